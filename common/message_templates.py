@@ -0,0 +1,101 @@
+import logging, os, threading
+
+from django.template import Context
+from django.template.base import TextNode
+from django.template.loader import get_template
+
+from configs.dev import settings
+
+logger = logging.getLogger(__name__)
+
+
+class MessageTemplateTooLong(Exception):
+	pass
+
+
+class MessageTemplateRegistry(object):
+	"""
+	Compiles every template under messages/ once. Templates that are all literal text are
+	rendered once and their bodies cached; the others render against a plain Context,
+	skipping the loader lookup. Templates longer than max_length are found at load time:
+	static bodies by their length and the others by the length of the literal text every
+	rendering contains. They are rejected if reject_oversize, and logged otherwise.
+	"""
+	TEMPLATE_DIRECTORY = 'messages'
+
+	def __init__(self, template_dirs=settings.TEMPLATE_DIRS, max_length=settings.TWILIO_MAX_SMS_LEN,
+		reject_oversize=settings.MESSAGE_TEMPLATES_REJECT_OVERSIZE):
+		self.template_dirs = template_dirs
+		self.max_length = max_length
+		self.reject_oversize = reject_oversize
+		self.templates = {}
+		self.static_bodies = {}
+		self.oversize_templates = []
+
+	def load(self):
+		for template_dir in self.template_dirs:
+			root = os.path.join(template_dir, self.TEMPLATE_DIRECTORY)
+			for dirpath, dirnames, filenames in os.walk(root):
+				for filename in filenames:
+					name = os.path.relpath(os.path.join(dirpath, filename), template_dir)
+					# The first template directory wins, as with the template loaders
+					if name.replace(os.sep, '/') not in self.templates:
+						self._add(name.replace(os.sep, '/'))
+		if self.oversize_templates:
+			error = "Message templates longer than %d characters: %s" % \
+			        (self.max_length, ", ".join(sorted(self.oversize_templates)))
+			if self.reject_oversize:
+				raise MessageTemplateTooLong(error)
+			logger.warning(error)
+
+	def _add(self, name):
+		template = get_template(name)
+		self.templates[name] = template
+		if all(isinstance(node, TextNode) for node in template.nodelist):
+			body = template.render(Context())
+			self.static_bodies[name] = body
+			length = len(body)
+		else:
+			# Only top level text is in every rendering; text in tags may be skipped
+			length = sum(len(node.s) for node in template.nodelist if isinstance(node, TextNode))
+		if length > self.max_length:
+			self.oversize_templates.append(name)
+
+	def names_in(self, directory):
+		"""
+		Returns the sorted names of the loaded templates in <directory>, e.g. 'messages/utility/'
+		"""
+		return sorted(name for name in self.templates if name.startswith(directory))
+
+	def render(self, name, context=None):
+		"""
+		Returns template <name> rendered with dictionary <context>
+		"""
+		body = self.static_bodies.get(name)
+		if body is not None:
+			return body
+		template = self.templates.get(name)
+		if template is None:
+			template = get_template(name)
+			self.templates[name] = template
+		return template.render(Context(context or {}))
+
+
+_message_templates = None
+_message_templates_lock = threading.Lock()
+
+def get_message_templates():
+	"""
+	Returns this process's MessageTemplateRegistry, loading it on first use
+	"""
+	global _message_templates
+	with _message_templates_lock:
+		if _message_templates is None:
+			message_templates = MessageTemplateRegistry()
+			message_templates.load()
+			_message_templates = message_templates
+	return _message_templates
+
+
+def render_message(name, context=None):
+	return get_message_templates().render(name, context)
@@ -1,8 +1,8 @@
 from __future__ import absolute_import
 
-from django.template.loader import render_to_string
 from django.db.models import Q
 
+from common.message_templates import render_message
 from common.models import UserProfile, RegistrationProfile
 from common.utilities import sendTextMessageToNumber
 from patients.models import PatientProfile
@@ -65,7 +65,7 @@ def create_inactive_patientprofile(
 	regprofile = create_regprofile_from_userprofile(patient)
 
 	# send verification SMS
-	sms_content = render_to_string(
+	sms_content = render_message(
 		'messages/verify_mobile.txt', 
 		{'otp':regprofile.phonenumber_activation_key})
 	sendTextMessageToNumber(to=primary_phone_number, body=sms_content)
@@ -1,6 +1,6 @@
 from django.contrib.contenttypes.models import ContentType
 from django.db.models import Q
-from django.db.models.signals import pre_delete
+from django.db.models.signals import pre_delete, post_save, post_delete
 from patients.models import PatientProfile
 from guardian.models import UserObjectPermission, GroupObjectPermission
 
@@ -10,4 +10,10 @@ def remove_obj_perms_connected_with_user(sender, instance, **kwargs):
 	UserObjectPermission.objects.filter(filters).delete()
 	GroupObjectPermission.objects.filter(filters).delete()
 
-pre_delete.connect(remove_obj_perms_connected_with_user, sender=PatientProfile)
\ No newline at end of file
+pre_delete.connect(remove_obj_perms_connected_with_user, sender=PatientProfile)
+
+def invalidate_patient_phone_number_cache(sender, instance, **kwargs):
+	PatientProfile.objects.invalidate_phone_number_cache(instance)
+
+post_save.connect(invalidate_patient_phone_number_cache, sender=PatientProfile)
+post_delete.connect(invalidate_patient_phone_number_cache, sender=PatientProfile)
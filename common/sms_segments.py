@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+import re
+
+# Texts are sent in GSM-7 when every character is in the GSM 03.38 alphabet, and in UCS-2 otherwise.
+# Characters of the extension table take two septets, an escape and the character itself.
+GSM7 = 'GSM-7'
+UCS2 = 'UCS-2'
+GSM7_BASIC_CHARACTERS = frozenset(u"@£$¥èéùìòÇ\nØø\rÅåΔ_ΦΓΛΩΠΨΣΘΞÆæßÉ !\"#¤%&'()*+,-./0123456789:;<=>?"
+                                  u"¡ABCDEFGHIJKLMNOPQRSTUVWXYZÄÖÑÜ§¿abcdefghijklmnopqrstuvwxyzäöñüà")
+GSM7_EXTENDED_CHARACTERS = frozenset(u"^{}\\[~]|€\f")
+
+# Characters per text of each encoding, alone and as part of a concatenated text,
+# whose user data header takes up the rest
+SEGMENT_LENGTHS = {
+	GSM7: (160, 153),
+	UCS2: (70, 67),
+}
+
+# A character, keeping surrogate pairs together on narrow Python builds
+CHARACTER_RE = re.compile(u"[\ud800-\udbff][\udc00-\udfff]|.", re.DOTALL)
+
+
+def _to_unicode(body):
+	if isinstance(body, str):
+		return body.decode('utf-8')
+	return body
+
+def sms_encoding(body):
+	"""
+	Returns GSM7 if <body> can be sent in GSM-7, or else UCS2
+	"""
+	for character in _to_unicode(body):
+		if character not in GSM7_BASIC_CHARACTERS and character not in GSM7_EXTENDED_CHARACTERS:
+			return UCS2
+	return GSM7
+
+def _character_lengths(body, encoding):
+	"""
+	Yields each character of <body> with the number of septets (GSM7) or
+	16 bit code units (UCS2) it takes up
+	"""
+	for character in CHARACTER_RE.findall(body):
+		if encoding == GSM7:
+			yield character, 2 if character in GSM7_EXTENDED_CHARACTERS else 1
+		else:
+			yield character, len(character.encode('utf-16-le')) / 2
+
+def split_sms(body):
+	"""
+	Returns <body> split into the segments of a concatenated text. Escaped characters
+	and surrogate pairs are never split across segments.
+	"""
+	body = _to_unicode(body)
+	encoding = sms_encoding(body)
+	single_length, concatenated_length = SEGMENT_LENGTHS[encoding]
+	character_lengths = list(_character_lengths(body, encoding))
+	if sum(length for (character, length) in character_lengths) <= single_length:
+		return [body]
+
+	segments = []
+	segment = []
+	segment_length = 0
+	for character, length in character_lengths:
+		if segment_length + length > concatenated_length:
+			segments.append(u''.join(segment))
+			segment = []
+			segment_length = 0
+		segment.append(character)
+		segment_length += length
+	segments.append(u''.join(segment))
+	return segments
+
+def count_segments(body):
+	"""
+	Returns the number of segments <body> is sent as
+	"""
+	return len(split_sms(body))
+
+def truncate_sms(body, max_segments):
+	"""
+	Returns <body> cut short to fit in <max_segments> segments
+	"""
+	segments = split_sms(body)
+	if len(segments) <= max_segments:
+		return _to_unicode(body)
+	return u''.join(segments[:max_segments])
+
+def pack_sms(bodies, max_segments, separator=u"\n\n"):
+	"""
+	Packs <bodies> to one recipient, in order, into the texts sent as the fewest segments
+	(and then the fewest texts), joining the bodies sent together with <separator>.
+	Returns a list of (packed body, indices of its bodies in <bodies>) tuples.
+	"""
+	bodies = [_to_unicode(body) for body in bodies]
+	# best[j] is the (segment count, text count, start of last text) of the best packing of bodies[:j]
+	best = [(0, 0, None)]
+	for j in range(1, len(bodies) + 1):
+		candidates = []
+		for i in range(j):
+			segment_count = count_segments(separator.join(bodies[i:j]))
+			if segment_count <= max_segments or i == j - 1:
+				candidates.append((best[i][0] + segment_count, best[i][1] + 1, i))
+		best.append(min(candidates))
+
+	packs = []
+	j = len(bodies)
+	while j > 0:
+		i = best[j][2]
+		packs.append((separator.join(bodies[i:j]), range(i, j)))
+		j = i
+	packs.reverse()
+	return packs
@@ -0,0 +1,232 @@
+import atexit, collections, logging, threading, time, Queue
+
+import twilio
+from twilio.rest import TwilioRestClient
+
+from common.sms_segments import count_segments
+from configs.dev import settings
+
+logger = logging.getLogger(__name__)
+
+class TwilioSMSProvider(object):
+	"""
+	Sends texts through Twilio. Each worker thread builds one client and reuses it
+	for all of its sends, since clients are not safe to share between threads.
+	"""
+	def __init__(self):
+		self._local = threading.local()
+
+	def send(self, body, to):
+		client = getattr(self._local, 'client', None)
+		if client is None:
+			client = TwilioRestClient(settings.TWILIO_ACCOUNT_SID, settings.TWILIO_AUTH_TOKEN)
+			self._local.client = client
+		client.messages.create(body=body, to=to, from_=settings.TWILIO_NUMBER)
+
+
+class FakeSMSProvider(object):
+	"""
+	Records texts instead of sending them, for tests and load testing.
+	Simulates provider latency with latency_sec, and raises TwilioRestException
+	(or <error>, if given) for the first <failures> sends.
+	"""
+	def __init__(self, latency_sec=0, failures=0, error=None):
+		self.latency_sec = latency_sec
+		self.failures = failures
+		self.error = error
+		self.sent = []
+		self._lock = threading.Lock()
+
+	def send(self, body, to):
+		if self.latency_sec:
+			time.sleep(self.latency_sec)
+		with self._lock:
+			if self.failures > 0:
+				self.failures -= 1
+				raise self.error or twilio.TwilioRestException(500, '/fake', "Fake provider failure")
+			self.sent.append((to, body))
+
+
+class RateLimiter(object):
+	"""
+	Token bucket allowing <rate> acquisitions per second with bursts of up to <burst>
+	"""
+	def __init__(self, rate, burst=1):
+		self.rate = float(rate)
+		self.burst = burst
+		self.tokens = float(burst)
+		self.last_refill = time.time()
+		self._lock = threading.Lock()
+
+	def try_acquire(self, tokens=1):
+		"""
+		Take <tokens> tokens if they're available right away. Returns whether they were taken.
+		"""
+		with self._lock:
+			now = time.time()
+			self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+			self.last_refill = now
+			if self.tokens >= min(tokens, self.burst):
+				self.tokens -= tokens
+				return True
+			return False
+
+	def acquire(self, tokens=1):
+		"""
+		Block until <tokens> tokens are available, then take them. More tokens than
+		the burst are taken as soon as a full bucket is, leaving the bucket in debt.
+		"""
+		needed = min(tokens, self.burst)
+		while True:
+			with self._lock:
+				now = time.time()
+				self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+				self.last_refill = now
+				if self.tokens >= needed:
+					self.tokens -= tokens
+					return
+				wait_sec = (needed - self.tokens) / self.rate
+			time.sleep(wait_sec)
+
+
+class SMSTransport(object):
+	"""
+	Outbound SMS pipeline: texts are queued and drained by a pool of worker threads.
+	Every recipient number is always served by the same worker, so texts to one
+	number go out in the order they were queued. Sends are rate limited globally
+	and per number, and retried with exponential backoff on TwilioRestException.
+	The global rate is in segments, since providers bill and throttle concatenated
+	texts per segment.
+	"""
+	LATENCY_SAMPLES = 1000
+
+	def __init__(self, provider=None,
+		worker_count=settings.SMS_TRANSPORT_WORKERS,
+		global_rate=settings.SMS_TRANSPORT_GLOBAL_RATE,
+		per_number_interval=settings.SMS_TRANSPORT_PER_NUMBER_INTERVAL,
+		max_retries=settings.SMS_TRANSPORT_MAX_RETRIES,
+		retry_backoff=settings.SMS_TRANSPORT_RETRY_BACKOFF):
+		self.provider = provider or TwilioSMSProvider()
+		self.worker_count = worker_count
+		self.per_number_interval = per_number_interval
+		self.max_retries = max_retries
+		self.retry_backoff = retry_backoff
+		self.global_rate_limiter = RateLimiter(global_rate, burst=worker_count)
+		self.queues = [Queue.Queue() for i in range(worker_count)]
+		self.workers = []
+		self.last_send_by_number = {}
+		self.latencies = collections.deque(maxlen=self.LATENCY_SAMPLES)
+		self.sent_count = 0
+		self.sent_segment_count = 0
+		self.failed_count = 0
+		self._lock = threading.Lock()
+
+	def start(self):
+		for queue in self.queues:
+			worker = threading.Thread(target=self._drain, args=(queue,))
+			worker.daemon = True
+			worker.start()
+			self.workers.append(worker)
+
+	def stop(self):
+		"""
+		Send every queued text, then stop the workers
+		"""
+		for queue in self.queues:
+			queue.put(None)
+		for worker in self.workers:
+			worker.join()
+		self.workers = []
+
+	def enqueue(self, body, to):
+		self.queues[hash(to) % self.worker_count].put((body, to))
+
+	def join(self):
+		"""
+		Block until every queued text has been sent or has failed
+		"""
+		for queue in self.queues:
+			queue.join()
+
+	def metrics(self):
+		with self._lock:
+			latencies = sorted(self.latencies)
+			sent_count = self.sent_count
+			sent_segment_count = self.sent_segment_count
+			failed_count = self.failed_count
+		def percentile(p):
+			if not latencies:
+				return None
+			return latencies[min(len(latencies) - 1, int(p * len(latencies)))]
+		return {'queue_depth': sum(queue.qsize() for queue in self.queues),
+		        'sent': sent_count,
+		        'sent_segments': sent_segment_count,
+		        'failed': failed_count,
+		        'p50_latency_sec': percentile(0.50),
+		        'p99_latency_sec': percentile(0.99)}
+
+	def _drain(self, queue):
+		while True:
+			item = queue.get()
+			try:
+				if item is None:
+					return
+				self._send(*item)
+			except Exception:
+				# Anything but a provider error isn't worth retrying, but mustn't kill the worker,
+				# or every number it serves would stall
+				logger.exception("Failed to send text to %s", item[1])
+				with self._lock:
+					self.failed_count += 1
+			finally:
+				queue.task_done()
+
+	def _wait_for_number(self, to):
+		# Only the worker that owns <to> sends to it, so no lock is needed around the wait
+		last_send = self.last_send_by_number.get(to)
+		if last_send is not None:
+			wait_sec = last_send + self.per_number_interval - time.time()
+			if wait_sec > 0:
+				time.sleep(wait_sec)
+		self.last_send_by_number[to] = time.time()
+
+	def _send(self, body, to):
+		backoff = self.retry_backoff
+		segment_count = count_segments(body)
+		for attempt in range(self.max_retries + 1):
+			self._wait_for_number(to)
+			self.global_rate_limiter.acquire(segment_count)
+			start_time = time.time()
+			try:
+				self.provider.send(body, to)
+			except twilio.TwilioRestException as e:
+				if attempt == self.max_retries:
+					logger.warning("Failed to send text to %s after %d attempts: %s", to, attempt + 1, e)
+					with self._lock:
+						self.failed_count += 1
+					return
+				time.sleep(backoff)
+				backoff *= 2
+			else:
+				with self._lock:
+					self.latencies.append(time.time() - start_time)
+					self.sent_count += 1
+					self.sent_segment_count += segment_count
+				return
+
+
+_sms_transport = None
+_sms_transport_lock = threading.Lock()
+
+def get_sms_transport():
+	"""
+	Returns this process's SMSTransport, starting it on first use.
+	Queued texts are flushed when the process exits.
+	"""
+	global _sms_transport
+	with _sms_transport_lock:
+		if _sms_transport is None:
+			_sms_transport = SMSTransport()
+			_sms_transport.start()
+			atexit.register(_sms_transport.stop)
+	return _sms_transport
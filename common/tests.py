@@ -6,20 +6,25 @@ Replace this with more appropriate tests for your application.
 """
 from django.contrib.auth import authenticate
 from django.core.exceptions import ValidationError
+from django.db import connection
 from django.template import Context, Template
+from django.template.loader import render_to_string
 from django.test import SimpleTestCase, TestCase
 
 from configs.dev import settings
 from configs.dev.settings import PROJECT_ROOT
 from common.datasources import *
+from common.message_templates import MessageTemplateRegistry, MessageTemplateTooLong
 from common.utilities import *
+from common.sms_segments import *
+from common.sms_transport import RateLimiter, SMSTransport, FakeSMSProvider
 from common.models import Drug
 from doctors.models import DoctorProfile
 from patients.models import PatientProfile
 from reminders.models import Notification, Prescription
 
 from freezegun import freeze_time
-import random, string, datetime
+import mock, os, random, string, datetime, pytz
 
 
 class TestDatasources(TestCase):
@@ -155,6 +160,216 @@ class MessageUtilitiesTest(TestCase):
 			f = open(settings.MESSAGE_LOG_FILENAME, 'w') # Open file with 'w' permission to clear log file.
 			f.close() 
 
+	def test_get_last_sent_messages(self):
+		self.assertEqual(SMSLogger.getLastSentMessage(), None)
+		sent_datetime = datetime.datetime(year=2013, month=10, day=13, hour=11)
+		for i in range(5):
+			SMSLogger.log('+18569067308', 'Message %d' % i, sent_datetime)
+		self.assertEqual(SMSLogger.getLastSentMessage()['content'], 'Message 4')
+		messages = SMSLogger.getLastNSentMessages(2)
+		self.assertEqual([m['content'] for m in messages], ['Message 3', 'Message 4'])
+		self.assertEqual(messages[0]['datetime_sent'], sent_datetime)
+		self.assertEqual(len(SMSLogger.getLastNSentMessages(10)), 5)
+
+	def test_tail_read_spans_blocks(self):
+		content = 'x' * (SMSLogger.TAIL_BLOCK_SIZE / 3)
+		for i in range(10):
+			SMSLogger.log('+18569067308', content + str(i), datetime.datetime.now())
+		messages = SMSLogger.getLastNSentMessages(4)
+		self.assertEqual([m['content'] for m in messages], [content + str(i) for i in range(6, 10)])
+
+	def test_log_rotates_by_size(self):
+		max_bytes = settings.MESSAGE_LOG_MAX_BYTES
+		settings.MESSAGE_LOG_MAX_BYTES = 1
+		try:
+			for i in range(3):
+				SMSLogger.log('+18569067308', 'Message %d' % i, datetime.datetime.now())
+		finally:
+			settings.MESSAGE_LOG_MAX_BYTES = max_bytes
+		self.assertEqual(SMSLogger._read_last_lines(settings.MESSAGE_LOG_FILENAME, 10),
+		                 SMSLogger._read_last_lines(settings.MESSAGE_LOG_FILENAME, 1))
+		self.assertTrue(os.path.exists(settings.MESSAGE_LOG_FILENAME + ".1"))
+		messages = SMSLogger.getLastNSentMessages(3)
+		self.assertEqual([m['content'] for m in messages], ['Message 0', 'Message 1', 'Message 2'])
+		for i in range(1, 3):
+			os.remove("%s.%d" % (settings.MESSAGE_LOG_FILENAME, i))
+
+	def test_log_reopens_file_rotated_by_another_process(self):
+		SMSLogger.log('+18569067308', 'Message 0', datetime.datetime.now())
+		os.rename(settings.MESSAGE_LOG_FILENAME, settings.MESSAGE_LOG_FILENAME + ".1")
+		max_bytes = settings.MESSAGE_LOG_MAX_BYTES
+		settings.MESSAGE_LOG_MAX_BYTES = 1
+		try:
+			SMSLogger.log('+18569067308', 'Message 1', datetime.datetime.now())
+		finally:
+			settings.MESSAGE_LOG_MAX_BYTES = max_bytes
+		# The rotated file isn't rotated again
+		self.assertFalse(os.path.exists(settings.MESSAGE_LOG_FILENAME + ".2"))
+		self.assertEqual([m['content'] for m in SMSLogger.getLastNSentMessages(2)], ['Message 0', 'Message 1'])
+		os.remove(settings.MESSAGE_LOG_FILENAME + ".1")
+
+	def test_empty_log_is_not_rotated_on_a_new_day(self):
+		rotate_daily = settings.MESSAGE_LOG_ROTATE_DAILY
+		settings.MESSAGE_LOG_ROTATE_DAILY = True
+		try:
+			SMSLogger.flush()
+			SMSLogger._open()
+			SMSLogger._file_date = datetime.date.today() - datetime.timedelta(days=1)
+			for i in range(2):
+				SMSLogger.log('+18569067308', 'Message %d' % i, datetime.datetime.now())
+		finally:
+			settings.MESSAGE_LOG_ROTATE_DAILY = rotate_daily
+		self.assertFalse(os.path.exists(settings.MESSAGE_LOG_FILENAME + ".1"))
+		self.assertEqual(len(SMSLogger._read_last_lines(settings.MESSAGE_LOG_FILENAME, 10)), 2)
+
+	def test_idle_log_is_flushed_by_timer(self):
+		with mock.patch.object(settings, 'MESSAGE_LOG_BUFFER_LINES', 100):
+			with mock.patch.object(settings, 'MESSAGE_LOG_FLUSH_INTERVAL', 0.05):
+				SMSLogger.flush()
+				SMSLogger.log('+18569067308', 'Message 0', datetime.datetime.now())
+				self.assertEqual(SMSLogger._read_last_lines(settings.MESSAGE_LOG_FILENAME, 10), [])
+				SMSLogger._flush_timer.join(1)
+		self.assertEqual(len(SMSLogger._read_last_lines(settings.MESSAGE_LOG_FILENAME, 10)), 1)
+
+class SMSTransportTest(SimpleTestCase):
+	def test_texts_to_a_number_are_sent_in_order(self):
+		provider = FakeSMSProvider()
+		transport = SMSTransport(provider=provider, worker_count=3, global_rate=1000,
+		                         per_number_interval=0, max_retries=0, retry_backoff=0)
+		transport.start()
+		numbers = ['+18569067308', '+12147094720', '+12029163381']
+		for i in range(10):
+			for number in numbers:
+				transport.enqueue(str(i), number)
+		transport.stop()
+
+		self.assertEqual(len(provider.sent), 30)
+		for number in numbers:
+			self.assertEqual([body for (to, body) in provider.sent if to == number], [str(i) for i in range(10)])
+		metrics = transport.metrics()
+		self.assertEqual(metrics['sent'], 30)
+		self.assertEqual(metrics['queue_depth'], 0)
+		self.assertIsNotNone(metrics['p50_latency_sec'])
+		self.assertIsNotNone(metrics['p99_latency_sec'])
+
+	def test_failed_sends_are_retried(self):
+		provider = FakeSMSProvider(failures=2)
+		transport = SMSTransport(provider=provider, worker_count=1, global_rate=1000,
+		                         per_number_interval=0, max_retries=2, retry_backoff=0.01)
+		transport.start()
+		transport.enqueue("Hello", '+18569067308')
+		transport.join()
+		self.assertEqual(provider.sent, [('+18569067308', "Hello")])
+		self.assertEqual(transport.metrics()['failed'], 0)
+
+		provider.failures = 3
+		transport.enqueue("Hello again", '+18569067308')
+		transport.stop()
+		self.assertEqual(len(provider.sent), 1)
+		self.assertEqual(transport.metrics()['failed'], 1)
+
+	def test_worker_survives_unexpected_errors(self):
+		provider = FakeSMSProvider(failures=1, error=IOError("Connection reset by peer"))
+		transport = SMSTransport(provider=provider, worker_count=1, global_rate=1000,
+		                         per_number_interval=0, max_retries=2, retry_backoff=0)
+		transport.start()
+		transport.enqueue("Hello", '+18569067308')
+		transport.enqueue("Hello again", '+18569067308')
+		transport.stop()
+		self.assertEqual(provider.sent, [('+18569067308', "Hello again")])
+		self.assertEqual(transport.metrics()['failed'], 1)
+		self.assertEqual(transport.metrics()['sent'], 1)
+
+	def test_rate_limiter_try_acquire(self):
+		rate_limiter = RateLimiter(0.001, burst=2)
+		self.assertTrue(rate_limiter.try_acquire())
+		self.assertTrue(rate_limiter.try_acquire())
+		self.assertFalse(rate_limiter.try_acquire())
+
+class SMSSegmentsTest(SimpleTestCase):
+	def test_encoding(self):
+		self.assertEqual(sms_encoding("Time to take your meds [1/2]"), GSM7)
+		self.assertEqual(sms_encoding(u"Caf\xe9 \u20ac5"), GSM7)
+		self.assertEqual(sms_encoding(u"Time to take your meds \U0001f48a"), UCS2)
+
+	def test_split_and_count_segments(self):
+		self.assertEqual(count_segments("a" * 160), 1)
+		self.assertEqual([len(segment) for segment in split_sms("a" * 161)], [153, 8])
+		# Escaped characters take two septets and are never split from their escape
+		self.assertEqual(count_segments("{" * 80), 1)
+		self.assertEqual([len(segment) for segment in split_sms("a" + "{" * 80)], [1 + 76, 4])
+		self.assertEqual(count_segments(u"\u2019" * 70), 1)
+		self.assertEqual([len(segment) for segment in split_sms(u"\u2019" * 71)], [67, 4])
+		self.assertEqual(truncate_sms("a" * 400, 2), "a" * 306)
+		self.assertEqual(truncate_sms("Hello", 1), "Hello")
+
+	def test_pack_sms(self):
+		self.assertEqual(pack_sms(["a" * 100, "b" * 100], 10), [("a" * 100 + "\n\n" + "b" * 100, [0, 1])])
+		# Joining two full texts would take three segments instead of two
+		self.assertEqual([indices for (body, indices) in pack_sms(["a" * 160, "b" * 160], 10)], [[0], [1]])
+		self.assertEqual([indices for (body, indices) in pack_sms(["a" * 100] * 3, 1)], [[0], [1], [2]])
+		self.assertEqual(pack_sms([], 10), [])
+
+class QueryBudgetTest(TestCase):
+	@mock.patch('common.utilities.logger')
+	def test_query_budget(self, logger):
+		with query_budget(1, "Test block"):
+			list(Drug.objects.all())
+		self.assertFalse(logger.warning.called)
+		with query_budget(1, "Test block"):
+			list(Drug.objects.all())
+			list(Drug.objects.all())
+		logger.warning.assert_called_once_with("%s ran %d queries, over its budget of %d", "Test block", 2, 1)
+
+	@mock.patch('common.utilities.logger')
+	def test_query_budget_does_not_record_queries(self, logger):
+		use_debug_cursor = connection.use_debug_cursor
+		connection.use_debug_cursor = False
+		try:
+			start_query_count = len(connection.queries)
+			with query_budget(0, "Test block"):
+				list(Drug.objects.all())
+		finally:
+			connection.use_debug_cursor = use_debug_cursor
+		self.assertEqual(len(connection.queries), start_query_count)
+		logger.warning.assert_called_once_with("%s ran %d queries, over its budget of %d", "Test block", 1, 0)
+
+	@mock.patch('common.utilities.logger')
+	def test_nested_query_budgets(self, logger):
+		with query_budget(2, "Outer block"):
+			with query_budget(0, "Inner block"):
+				list(Drug.objects.all())
+			list(Drug.objects.all())
+			list(Drug.objects.all())
+		self.assertEqual(logger.warning.call_args_list, [
+			mock.call("%s ran %d queries, over its budget of %d", "Inner block", 1, 0),
+			mock.call("%s ran %d queries, over its budget of %d", "Outer block", 3, 2),
+		])
+
+
+class MessageTemplateRegistryTest(SimpleTestCase):
+	def test_templates_render_as_with_render_to_string(self):
+		registry = MessageTemplateRegistry(reject_oversize=False)
+		registry.load()
+		static_template = 'messages/response_quit_is_confirmed.txt'
+		self.assertIn(static_template, registry.static_bodies)
+		self.assertEqual(registry.render(static_template), render_to_string(static_template))
+		dynamic_template = 'messages/verify_mobile.txt'
+		self.assertNotIn(dynamic_template, registry.static_bodies)
+		self.assertEqual(registry.render(dynamic_template, {'otp': '12345'}),
+		                 render_to_string(dynamic_template, {'otp': '12345'}))
+		self.assertIn("messages/medication_questionnaire_responses/Haven't gotten the chance.txt",
+		              registry.names_in('messages/medication_questionnaire_responses/'))
+
+	def test_oversize_templates(self):
+		registry = MessageTemplateRegistry(reject_oversize=False)
+		registry.load()
+		self.assertIn('messages/refill_questionnaire_responses/Too expensive.txt', registry.oversize_templates)
+		self.assertNotIn('messages/verify_mobile.txt', registry.oversize_templates)
+		registry = MessageTemplateRegistry(max_length=20, reject_oversize=True)
+		self.assertRaises(MessageTemplateTooLong, registry.load)
+
+
 class DatetimeUtilitiesTest(TestCase):
 	def test_week_of_month(self):
 		testtime = datetime.datetime(year=2013, month=11, day=17)
@@ -183,6 +398,33 @@ class DatetimeUtilitiesTest(TestCase):
 		self.assertTrue(lastWeekOfMonth(testtime))
 		testtime = datetime.datetime(year=2013, month=5, day=31)
 		self.assertTrue(lastWeekOfMonth(testtime))
+	def test_convert_timezone(self):
+		los_angeles = pytz.timezone('America/Los_Angeles')
+		new_york = pytz.timezone('America/New_York')
+		self.assertEqual(convert_timezone(datetime.datetime(2014, 1, 1, 8, 0), new_york, los_angeles),
+		                 datetime.datetime(2014, 1, 1, 5, 0))
+		# 2:30am is skipped on 3/9/2014 and moves forward an hour
+		self.assertEqual(convert_timezone(datetime.datetime(2014, 3, 9, 2, 30), new_york, pytz.utc),
+		                 datetime.datetime(2014, 3, 9, 7, 30))
+		# 1:30am happens twice on 11/2/2014; the first is in daylight time
+		self.assertEqual(convert_timezone(datetime.datetime(2014, 11, 2, 1, 30), new_york, pytz.utc),
+		                 datetime.datetime(2014, 11, 2, 5, 30))
+		self.assertEqual(convert_timezone(datetime.datetime(2014, 11, 2, 1, 30), new_york, pytz.utc, is_dst=False),
+		                 datetime.datetime(2014, 11, 2, 6, 30))
+
+	def test_to_server_datetime(self):
+		new_york = pytz.timezone('America/New_York')
+		with mock.patch.object(settings, 'TIME_ZONE', 'America/Los_Angeles'):
+			self.assertEqual(to_server_datetime(datetime.datetime(2014, 7, 1, 8, 0), new_york),
+			                 (datetime.datetime(2014, 7, 1, 5, 0), None))
+			# Both of these are 1:30am in Los Angeles on 11/2/2014, before and after it falls back
+			self.assertEqual(to_server_datetime(datetime.datetime(2014, 11, 2, 3, 30), new_york),
+			                 (datetime.datetime(2014, 11, 2, 1, 30), True))
+			self.assertEqual(to_server_datetime(datetime.datetime(2014, 11, 2, 4, 30), new_york),
+			                 (datetime.datetime(2014, 11, 2, 1, 30), False))
+			self.assertEqual(resolve_server_is_dst(datetime.datetime(2014, 7, 1, 1, 30)), None)
+			# The current instant is long past both
+			self.assertEqual(resolve_server_is_dst(datetime.datetime(2014, 11, 2, 1, 30)), False)
 
 # ==== AUTHENTICATION TESTS =========================================
 
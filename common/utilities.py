@@ -1,28 +1,51 @@
-import json
+import atexit, fcntl, json, logging, os, threading, time
 from configs.dev import settings
 import twilio
 from twilio.rest import TwilioRestClient
 import datetime as datetime_orig
 import codecs
 from datetime import timedelta
+from contextlib import contextmanager
 from math import ceil, floor
-from django.db import models
+from django.db import models, connection
 import phonenumbers
+import pytz
+
+from common.sms_segments import truncate_sms
+from common.sms_transport import get_sms_transport
 
 # Construct our client for communicating with Twilio service
 twilio_client = TwilioRestClient(settings.TWILIO_ACCOUNT_SID, 
 								 settings.TWILIO_AUTH_TOKEN)
 twilio_number = settings.TWILIO_NUMBER
 
+logger = logging.getLogger(__name__)
+
 
 class SMSLogger():
 	""" Used to log sent SMS content to a file and read back SMS content from file
+	The log file is kept open; lines are buffered and written every MESSAGE_LOG_BUFFER_LINES
+	lines or MESSAGE_LOG_FLUSH_INTERVAL seconds, by a timer if nothing else is logged. The file is rotated to numbered backups
+	(<filename>.1 is the most recent) by size and, if MESSAGE_LOG_ROTATE_DAILY, by day.
+	Every worker process appends to the same file, so rotation is done under an exclusive
+	lock on it, and a process whose file was rotated by another reopens the new one.
 	"""
 	# See Unicode private use areas: http://en.wikipedia.org/wiki/Private_Use_Areas
 	DATETIME_DELIMITER = u'\uE000'
 	TO_NUMBER_DELIMITER = u'\uE001'
 	CONTENT_DELIMITER = u'\uE002'
 	NEWLINE_ENCODER = u'\uE003'
+
+	TAIL_BLOCK_SIZE = 4096 # bytes read at a time when reading the log backwards
+
+	_file = None
+	_filename = None
+	_file_date = None
+	_buffer = []
+	_last_flush_time = 0
+	_flush_timer = None
+	_lock = threading.RLock()
+
 	@staticmethod
 	def _decode_log(string):
 		if string == "" or string == None or string == "\n":
@@ -32,51 +55,158 @@ class SMSLogger():
 		log_data['datetime_sent'] = datetime
 		return log_data
 
+	@staticmethod
+	def _open():
+		filename = settings.MESSAGE_LOG_FILENAME
+		if SMSLogger._file is not None and SMSLogger._filename == filename:
+			return
+		SMSLogger._close()
+		SMSLogger._file = open(filename, 'ab')
+		SMSLogger._filename = filename
+		# Lines already in the file are from the day it was last written
+		stat = os.fstat(SMSLogger._file.fileno())
+		if stat.st_size:
+			SMSLogger._file_date = datetime_orig.date.fromtimestamp(stat.st_mtime)
+		else:
+			SMSLogger._file_date = datetime_orig.date.today()
+
+	@staticmethod
+	def _close():
+		if SMSLogger._file is not None:
+			SMSLogger._file.close()
+			SMSLogger._file = None
+
+	@staticmethod
+	def _is_current():
+		""" Returns whether the open file is still the one at the log's filename, i.e. no
+		other process has rotated it away
+		"""
+		try:
+			return os.stat(SMSLogger._filename).st_ino == os.fstat(SMSLogger._file.fileno()).st_ino
+		except OSError:
+			return False
+
+	@staticmethod
+	def _needs_rotation():
+		size = os.fstat(SMSLogger._file.fileno()).st_size
+		if size == 0:
+			# Whatever is written next is today's
+			SMSLogger._file_date = datetime_orig.date.today()
+			return False
+		new_day = settings.MESSAGE_LOG_ROTATE_DAILY and SMSLogger._file_date != datetime_orig.date.today()
+		return size >= settings.MESSAGE_LOG_MAX_BYTES or new_day
+
+	@staticmethod
+	def _rotate_if_needed():
+		if SMSLogger._is_current() and not SMSLogger._needs_rotation():
+			return
+		# Whichever process gets the lock first rotates; the others find their file
+		# rotated away once they get it, and only reopen
+		fcntl.flock(SMSLogger._file.fileno(), fcntl.LOCK_EX)
+		try:
+			if SMSLogger._is_current() and SMSLogger._needs_rotation():
+				filename = SMSLogger._filename
+				for i in range(settings.MESSAGE_LOG_BACKUP_COUNT - 1, 0, -1):
+					if os.path.exists("%s.%d" % (filename, i)):
+						os.rename("%s.%d" % (filename, i), "%s.%d" % (filename, i + 1))
+				os.rename(filename, filename + ".1")
+		finally:
+			# Closing releases the lock
+			SMSLogger._close()
+		SMSLogger._open()
+
+	@staticmethod
+	def flush():
+		""" Write buffered log lines to the log file
+		"""
+		with SMSLogger._lock:
+			SMSLogger._last_flush_time = time.time()
+			if SMSLogger._flush_timer is not None:
+				SMSLogger._flush_timer.cancel()
+				SMSLogger._flush_timer = None
+			if not SMSLogger._buffer:
+				return
+			SMSLogger._open()
+			SMSLogger._rotate_if_needed()
+			SMSLogger._file.write("".join(SMSLogger._buffer))
+			SMSLogger._file.flush()
+			SMSLogger._buffer = []
+
+	@staticmethod
+	def _read_last_lines(filename, n):
+		""" Returns the last n lines of file filename, reading backwards from the end of
+		the file so the cost is proportional to n rather than to the size of the file
+		"""
+		if n <= 0 or not os.path.exists(filename):
+			return []
+		with open(filename, 'rb') as f:
+			f.seek(0, os.SEEK_END)
+			position = f.tell()
+			data = ""
+			# n complete lines are guaranteed once n+1 newlines have been read
+			while position > 0 and data.count("\n") <= n:
+				read_size = min(SMSLogger.TAIL_BLOCK_SIZE, position)
+				position -= read_size
+				f.seek(position)
+				data = f.read(read_size) + data
+		lines = [line for line in data.split("\n") if line]
+		return lines[-n:]
+
+	@staticmethod
+	def _get_last_n_lines(n):
+		SMSLogger.flush()
+		filename = settings.MESSAGE_LOG_FILENAME
+		lines = SMSLogger._read_last_lines(filename, n)
+		backup = 1
+		while len(lines) < n and backup <= settings.MESSAGE_LOG_BACKUP_COUNT:
+			lines = SMSLogger._read_last_lines("%s.%d" % (filename, backup), n - len(lines)) + lines
+			backup += 1
+		return lines
+
 	@staticmethod
 	def getLastSentMessage():
 		if not settings.DEBUG:
 			raise Exception("getLastSentMessageContent should only be used in test setting")
-
-		f = codecs.open(settings.MESSAGE_LOG_FILENAME, 'r')
-		# Iterate through file until we get to last line of file
-		line = ""
-		for line in f:
-			pass
-		f.close()
-		return SMSLogger._decode_log(line)
+		lines = SMSLogger._get_last_n_lines(1)
+		if not lines:
+			return None
+		return SMSLogger._decode_log(lines[0])
 
 	@staticmethod
 	def getLastNSentMessages(n):
 		if not settings.DEBUG:
 			raise Exception("getLastNSentMessageContent should only be used in test setting")
-		l = []
-		f = codecs.open(settings.MESSAGE_LOG_FILENAME, 'r')
-		# Iterate through file until we get to last line of file
-		for message in f: l.append(message.rstrip('\n'))
-		f.close()
-		l = l[-n:] # reverse array so most recently sent message is first
-		messages = []
-		for line in l:
-			messages.append(SMSLogger._decode_log(line))
-		return messages
+		return [SMSLogger._decode_log(line) for line in SMSLogger._get_last_n_lines(n)]
 
 	@staticmethod
 	def log(to_number, content, datetime_sent):
-		f = codecs.open(settings.MESSAGE_LOG_FILENAME, 'a')
 		log_data = {'datetime_sent': str(datetime_sent), 'to': to_number, 'content':content}
-		f.write(json.dumps(log_data)+"\n")
-		f.close()
+		with SMSLogger._lock:
+			SMSLogger._buffer.append(json.dumps(log_data)+"\n")
+			if len(SMSLogger._buffer) >= settings.MESSAGE_LOG_BUFFER_LINES or \
+				time.time() - SMSLogger._last_flush_time >= settings.MESSAGE_LOG_FLUSH_INTERVAL:
+				SMSLogger.flush()
+			elif SMSLogger._flush_timer is None:
+				# Write the lines out even if this process logs nothing else for a while
+				SMSLogger._flush_timer = threading.Timer(settings.MESSAGE_LOG_FLUSH_INTERVAL, SMSLogger.flush)
+				SMSLogger._flush_timer.daemon = True
+				SMSLogger._flush_timer.start()
+
+atexit.register(SMSLogger.flush)
 
 
 def sendTextMessageToNumber(body, to):
 	if settings.SEND_TEXT_MESSAGES:
 		to = convert_to_e164(to)
-		try: 
-			# just send first 160 char for now; plan to support concatenation in the future
-			body = body[:settings.TWILIO_MAX_SMS_LEN] #
-			message = twilio_client.messages.create(body=body, to=to, from_=twilio_number)
-		except twilio.TwilioRestException as e:
-			print e
+		# Longer bodies are sent as concatenated texts, up to SMS_MAX_SEGMENTS of them
+		body = truncate_sms(body, settings.SMS_MAX_SEGMENTS)
+		if settings.SMS_TRANSPORT_ASYNC:
+			get_sms_transport().enqueue(body, to)
+		else:
+			try: 
+				message = twilio_client.messages.create(body=body, to=to, from_=twilio_number)
+			except twilio.TwilioRestException as e:
+				print e
 	# else:
 	# 	print body
 
@@ -134,6 +264,88 @@ def list_to_queryset(l):
 	return None
 
 
+def reserve_primary_keys(instances):
+	"""
+	Assigns primary keys drawn from the table's Postgres sequence to unsaved model
+	<instances> of a single Model subclass in one query. bulk_create does not return
+	primary keys, so this lets bulk-created rows be referenced by foreign keys.
+	"""
+	if not instances:
+		return
+	model_meta = instances[0].__class__._meta
+	cursor = connection.cursor()
+	cursor.execute("SELECT nextval(pg_get_serial_sequence(%s, %s)) FROM generate_series(1, %s)",
+	               [model_meta.db_table, model_meta.pk.column, len(instances)])
+	for instance, row in zip(instances, cursor.fetchall()):
+		instance.pk = row[0]
+
+
+@contextmanager
+def advisory_lock(key, subkey=0, wait=False):
+	"""
+	Try to take the Postgres session-level advisory lock (<key>, <subkey>) without blocking.
+	Yields True if the lock was acquired, False if another session holds it.
+	If wait, blocks until the lock is free instead, and always yields True.
+	The lock is released on exit, or by Postgres if the holding connection dies.
+	"""
+	cursor = connection.cursor()
+	if wait:
+		cursor.execute("SELECT pg_advisory_lock(%s, %s)", [key, subkey])
+		acquired = True
+	else:
+		cursor.execute("SELECT pg_try_advisory_lock(%s, %s)", [key, subkey])
+		acquired = cursor.fetchone()[0]
+	try:
+		yield acquired
+	finally:
+		if acquired:
+			cursor.execute("SELECT pg_advisory_unlock(%s, %s)", [key, subkey])
+
+
+class _CountingCursor(object):
+	"""
+	Wraps a database cursor, counting the statements it executes.
+	"""
+	def __init__(self, cursor, counter):
+		self.cursor = cursor
+		self.counter = counter
+
+	def __getattr__(self, attr):
+		return getattr(self.cursor, attr)
+
+	def __iter__(self):
+		return iter(self.cursor)
+
+	def execute(self, *args, **kwargs):
+		self.counter[0] += 1
+		return self.cursor.execute(*args, **kwargs)
+
+	def executemany(self, *args, **kwargs):
+		self.counter[0] += 1
+		return self.cursor.executemany(*args, **kwargs)
+
+
+@contextmanager
+def query_budget(max_queries, description):
+	"""
+	Logs a warning if the block runs more than max_queries queries.
+	Queries are counted without being recorded, so this is cheap with DEBUG off.
+	"""
+	counter = [0]
+	instance_cursor = connection.__dict__.get('cursor')
+	make_cursor = connection.cursor
+	connection.cursor = lambda: _CountingCursor(make_cursor(), counter)
+	try:
+		yield
+	finally:
+		if instance_cursor is None:
+			del connection.cursor
+		else:
+			connection.cursor = instance_cursor
+		if counter[0] > max_queries:
+			logger.warning("%s ran %d queries, over its budget of %d", description, counter[0], max_queries)
+
+
 def convert_to_e164(raw_phone):
 	"""
 	Convert a raw phone number string to E.164 format
@@ -169,6 +381,66 @@ def next_weekday(d, weekday):
 	return d + datetime_orig.timedelta(days_ahead)
 
 
+def localize(dt, zone, is_dst=True):
+	"""
+	Returns naive wall-clock datetime <dt> in pytz zone <zone> as an aware datetime. As in
+	RFC 5545, a time skipped by a DST change moves forward by the change; a repeated time is
+	its first (daylight saving) instant, unless is_dst is False.
+	"""
+	try:
+		return zone.localize(dt, is_dst=None)
+	except pytz.NonExistentTimeError:
+		return zone.normalize(zone.localize(dt, is_dst=False))
+	except pytz.AmbiguousTimeError:
+		return zone.localize(dt, is_dst=is_dst is not False)
+
+
+def convert_timezone(dt, from_zone, to_zone, is_dst=True):
+	"""
+	Returns naive wall-clock datetime <dt> in pytz zone <from_zone> as the naive wall-clock
+	datetime of the same instant in <to_zone>. See localize for times DST changes skip or repeat.
+	"""
+	if from_zone.zone == to_zone.zone:
+		return dt
+	return localize(dt, from_zone, is_dst).astimezone(to_zone).replace(tzinfo=None)
+
+
+def server_timezone():
+	"""Returns the pytz zone of the naive datetimes stored and compared against datetime.now()"""
+	return pytz.timezone(settings.TIME_ZONE)
+
+
+def to_server_datetime(dt, zone):
+	"""
+	Returns naive wall-clock datetime <dt> in pytz zone <zone> as a (naive server datetime,
+	is_dst) pair. is_dst is None unless a DST change repeats the server time, in which case
+	it tells whether the daylight saving (first) instant is meant.
+	"""
+	server_zone = server_timezone()
+	server_dt = localize(dt, zone).astimezone(server_zone)
+	naive_server_dt = server_dt.replace(tzinfo=None)
+	try:
+		server_zone.localize(naive_server_dt, is_dst=None)
+		return (naive_server_dt, None)
+	except pytz.AmbiguousTimeError:
+		return (naive_server_dt, bool(server_dt.dst()))
+
+
+def resolve_server_is_dst(dt):
+	"""
+	Returns None if naive server datetime <dt> occurs once, or whether its latest occurrence
+	not after the current instant is the daylight saving one
+	"""
+	zone = server_timezone()
+	try:
+		zone.localize(dt, is_dst=None)
+		return None
+	except pytz.NonExistentTimeError:
+		return None
+	except pytz.AmbiguousTimeError:
+		return zone.localize(dt, is_dst=False) > datetime_orig.datetime.now(pytz.utc)
+
+
 class InterpersonalRelationship():
 	FRIEND          = 'friend'
 
@@ -24,6 +24,27 @@ TEMPLATE_DEBUG = DEBUG
 SEND_TEXT_MESSAGES = True if not TEST else False
 MESSAGE_CUTOFF_HOURS = 24 # hours
 REMINDER_MERGE_INTERVAL = 3600 # seconds
+REMINDER_DISPATCH_SHARDS = 1 # number of sendRemindersForShard subtasks each reminder tick fans out to
+REMINDER_CATCH_UP_WINDOW = 900 # seconds; after missed ticks, reminders are caught up in windows of this size
+# Dispatch records are written after every this many recipients, bounding the replies that arrive
+# before their message is recorded; send times are advanced as each text goes out, so none are resent
+REMINDER_DISPATCH_FLUSH_SIZE = 10
+# seconds; each tick's recipients are paced evenly over this window, and never faster than
+# SMS_TRANSPORT_GLOBAL_RATE, to flatten the spikes at round reminder times. Recipients left when
+# the window is up are sent unpaced, so keep it under the one minute tick; 0 sends to every
+# recipient at once. Off in tests, which freeze the clock.
+REMINDER_SEND_SPREAD_WINDOW = 0 if TEST else 45
+# Send time learning (see reminders.send_time_learner.SendTimeLearner), retrained nightly
+SEND_TIME_ACK_WINDOW = 3600 # seconds; doses acknowledged within this count as acknowledged on time
+SEND_TIME_MAX_OFFSET_HOURS = 2 # medication reminders are delayed by at most this many hours
+SEND_TIME_PRIOR_WEIGHT = 5 # doses; each hour's acknowledgement rate is smoothed toward the patient's overall rate
+SEND_TIME_MIN_IMPROVEMENT = 0.1 # acknowledgement rate a later hour must gain before reminders are moved to it
+# seconds patient ids are cached by phone number; the row is always read, so per-process caches are never stale.
+# Off in tests, since the cache outlives each test's rolled back patients
+PATIENT_PHONE_NUMBER_CACHE_TIMEOUT = 0 if TEST else 300
+INBOUND_SMS_QUERY_BUDGET = 25 # queries; inbound texts needing more are logged
+INBOUND_MESSAGE_LEDGER_TTL = 86400 # seconds inbound texts are remembered by SID to deduplicate webhook retries
+INBOUND_SMS_ASYNC = False # if True, inbound texts are acknowledged at once and replied to by a Celery worker
 DOCTOR_INITIATED_WELCOME_SEND_TIME = datetime.time(hour=10) # The time when a patient gets their welcome message
 															# the day following the doctor's appointment
 
@@ -216,8 +237,25 @@ TWILIO_NUMBER =  "+14153602341"
 # TWILIO_NUMBER =  "+14154297277"
 
 TWILIO_MAX_SMS_LEN = 160
+# If True, workers refuse to start with message templates longer than TWILIO_MAX_SMS_LEN.
+# Off while some replies still run past one text and are cut short by sendTextMessageToNumber
+MESSAGE_TEMPLATES_REJECT_OVERSIZE = False
+SMS_MAX_SEGMENTS = 10 # segments of a concatenated text; Twilio accepts bodies of up to 1600 characters
+
+# Outbound SMS pipeline (common.sms_transport.SMSTransport)
+SMS_TRANSPORT_ASYNC = False # if True, texts are queued and sent by a pool of background workers
+SMS_TRANSPORT_WORKERS = 4
+SMS_TRANSPORT_GLOBAL_RATE = 30 # segments per second across all workers
+SMS_TRANSPORT_PER_NUMBER_INTERVAL = 1 # seconds between texts to the same number
+SMS_TRANSPORT_MAX_RETRIES = 3
+SMS_TRANSPORT_RETRY_BACKOFF = 1 # seconds before the first retry; doubles after every failed attempt
 
 MESSAGE_LOG_FILENAME="message_output"
+MESSAGE_LOG_BUFFER_LINES = 1 if TEST else 100 # tests read the log straight after truncating it, so never buffer there
+MESSAGE_LOG_FLUSH_INTERVAL = 5 # seconds
+MESSAGE_LOG_MAX_BYTES = 10 * 1024 * 1024 # rotate the log once it grows past this size
+MESSAGE_LOG_ROTATE_DAILY = not TEST # also rotate at the first write of every day
+MESSAGE_LOG_BACKUP_COUNT = 7
 
 # Celery settings
 # To get celery to work, you will need to install a Rabbitmq server: see http://docs.celeryproject.org/en/latest/getting-started/brokers/rabbitmq.html#installing-rabbitmq-on-os-x
@@ -239,10 +277,26 @@ CELERYBEAT_SCHEDULE = {
         'task' : 'reminders.tasks.sendRemindersForNow',
         'schedule': crontab(minute='*/1'),
     },
+    'rollup-timed-out-doses': {
+        'task' : 'reminders.tasks.rollup_timed_out_doses',
+        'schedule': crontab(minute='*/15'),
+    },
     'schedule-safety-net': {
 	    'task' : 'reminders.tasks.schedule_safety_net_messages',
         'schedule': crontab(minute=0, hour=10, day_of_week=1) # Schedule safety net messages weekly at 10am on Monday
     },
+    'process-pending-inbound-messages': {
+        'task' : 'reminders.tasks.process_pending_inbound_messages',
+        'schedule': crontab(minute='*/1'),
+    },
+    'delete-expired-inbound-messages': {
+        'task' : 'reminders.tasks.delete_expired_inbound_messages',
+        'schedule' : crontab(minute=30)
+    },
+    'train-send-time-offsets': {
+        'task' : 'reminders.tasks.train_send_time_offsets',
+        'schedule' : crontab(minute=0, hour=3)
+    },
     'delete_expired_regprofiles': {
         'task' : 'common.registration_services.delete_expired_regprofiles',
         'schedule' : crontab(minute='*/5')
@@ -1,10 +1,13 @@
 import datetime
 
+import pytz
+from django.core.cache import cache
 from django.db import models
 from django.template.loader import render_to_string
 from django.core.exceptions import ValidationError
 
-from common.utilities import InterpersonalRelationship, convert_to_e164
+from configs.dev.settings import PATIENT_PHONE_NUMBER_CACHE_TIMEOUT, TIME_ZONE
+from common.utilities import InterpersonalRelationship, convert_to_e164, convert_timezone, server_timezone
 from common.models import UserProfile, UserProfileManager
 
 
@@ -32,7 +35,53 @@ class SafetyNetRelationship(models.Model):
 
 class PatientManager(UserProfileManager):
 	"""Manager for performing operations on PatientProfile records"""
-	pass
+	@staticmethod
+	def _phone_number_cache_key(phone_number):
+		return 'patients.patient_id_by_phone_number.%s' % phone_number
+
+	@staticmethod
+	def _cached_phone_number_cache_key(patient_id):
+		return 'patients.cached_phone_number.%s' % patient_id
+
+	def get_by_phone_number(self, phone_number):
+		"""
+		Returns the patient whose primary phone number is phone_number, or None.
+		Only the patient's id is cached by phone number, for PATIENT_PHONE_NUMBER_CACHE_TIMEOUT
+		seconds or until they're saved or deleted (see invalidate_phone_number_cache). The
+		row itself is always read from the DB, so a patient paused or quit by another
+		process is never stale, and an id whose patient no longer has that number is dropped.
+		"""
+		if not phone_number:
+			return None
+		key = self._phone_number_cache_key(phone_number)
+		patient_id = cache.get(key)
+		if patient_id is not None:
+			try:
+				patient = self.get(pk=patient_id)
+				if patient.primary_phone_number == phone_number:
+					return patient
+			except self.model.DoesNotExist:
+				pass
+			cache.delete(key)
+		try:
+			patient = self.get(primary_phone_number=phone_number)
+		except self.model.DoesNotExist:
+			return None
+		cache.set_many({key: patient.pk, self._cached_phone_number_cache_key(patient.pk): phone_number},
+		               PATIENT_PHONE_NUMBER_CACHE_TIMEOUT)
+		return patient
+
+	def invalidate_phone_number_cache(self, patient):
+		"""
+		Drops patient from the phone number cache, both under its current phone number
+		and under the one it was cached with, in case the number changed
+		"""
+		cached_phone_number_key = self._cached_phone_number_cache_key(patient.pk)
+		keys = [cached_phone_number_key]
+		for phone_number in (patient.primary_phone_number, cache.get(cached_phone_number_key)):
+			if phone_number:
+				keys.append(self._phone_number_cache_key(phone_number))
+		cache.delete_many(keys)
 
 
 class PatientProfile(UserProfile):
@@ -102,6 +151,14 @@ class PatientProfile(UserProfile):
 	QUIT_RESPONSE_WINDOW    = 60 #minutes
 	quit_request_datetime   = models.DateTimeField(blank=True, null=True)
 
+	# The pytz zone the patient's reminder times are in, e.g. 'America/New_York'. Send times
+	# are stored in the server's zone; recurrences are computed on the patient's wall clock.
+	timezone                = models.CharField(max_length=64, default=TIME_ZONE)
+
+	# Minutes to delay medication reminders by at each local hour, as 24 comma separated
+	# values, or blank to send them on time. Learned nightly by SendTimeLearner.
+	send_time_offsets       = models.CommaSeparatedIntegerField(max_length=200, blank=True, default='')
+
 	# Manager fields
 	objects = PatientManager()
 
@@ -126,6 +183,29 @@ class PatientProfile(UserProfile):
 		if not valid:
 			raise ValidationError('Must provide either a primary phone number or primary contact')
 
+		if self.timezone not in pytz.all_timezones_set:
+			raise ValidationError('Unknown time zone %s' % self.timezone)
+
+	def get_timezone(self):
+		return pytz.timezone(self.timezone)
+
+	def to_local_datetime(self, dt, is_dst=True):
+		"""
+		Returns naive server datetime <dt> as the patient's naive local datetime. If a DST
+		change repeats <dt> on the server's clock, is_dst=False picks its second instant.
+		"""
+		return convert_timezone(dt, server_timezone(), self.get_timezone(), is_dst)
+
+	def from_local_datetime(self, dt):
+		"""Returns the patient's naive local datetime <dt> as a naive server datetime"""
+		return convert_timezone(dt, self.get_timezone(), server_timezone())
+
+	def get_send_time_offset(self, hour):
+		"""Returns the minutes to delay medication reminders at local hour <hour> by"""
+		if not self.send_time_offsets:
+			return 0
+		return int(self.send_time_offsets.split(',')[hour])
+
 	def quit(self):
 		self.status = PatientProfile.QUIT
 		self.record_quit_request()
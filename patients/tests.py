@@ -1,5 +1,7 @@
-from datetime import date
+from datetime import date, datetime
+import mock
 
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
 from django.test import TestCase
 
@@ -29,6 +31,15 @@ class PatientTest(TestCase):
 		self.assertEqual(minqi.safety_net_contacts.all()[0], matt)
 		self.assertEqual(matt.source_patient_safety_nets.all()[0].source_patient, minqi)
 
+	def test_timezone(self):
+		patient = PatientProfile.objects.create(first_name="Minqi", last_name="Jiang",
+		                                        primary_phone_number="8569067308", timezone='America/New_York')
+		# The server is on Los Angeles time
+		self.assertEqual(patient.to_local_datetime(datetime(2014, 7, 1, 8, 0)), datetime(2014, 7, 1, 11, 0))
+		self.assertEqual(patient.from_local_datetime(datetime(2014, 7, 1, 8, 0)), datetime(2014, 7, 1, 5, 0))
+		self.assertRaises(ValidationError, PatientProfile, primary_phone_number="2147094720",
+		                  timezone='Mars/Olympus_Mons')
+
 
 class LookupBackwardsRelationshipTest(TestCase):
 	def setUp(self):
@@ -72,3 +83,48 @@ class LookupBackwardsRelationshipTest(TestCase):
 			InterpersonalRelationship.MOTHER, self.gender_neutral_patient), InterpersonalRelationship.CHILD)
 		self.assertEqual(InterpersonalRelationship.lookup_backwards_relationship(
 			InterpersonalRelationship.SON, self.gender_neutral_patient), InterpersonalRelationship.PARENT)
+
+
+@mock.patch('patients.models.PATIENT_PHONE_NUMBER_CACHE_TIMEOUT', 300)
+class PatientPhoneNumberCacheTest(TestCase):
+	def setUp(self):
+		cache.clear()
+		self.minqi = PatientProfile.objects.create(first_name="Minqi", last_name="Jiang",
+		                                           primary_phone_number="+18569067308")
+
+	def tearDown(self):
+		cache.clear()
+
+	def test_get_by_phone_number_is_cached(self):
+		PatientProfile.objects.get_by_phone_number("+18569067308")
+		# Only the id is cached; the patient is read back by primary key
+		with self.assertNumQueries(1):
+			self.assertEqual(PatientProfile.objects.get_by_phone_number("+18569067308"), self.minqi)
+		self.assertEqual(cache.get(PatientProfile.objects._phone_number_cache_key("+18569067308")), self.minqi.pk)
+		self.assertIsNone(PatientProfile.objects.get_by_phone_number("+12147094720"))
+		self.assertIsNone(PatientProfile.objects.get_by_phone_number(None))
+
+	def test_save_invalidates_cache(self):
+		PatientProfile.objects.get_by_phone_number("+18569067308").pause()
+		self.assertEqual(PatientProfile.objects.get_by_phone_number("+18569067308").status, PatientProfile.QUIT)
+
+		self.minqi = PatientProfile.objects.get(pk=self.minqi.pk)
+		self.minqi.primary_phone_number = "+12147094720"
+		self.minqi.save()
+		self.assertIsNone(PatientProfile.objects.get_by_phone_number("+18569067308"))
+		self.assertEqual(PatientProfile.objects.get_by_phone_number("+12147094720"), self.minqi)
+
+	def test_changes_without_invalidation_are_seen(self):
+		# Another process's cache isn't invalidated by a save here
+		PatientProfile.objects.get_by_phone_number("+18569067308")
+		PatientProfile.objects.filter(pk=self.minqi.pk).update(status=PatientProfile.QUIT)
+		self.assertEqual(PatientProfile.objects.get_by_phone_number("+18569067308").status, PatientProfile.QUIT)
+
+		PatientProfile.objects.filter(pk=self.minqi.pk).update(primary_phone_number="+12147094720")
+		self.assertIsNone(PatientProfile.objects.get_by_phone_number("+18569067308"))
+		self.assertEqual(PatientProfile.objects.get_by_phone_number("+12147094720"), self.minqi)
+
+	def test_delete_invalidates_cache(self):
+		PatientProfile.objects.get_by_phone_number("+18569067308")
+		self.minqi.delete()
+		self.assertIsNone(PatientProfile.objects.get_by_phone_number("+18569067308"))
@@ -0,0 +1,27 @@
+import datetime
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from reminders.models import AdherenceRollup
+from reminders.safety_net_center import SafetyNetCenter
+
+
+class Command(BaseCommand):
+	help = "Rebuilds the adherence rollups from feedback. Run while no responses are being processed."
+	option_list = BaseCommand.option_list + (
+		make_option('--timeout-hours', type='float', dest='timeout_hours', default=None,
+		            help="Hours after which an unacknowledged dose counts as missed "
+		                 "(defaults to the safety net timeout)"),
+		make_option('--batch-size', type='int', dest='batch_size', default=1000,
+		            help="Number of rollups inserted per query"),
+	)
+
+	def handle(self, *args, **options):
+		if options['timeout_hours'] is None:
+			timeout = SafetyNetCenter().timeout
+		else:
+			timeout = datetime.timedelta(hours=options['timeout_hours'])
+		rollup_count = AdherenceRollup.objects.rebuild(
+			datetime.datetime.now() - timeout, batch_size=options['batch_size'])
+		self.stdout.write("Rebuilt %d adherence rollups" % rollup_count)
@@ -0,0 +1,85 @@
+import datetime, random, time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+
+from configs.dev.settings import REMINDER_MERGE_INTERVAL
+from patients.models import PatientProfile
+from reminders.models import Notification
+
+
+class _Rollback(Exception):
+	pass
+
+
+class Command(BaseCommand):
+	help = ("Benchmarks the reminder tick's due notification lookup (notifications_at_time_by_recipient) "
+	        "as the number of patients grows: adds patients in steps up to each of --patients, each with "
+	        "--future notifications past the look-ahead window and some with a notification due, and reports "
+	        "the lookup's query count, time and query plan at each step. Everything runs in a transaction "
+	        "that is rolled back.")
+	option_list = BaseCommand.option_list + (
+		make_option('--patients', dest='patients', default='1000,10000,100000',
+		            help="Comma separated numbers of patients to benchmark at"),
+		make_option('--future', type='int', dest='future', default=10,
+		            help="Number of future notifications per patient, past the look-ahead window"),
+		make_option('--due-fraction', type='float', dest='due_fraction', default=0.1,
+		            help="Fraction of patients with a notification due at the tick, "
+		                 "plus another inside their look-ahead window"),
+		make_option('--ticks', type='int', dest='ticks', default=5,
+		            help="Number of lookups timed at each step"),
+		make_option('--seed', type='int', dest='seed', default=0),
+	)
+
+	BATCH_SIZE = 10000
+
+	def handle(self, *args, **options):
+		try:
+			with transaction.atomic():
+				self._benchmark(options)
+				raise _Rollback()
+		except _Rollback:
+			pass
+
+	def _create_notifications(self, rng, now, patients, options):
+		notifications = []
+		for patient in patients:
+			offsets_sec = [rng.randint(2 * REMINDER_MERGE_INTERVAL, 30 * 86400) for i in range(options['future'])]
+			if rng.random() < options['due_fraction']:
+				offsets_sec += [rng.randint(-60, 0), rng.randint(1, REMINDER_MERGE_INTERVAL - 1)]
+			notifications.extend(
+				Notification(to=patient, _type=Notification.STATIC_ONE_OFF, content="Benchmark",
+				             repeat=Notification.DAILY, send_datetime=now + datetime.timedelta(seconds=offset_sec))
+				for offset_sec in offsets_sec)
+		Notification.objects.bulk_create(notifications, batch_size=self.BATCH_SIZE)
+
+	def _benchmark(self, options):
+		rng = random.Random(options['seed'])
+		now = datetime.datetime.now()
+		cursor = connection.cursor()
+		patient_count = 0
+		for target_patient_count in sorted(int(count) for count in options['patients'].split(',')):
+			# PatientProfile inherits from UserProfile, so patients can't be bulk created
+			patients = [PatientProfile.objects.create(first_name="Benchmark", last_name="Patient %d" % i,
+			                                          primary_phone_number="+1555%07d" % i)
+			            for i in range(patient_count, target_patient_count)]
+			self._create_notifications(rng, now, patients, options)
+			patient_count = max(patient_count, target_patient_count)
+			cursor.execute("ANALYZE %s" % connection.ops.quote_name(Notification._meta.db_table))
+
+			elapsed_sec = []
+			for tick in range(options['ticks']):
+				with CaptureQueriesContext(connection) as queries:
+					start_time = time.time()
+					recipient_groups = Notification.objects.notifications_at_time_by_recipient(now)
+					elapsed_sec.append(time.time() - start_time)
+			sql, params = Notification.objects.notifications_at_time(now).query.sql_with_params()
+			cursor.execute("EXPLAIN " + sql, params)
+			plan = [row[0].strip() for row in cursor.fetchall()]
+			self.stdout.write("%d patients: %.1fms per tick, %d queries, %d recipients with %d notifications" % (
+				patient_count, min(elapsed_sec) * 1000, len(queries), len(recipient_groups),
+				sum(len(notifications) for (recipient, notifications) in recipient_groups)))
+			for line in plan:
+				self.stdout.write("    " + line)
@@ -0,0 +1,47 @@
+import datetime, random, timeit
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from reminders.models import Notification
+from reminders.notification_center import NotificationCenter
+
+
+class Command(BaseCommand):
+	help = "Micro-benchmarks NotificationCenter.merge_notifications over in-memory recipients' notifications."
+	option_list = BaseCommand.option_list + (
+		make_option('--recipients', type='int', dest='recipients', default=1000,
+		            help="Number of recipients to chunk notifications for"),
+		make_option('--notifications', type='int', dest='notifications', default=6,
+		            help="Number of notifications per recipient"),
+		make_option('--iterations', type='int', dest='iterations', default=10,
+		            help="Number of passes over the recipients"),
+		make_option('--seed', type='int', dest='seed', default=0),
+	)
+
+	def handle(self, *args, **options):
+		rng = random.Random(options['seed'])
+		nc = NotificationCenter()
+		now = datetime.datetime.now()
+		recipients = []
+		for i in range(options['recipients']):
+			# Notifications are built with ids so nothing touches the DB
+			recipients.append(sorted([
+				Notification(id=i * options['notifications'] + j, _type=Notification.STATIC_ONE_OFF, content="",
+				             repeat=Notification.NO_REPEAT,
+				             send_datetime=now + datetime.timedelta(seconds=rng.randint(0, 3 * nc.interval_sec)))
+				for j in range(options['notifications'])], key=lambda n: n.send_datetime))
+		shuffled_recipients = [rng.sample(notifications, len(notifications)) for notifications in recipients]
+
+		def merge(recipient_notifications):
+			def run():
+				for notifications in recipient_notifications:
+					for notification_group in nc.merge_notifications(notifications):
+						pass
+			return run
+
+		for (name, run) in [('Sorted', merge(recipients)), ('Shuffled', merge(shuffled_recipients))]:
+			elapsed_sec = timeit.timeit(run, number=options['iterations'])
+			recipient_count = options['iterations'] * len(recipients)
+			self.stdout.write("%s: %.2fus per recipient over %d recipients of %d notifications" % (
+				name, elapsed_sec * 1e6 / recipient_count, recipient_count, options['notifications']))
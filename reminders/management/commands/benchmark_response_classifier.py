@@ -0,0 +1,39 @@
+import timeit
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from reminders.response_classifier import ResponseClassifier
+
+
+class Command(BaseCommand):
+	help = "Micro-benchmarks ResponseClassifier over a corpus of typical inbound replies."
+	option_list = BaseCommand.option_list + (
+		make_option('--iterations', type='int', dest='iterations', default=1000,
+		            help="Number of passes over the corpus"),
+	)
+
+	CORPUS = [
+		'y', 'Y', 'yes', 'Yes ', 'YES', 'n', 'N', 'no', 'No', 'm', 'info', 'q', 'quit', 'p', 'pause', 'r', 'resume',
+		'a', 'B', 'c', 'd', 'E', 'f', 'g',
+		'9am', '10am', '10:27am', '1027am', '10 pm', '7', '12pm', '13pm', '10:2am',
+		'ok', 'thanks!', 'Took it', 'who is this?', 'I forgot, will take it tonight', 'stop',
+	]
+
+	def handle(self, *args, **options):
+		iterations = options['iterations']
+		classifier = ResponseClassifier()
+
+		def classify_cold():
+			for response in self.CORPUS:
+				classifier.classified_responses.clear()
+				classifier.classify(response)
+
+		def classify_warm():
+			for response in self.CORPUS:
+				classifier.classify(response)
+
+		for (name, run) in [('Unmemoized', classify_cold), ('Memoized', classify_warm)]:
+			elapsed_sec = timeit.timeit(run, number=iterations)
+			self.stdout.write("%s: %.2fus per reply over %d replies" % (
+				name, elapsed_sec * 1e6 / (iterations * len(self.CORPUS)), iterations * len(self.CORPUS)))
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from reminders.models import AdherenceRollup
+
+
+class Command(BaseCommand):
+	help = ("Checks the adherence rollups against feedback and lists every rollup that disagrees. "
+	        "Inconsistent rollups can be repaired with backfill_adherence_rollups.")
+
+	def handle(self, *args, **options):
+		inconsistencies = AdherenceRollup.objects.find_inconsistencies()
+		for (patient_id, prescription_id, date, expected, actual) in inconsistencies:
+			self.stdout.write("patient %s, prescription %s, %s: expected %s doses (%s acked), found %s (%s acked)" % (
+				patient_id, prescription_id, date, expected[0], expected[1], actual[0], actual[1]))
+		if inconsistencies:
+			raise CommandError("%d inconsistent adherence rollups" % len(inconsistencies))
+		self.stdout.write("Adherence rollups are consistent")
@@ -0,0 +1,89 @@
+import datetime, random, time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import connection, reset_queries, transaction
+from django.test.client import RequestFactory
+
+from common.models import Drug
+from doctors.models import DoctorProfile
+from patients.models import PatientProfile
+from reminders.models import Prescription, Notification, Message, Feedback
+from reminders.views import handle_text
+
+
+class _Rollback(Exception):
+	pass
+
+
+class Command(BaseCommand):
+	help = ("Benchmarks the inbound text webhook: sends a medication reminder to a set of throwaway patients, "
+	        "replays a storm of replies through handle_text and reports latency percentiles and queries per "
+	        "reply. Everything runs in a transaction that is rolled back.")
+	option_list = BaseCommand.option_list + (
+		make_option('--replies', type='int', dest='replies', default=10000,
+		            help="Number of inbound replies to replay"),
+		make_option('--patients', type='int', dest='patients', default=1000,
+		            help="Number of patients the replies are spread over"),
+		make_option('--seed', type='int', dest='seed', default=0,
+		            help="Seed for choosing reply bodies"),
+	)
+
+	# Replies as they arrive after a reminder wave, including retried and unrecognized ones
+	REPLY_BODIES = ['y', 'y', 'yes', 'n', 'a', 'ok']
+
+	def handle(self, *args, **options):
+		try:
+			with transaction.atomic():
+				latencies, query_counts = self._replay(options['replies'], options['patients'], options['seed'])
+				raise _Rollback()
+		except _Rollback:
+			pass
+
+		latencies.sort()
+		def percentile(p):
+			return latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1000
+		self.stdout.write("Replayed %d replies from %d patients" % (len(latencies), options['patients']))
+		self.stdout.write("Latency: p50 %.1fms, p99 %.1fms, max %.1fms" % (
+			percentile(0.50), percentile(0.99), latencies[-1] * 1000))
+		self.stdout.write("Queries per reply: mean %.1f, max %d" % (
+			float(sum(query_counts)) / len(query_counts), max(query_counts)))
+
+	def _replay(self, reply_count, patient_count, seed):
+		doctor = DoctorProfile.objects.create(first_name="Replay", last_name="Doctor",
+		                                      primary_phone_number="+15550100000", birthday=datetime.date(1960, 1, 1))
+		drug = Drug.objects.create(name='replay')
+		now = datetime.datetime.now()
+		patients = []
+		for i in range(patient_count):
+			patient = PatientProfile.objects.create(first_name="Replay", last_name="Patient %d" % i,
+			                                        primary_phone_number="+1555%07d" % i)
+			prescription = Prescription.objects.create(prescriber=doctor, patient=patient, drug=drug, filled=True)
+			notification = Notification.objects.create(to=patient, _type=Notification.MEDICATION,
+			                                           prescription=prescription, repeat=Notification.DAILY,
+			                                           send_datetime=now)
+			message = Message.objects.create(to=patient, _type=Message.MEDICATION, content="Time to take your meds")
+			message.notifications.add(notification)
+			message.feedbacks.add(Feedback.objects.create(_type=Feedback.MEDICATION, notification=notification,
+			                                              prescription=prescription))
+			patients.append(patient)
+
+		request_factory = RequestFactory()
+		reply_random = random.Random(seed)
+		latencies = []
+		query_counts = []
+		use_debug_cursor = connection.use_debug_cursor
+		connection.use_debug_cursor = True
+		try:
+			for i in range(reply_count):
+				request = request_factory.get('/textmessage_response/', {
+					'From': patients[i % patient_count].primary_phone_number,
+					'Body': reply_random.choice(self.REPLY_BODIES)})
+				reset_queries()
+				start_time = time.time()
+				handle_text(request)
+				latencies.append(time.time() - start_time)
+				query_counts.append(len(connection.queries))
+		finally:
+			connection.use_debug_cursor = use_debug_cursor
+		return latencies, query_counts
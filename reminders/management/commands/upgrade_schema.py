@@ -0,0 +1,113 @@
+from optparse import make_option
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.core.management.color import no_style
+from django.core.management.sql import custom_sql_for_model
+from django.db import connection, transaction
+
+from patients.models import PatientProfile
+from reminders.models import Notification, Message, Feedback
+
+
+# Columns added to tables that syncdb doesn't alter once they exist, by model
+ADDED_COLUMNS = (
+	(PatientProfile, ['timezone', 'send_time_offsets']),
+	(Notification, ['send_datetime_is_dst', 'day_of_month', 'recurrence_rule']),
+	(Message, ['segment_count']),
+	(Feedback, ['rolled_up']),
+)
+# varchar columns widened since their tables were created
+WIDENED_COLUMNS = (
+	(Message, 'content'),
+)
+# Models whose index_together or custom SQL indexes were added after their tables were created
+INDEXED_MODELS = (Notification, Message)
+
+
+class Command(BaseCommand):
+	help = ("Brings a database created by an earlier syncdb up to the current models: runs syncdb for "
+	        "the new tables (MessageCounter, DispatchCursor, InboundMessage and AdherenceRollup), then adds "
+	        "the new columns and indexes to existing tables and widens Message.content. Statements already "
+	        "applied are skipped, so it's safe to run again. Run backfill_adherence_rollups afterwards, "
+	        "since existing feedback isn't counted in any rollup yet.")
+	option_list = BaseCommand.option_list + (
+		make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+		            help="Print the statements for existing tables instead of running them, and skip syncdb"),
+	)
+
+	def handle(self, *args, **options):
+		if not options['dry_run']:
+			call_command('syncdb', interactive=False, verbosity=options['verbosity'])
+		cursor = connection.cursor()
+		statements = (self._column_statements(cursor) + self._widening_statements(cursor) +
+		              self._index_statements(cursor))
+		if options['dry_run']:
+			for (sql, params) in statements:
+				self.stdout.write(cursor.mogrify(sql, params) + ";")
+			return
+		with transaction.atomic():
+			for (sql, params) in statements:
+				cursor.execute(sql, params)
+		self.stdout.write("Applied %d schema changes" % len(statements))
+
+	def _column_statements(self, cursor):
+		"""
+		Returns (sql, params) adding each of ADDED_COLUMNS missing from its table. Existing rows get the
+		field's default, which is then dropped again, since syncdb leaves defaults to Django.
+		"""
+		qn = connection.ops.quote_name
+		statements = []
+		for (model, field_names) in ADDED_COLUMNS:
+			table = model._meta.db_table
+			columns = set(column.name for column in connection.introspection.get_table_description(cursor, table))
+			for field_name in field_names:
+				field = model._meta.get_field(field_name)
+				if field.column in columns:
+					continue
+				add_column = "ALTER TABLE %s ADD COLUMN %s %s" % (
+					qn(table), qn(field.column), field.db_type(connection=connection))
+				if field.null:
+					statements.append((add_column, []))
+				else:
+					statements.append((add_column + " NOT NULL DEFAULT %s", [field.get_default()]))
+					statements.append(("ALTER TABLE %s ALTER COLUMN %s DROP DEFAULT" % (
+						qn(table), qn(field.column)), []))
+		return statements
+
+	def _widening_statements(self, cursor):
+		"""
+		Returns (sql, params) widening each of WIDENED_COLUMNS shorter than its field's max_length
+		"""
+		qn = connection.ops.quote_name
+		statements = []
+		for (model, field_name) in WIDENED_COLUMNS:
+			table = model._meta.db_table
+			field = model._meta.get_field(field_name)
+			cursor.execute(
+				"SELECT character_maximum_length FROM information_schema.columns "
+				"WHERE table_name = %s AND column_name = %s", [table, field.column])
+			if cursor.fetchone()[0] < field.max_length:
+				statements.append(("ALTER TABLE %s ALTER COLUMN %s TYPE %s" % (
+					qn(table), qn(field.column), field.db_type(connection=connection)), []))
+		return statements
+
+	def _index_statements(self, cursor):
+		"""
+		Returns (sql, params) creating each index of INDEXED_MODELS' index_together and custom SQL
+		that's missing, named as syncdb names them
+		"""
+		style = no_style()
+		statements = []
+		for model in INDEXED_MODELS:
+			cursor.execute("SELECT indexname FROM pg_indexes WHERE tablename = %s", [model._meta.db_table])
+			index_names = set(row[0] for row in cursor.fetchall())
+			create_index_statements = custom_sql_for_model(model, style, connection)
+			for field_names in model._meta.index_together:
+				fields = [model._meta.get_field(field_name) for field_name in field_names]
+				create_index_statements.extend(connection.creation.sql_indexes_for_fields(model, fields, style))
+			for sql in create_index_statements:
+				# CREATE INDEX <name> ON ...
+				if sql.startswith("CREATE INDEX") and sql.split()[2].strip('"') not in index_names:
+					statements.append((sql.rstrip(';'), []))
+		return statements
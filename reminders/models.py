@@ -1,12 +1,18 @@
-import datetime, calendar
+import datetime, calendar, uuid
 from itertools import groupby
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
+from django.http import HttpResponse
 
-from django.db import models
-from django.db.models import Q
+from django.db import models, connection, transaction, IntegrityError
+from django.db.models import F, Q
 
-from configs.dev.settings import REMINDER_MERGE_INTERVAL, DOCTOR_INITIATED_WELCOME_SEND_TIME
+from configs.dev.settings import REMINDER_MERGE_INTERVAL, DOCTOR_INITIATED_WELCOME_SEND_TIME, \
+	INBOUND_MESSAGE_LEDGER_TTL, SMS_MAX_SEGMENTS
 from common.models import UserProfile, Drug
+from common.sms_segments import count_segments
+from common.utilities import resolve_server_is_dst, to_server_datetime
+from reminders import recurrence
 from patients.models import PatientProfile
 
 class Prescription(models.Model):
@@ -33,34 +39,66 @@ class Prescription(models.Model):
 #==============NOTIFICATION RELATED CLASSES=======================
 
 class NotificationManager(models.Manager):
-	def notifications_at_time(self, now_datetime):
+	def notifications_at_time(self, now_datetime, now_is_dst=None):
 		"""
 		Returns all notifications at and before now_datetime
 		If there is at least one such notification, also looks ahead REMINDER_MERGE_INTERVAL
 		seconds to look for additional notifications
+		If now_is_dst, now_datetime is the first of two instants a DST change gives its server
+		wall-clock time, and notifications at the second instant of theirs aren't due yet
+		(see Notification.send_datetime_is_dst)
+
+		The look-ahead window of every recipient is computed in a single query with a
+		correlated subquery, so the cost doesn't grow with the number of recipients.
+		Recipients with a due notification are found first, so a tick reads only the due
+		rows and their recipients' rows through the partial indexes on active notifications
+		(see sql/notification.postgresql_psycopg2.sql), however many future rows there are.
+		Results are ordered by recipient, then by send_datetime.
 
 		Arguments:
 		now_datetime -- the datetime for which we care about notifications. datetime object
 		"""
-		notifications_at_time = super(NotificationManager, self).get_query_set().filter(
-			Q(active=True) &
-			Q(send_datetime__lte=now_datetime)
-		).order_by('to', 'send_datetime') # order by recipient's full name, then by send_time
-
-		all_notifications_at_time = Notification.objects.none()
-		if notifications_at_time.exists():
-			for recipient, recipient_group in groupby(notifications_at_time, lambda x: x.to):
-				latest_notification = None
-				for latest_notification in recipient_group: # get latest notification in group
-					pass
-				max_send_time_for_batch = latest_notification.send_datetime + datetime.timedelta(seconds=REMINDER_MERGE_INTERVAL)
-				notifications_at_time_for_user = super(NotificationManager, self).get_queryset().filter(
-					Q(to=recipient) &
-					Q(active=True) &
-					Q(send_datetime__lt=max_send_time_for_batch)
-				)
-				all_notifications_at_time = all_notifications_at_time | notifications_at_time_for_user
-		return all_notifications_at_time
+		table = connection.ops.quote_name(Notification._meta.db_table)
+		due_where = "due.active = %s AND due.send_datetime <= %s"
+		due_params = [True, now_datetime]
+		if now_is_dst:
+			due_where += " AND due.send_datetime_is_dst IS DISTINCT FROM %s"
+			due_params.append(False)
+		due_recipient_where = (
+			"%(table)s.to_id IN (SELECT due.to_id FROM %(table)s due WHERE %(due)s)" % {
+				'table': table, 'due': due_where})
+		look_ahead_where = (
+			"%(table)s.send_datetime < ("
+			"SELECT MAX(due.send_datetime) FROM %(table)s due WHERE due.to_id = %(table)s.to_id AND %(due)s"
+			") + %%s" % {'table': table, 'due': due_where})
+		return super(NotificationManager, self).get_queryset().filter(active=True).extra(
+			where=[due_recipient_where, look_ahead_where],
+			params=due_params + due_params + [datetime.timedelta(seconds=REMINDER_MERGE_INTERVAL)]
+		).order_by('to', 'send_datetime')
+
+	def notifications_at_time_by_recipient(self, now_datetime, patient=None, shard=0, shard_count=1,
+		now_is_dst=None):
+		"""
+		Returns a list of (recipient, [notifications]) tuples for all notifications
+		returned by notifications_at_time, grouped by recipient.
+
+		Arguments:
+		now_is_dst -- see notifications_at_time
+		patient -- if not None, only return notifications for this recipient
+		shard, shard_count -- only return recipients whose id falls in shard <shard>
+		                      when recipients are partitioned into <shard_count> shards
+		"""
+		notifications = self.notifications_at_time(now_datetime, now_is_dst)
+		if patient is not None:
+			notifications = notifications.filter(to=patient)
+		if shard_count > 1:
+			table = connection.ops.quote_name(Notification._meta.db_table)
+			notifications = notifications.extra(
+				where=["%s.to_id %%%% %%s = %%s" % table],
+				params=[shard_count, shard])
+		notifications = notifications.select_related(*Notification.DISPATCH_RELATED)
+		return [(recipient, list(recipient_group))
+		        for recipient, recipient_group in groupby(notifications, lambda x: x.to)]
 
 	def create_prescription_notifications(self, to, repeat, prescription):
 		"""STUB: Schedule both a refill notification and a medication notification for a prescription"""
@@ -98,6 +136,57 @@ class NotificationManager(models.Manager):
 
 		return (refill_notification, notification_times)
 
+	def advance_send_times(self, notifications, now=None):
+		"""
+		Advances every notification in <notifications> past <now> and writes them
+		back to the DB in a single UPDATE query. Load the notifications with their
+		recipients (select_related('to')), whose time zones the recurrences follow.
+		"""
+		if now is None:
+			now = datetime.datetime.now()
+		notifications = list(notifications)
+		for notification in notifications:
+			notification.update_to_next_send_time(save=False, now=now)
+		self.bulk_update_send_times(notifications)
+
+	def bulk_update_send_times(self, notifications):
+		"""
+		Writes send_datetime, send_datetime_is_dst, active, times_sent and day_of_month of every
+		notification in <notifications> back to the DB in a single UPDATE query
+		"""
+		notifications = list(notifications)
+		if not notifications:
+			return
+		params = []
+		for notification in notifications:
+			params.extend([notification.pk, notification.send_datetime, notification.send_datetime_is_dst,
+			               notification.active, notification.times_sent, notification.day_of_month])
+		cursor = connection.cursor()
+		# Nullable columns are cast, since a column of NULLs would otherwise be typed as text
+		cursor.execute(
+			"UPDATE %s AS n SET send_datetime = v.send_datetime, send_datetime_is_dst = v.send_datetime_is_dst, "
+			"active = v.active, times_sent = v.times_sent, day_of_month = v.day_of_month "
+			"FROM (VALUES %s) AS v(id, send_datetime, send_datetime_is_dst, active, times_sent, day_of_month) "
+			"WHERE n.id = v.id" % (
+				connection.ops.quote_name(Notification._meta.db_table),
+				", ".join(["(%s, %s, %s::boolean, %s, %s, %s::integer)"] * len(notifications))),
+			params)
+
+	def change_timezone(self, patient, timezone):
+		"""
+		Moves <patient> to pytz zone name <timezone>, keeping each of their active notifications
+		at the same time on their new wall clock. Saves the patient.
+		"""
+		notifications = list(self.filter(to=patient, active=True))
+		for notification in notifications:
+			notification.to = patient
+		local_send_datetimes = [n.get_local_send_datetime() for n in notifications]
+		patient.timezone = timezone
+		for (notification, local_send_datetime) in zip(notifications, local_send_datetimes):
+			notification.set_local_send_datetime(local_send_datetime)
+		self.bulk_update_send_times(notifications)
+		patient.save()
+
 	def create_consumer_welcome_notification(self, to):
 		welcome_reminder = Notification.objects.get_or_create(to=to,
 			_type=Notification.WELCOME, repeat=Notification.NO_REPEAT)[0]
@@ -130,6 +219,9 @@ class Notification(models.Model):
 		(STATIC_ONE_OFF,        'static_one_off')
 	)
 
+	# Everything NotificationCenter.send_notifications reads through a notification
+	DISPATCH_RELATED = ('to__primary_contact', 'prescription__drug', 'patient_of_safety_net', 'message')
+
 	@classmethod
 	def is_valid_type(cls, type):
 		for choice in cls.NOTIFICATION_TYPE_CHOICES:
@@ -158,8 +250,14 @@ class Notification(models.Model):
 	repeat 				   = models.CharField(max_length=2,
 	                                         choices=REPEAT_CHOICES, null=False, blank=False)
 	send_datetime		   = models.DateTimeField(null=False, blank=False)
+	# send_datetime is naive on the server's clock. When a DST change repeats it, whether the
+	# first (daylight saving) instant is meant; None when it occurs once.
+	send_datetime_is_dst   = models.NullBooleanField()
 	active				   = models.BooleanField(default=True) # is the notification still alive?
 	day_of_week            = models.PositiveSmallIntegerField(null=True, blank=True)
+	# The day of the month MONTHLY and YEARLY notifications recur on, in the recipient's zone.
+	# send_datetime is clamped in shorter months, so it can't stand in for this.
+	day_of_month           = models.PositiveSmallIntegerField(null=True, blank=True)
 	times_sent             = models.PositiveIntegerField(default=0)
 
 # ************ ENCRYPTION START ************ 
@@ -180,6 +278,9 @@ class Notification(models.Model):
 	# Required for REPEAT_MESSAGE
 	message                = models.ForeignKey('Message', null=True, blank=True, related_name="repeat_message")
 
+	# Required for CUSTOM repeat; a recurrence.RecurrenceRule, e.g. "FREQ=WEEKLY;BYDAY=MO,WE,FR;BYHOUR=8,20"
+	recurrence_rule        = models.CharField(max_length=200, null=True, blank=True)
+
 	objects 			   = NotificationManager()
 
 	class Meta:
@@ -224,12 +325,40 @@ class Notification(models.Model):
 		if self.repeat == "":
 			raise ValidationError("All notifications require a repeat value")
 
+		if self.repeat == self.CUSTOM:
+			if not self.recurrence_rule:
+				raise ValidationError("Custom notifications require a recurrence rule")
+			try:
+				recurrence_rule = self.get_recurrence_rule()
+			except ValueError as e:
+				raise ValidationError(str(e))
+			# Start at the rule's first occurrence at or after send_datetime, on the recipient's clock
+			local_send_datetime = self.get_local_send_datetime()
+			occurrences = recurrence_rule.occurrences(
+				local_send_datetime, local_send_datetime - datetime.timedelta(microseconds=1))
+			if not occurrences:
+				raise ValidationError("Recurrence rule %s has no occurrences after %s" % (
+					self.recurrence_rule, self.send_datetime))
+			self.set_local_send_datetime(occurrences[0])
+
 		if self.repeat == self.WEEKLY:
-			self.day_of_week = self.send_datetime.isoweekday()
+			self.day_of_week = self.get_local_send_datetime().isoweekday()
+
+		if self.repeat in (self.MONTHLY, self.YEARLY):
+			self.day_of_month = self.get_local_send_datetime().day
 
 
 	# update send_time to next send_time based on notification period
-	def update_to_next_send_time(self):
+	# If save is False, the caller is responsible for writing the notification back,
+	# e.g. with NotificationManager.bulk_update_send_times
+	def update_to_next_send_time(self, save=True, now=None):
+		"""
+		Advances send_datetime to the first occurrence after <now> in a single step,
+		however long the notification has been dormant. Occurrences are computed on the
+		recipient's wall clock, so a daily 8am reminder stays at 8am across DST changes.
+		"""
+		if now is None:
+			now = datetime.datetime.now()
 		update_periodic_send_time = {
 			self.NO_REPEAT: self.__update_one_shot_send_time,
 			self.DAILY:    self.__update_daily_send_time,
@@ -239,11 +368,31 @@ class Notification(models.Model):
 			self.CUSTOM:   self.__update_custom_send_time,
 		}
 		self.times_sent += 1
-		update_periodic_send_time[self.repeat]()
+		self.send_datetime = self.get_local_send_datetime()
+		update_periodic_send_time[self.repeat](self.to.to_local_datetime(now, resolve_server_is_dst(now)))
+		self.set_local_send_datetime(self.send_datetime)
+		if save:
+			self.save()
+
+	def get_local_send_datetime(self):
+		"""Returns send_datetime as the recipient's naive local datetime"""
+		return self.to.to_local_datetime(self.send_datetime, self.send_datetime_is_dst)
+
+	def set_local_send_datetime(self, local_send_datetime):
+		"""Sets send_datetime from the recipient's naive local datetime <local_send_datetime>"""
+		(self.send_datetime, self.send_datetime_is_dst) = to_server_datetime(
+			local_send_datetime, self.to.get_timezone())
 
-	# return the optimal time to send notification
 	def get_best_send_time(self):
-		pass
+		"""
+		Returns when the notification is best sent: medication reminders are delayed by the
+		offset the recipient's send time model gives their local hour (see SendTimeLearner),
+		other notifications are sent on time. Needs no query once the recipient is loaded.
+		"""
+		if self._type != self.MEDICATION:
+			return self.send_datetime
+		offset = self.to.get_send_time_offset(self.get_local_send_datetime().hour)
+		return self.send_datetime + datetime.timedelta(minutes=offset)
 
 	# return and set the optimal time to send notification
 	def set_best_send_time(self):
@@ -252,67 +401,46 @@ class Notification(models.Model):
 			self.send_datetime = datetime.datetime.now()
 		pass
 
-	def __update_one_shot_send_time(self):
-		if self.repeat == self.NO_REPEAT:
-			self.active = False
-			self.save()
+	def __update_one_shot_send_time(self, now):
+		self.active = False
 
-	def __update_daily_send_time(self):
-		if self.repeat == self.DAILY:
-			now = datetime.datetime.now()
-			dt = datetime.timedelta(days=1)
-			self.send_datetime += dt
-			while self.send_datetime <= now:
-				self.send_datetime += dt
-			self.save()
+	def __update_daily_send_time(self, now):
+		self.send_datetime = recurrence.next_by_period(self.send_datetime, now, datetime.timedelta(days=1))
 
-	def __update_weekly_send_time(self):
-		if self.repeat == self.WEEKLY:
-			now = datetime.datetime.now()
-			dt = datetime.timedelta(days=7)
-			self.send_datetime += dt
-			while self.send_datetime <= now:
-				self.send_datetime += dt
-			self.save()
+	def __update_weekly_send_time(self, now):
+		self.send_datetime = recurrence.next_by_period(self.send_datetime, now, datetime.timedelta(days=7))
 
-	def __update_monthly_send_time(self):
-		if self.repeat == self.MONTHLY:
-			now_date = datetime.datetime.now().date()
-			next_date = self.send_datetime.date()
-			year = next_date.year
-			month = next_date.month
-			next_month = next_date.month % 12 + 1
-			next_year = next_date.year + next_month / 12
-			next_day = min(next_date.day,calendar.monthrange(next_year,next_month)[1])
-			next_date = datetime.date(next_year, next_month, next_day)
-
-			while next_date <= now_date:
-				next_month = next_date.month % 12 + 1
-				next_year = next_date.year + next_month / 12
-				next_day = min(next_date.day,calendar.monthrange(next_year,next_month)[1])
-				next_date = datetime.date(next_year, next_month, next_day)
-
-			self.send_datetime = datetime.datetime.combine(next_date, self.send_datetime.time())
-			self.save()
+	def __update_monthly_send_time(self, now):
+		if self.day_of_month is None:
+			self.day_of_month = self.send_datetime.day
+		self.send_datetime = recurrence.next_by_months(self.send_datetime, now, 1, self.day_of_month)
 
-	def __update_yearly_send_time(self):
-		if self.repeat == self.YEARLY:
-			now_year = datetime.datetime.now().date().year
-			date = self.send_datetime.date()
-			year  = date.year
-			month = date.month
-			day = date.day
-			year += 1
-			while year <= now_year:
-				year += 1
-
-			next_date = datetime.date(year, month, day)
-			self.send_datetime = datetime.datetime.combine(next_date, self.send_datetime.time())
-			self.save()
+	def __update_yearly_send_time(self, now):
+		if self.day_of_month is None:
+			self.day_of_month = self.send_datetime.day
+		self.send_datetime = recurrence.next_by_years(self.send_datetime, now, self.day_of_month)
 
-	def __update_custom_send_time(self):
-		if self._type == self.CUSTOM:
-			pass
+	def __update_custom_send_time(self, now):
+		occurrences = self.get_recurrence_rule().occurrences(self.send_datetime, max(now, self.send_datetime))
+		if occurrences:
+			self.send_datetime = occurrences[0]
+		else:
+			self.active = False
+
+	def get_recurrence_rule(self):
+		return recurrence.RecurrenceRule.parse(self.recurrence_rule)
+
+	def get_upcoming_send_datetimes(self, count, now=None):
+		"""
+		Returns the next <count> send datetimes of a CUSTOM notification after <now>,
+		starting with send_datetime if it is still ahead
+		"""
+		if now is None:
+			now = datetime.datetime.now()
+		local_send_datetime = self.get_local_send_datetime()
+		after = max(self.to.to_local_datetime(now), local_send_datetime - datetime.timedelta(microseconds=1))
+		return [self.to.from_local_datetime(occurrence)
+		        for occurrence in self.get_recurrence_rule().occurrences(local_send_datetime, after, count)]
 
 
 #==============MESSAGE RELATED CLASSES=======================
@@ -327,29 +455,43 @@ class MessageManager(models.Manager):
 		else:
 			return super(MessageManager, self).create(**kwargs)
 
-		today = datetime.datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
-		todays_messages = self.filter(datetime_sent__gte=today, _type=_type)
-		if todays_messages:
-			nth_message_of_day_of_type = todays_messages.first().nth_message_of_day_of_type + 1
-		else:
-			nth_message_of_day_of_type = 0
+		nth_message_of_day_of_type = self.reserve_nth_messages_of_day_of_type(_type)
 		return super(MessageManager, self).create(nth_message_of_day_of_type=nth_message_of_day_of_type, **kwargs)
 
+	def reserve_nth_messages_of_day_of_type(self, _type, count=1):
+		"""
+		Reserves the nth_message_of_day_of_type of the next <count> messages of type <_type>
+		sent today and returns the first. Concurrent workers never reserve the same values.
+		"""
+		return MessageCounter.objects.reserve(datetime.date.today(), _type, count)
+
+	def next_nth_message_of_day_of_type(self, _type):
+		"""
+		Returns the nth_message_of_day_of_type the next message of type <_type> sent today should have,
+		according to the messages sent so far. Only used to start each day's MessageCounter.
+		"""
+		today = datetime.datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+		last_message = self.filter(datetime_sent__gte=today, _type=_type).first()
+		if last_message:
+			return last_message.nth_message_of_day_of_type + 1
+		return 0
+
 	def get_last_sent_message_requiring_response(self, to):
+		"""
+		Returns the latest message sent to <to> today that still awaits a response, or None.
+		A single LIMIT 1 query served by the (to, datetime_sent, _type, datetime_responded) index
+		"""
 		today = datetime.datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
-		message = self.filter(to=to, datetime_sent__gte=today, _type__in=Message.REQUIRE_RESPONSE_MESSAGES,
-		                      datetime_responded=None)
-		if message:
-			message = message[0]
-		else:
-			message = None
-		return message
+		return self.filter(to=to, datetime_sent__gte=today, _type__in=Message.REQUIRE_RESPONSE_MESSAGES,
+		                   datetime_responded=None).first()
 
 
 class Message(models.Model):
 	"""Model for messages that have been sent to users"""
 	class Meta:
 		ordering = ['-datetime_sent']
+		# Serves get_last_sent_message_requiring_response for inbound texts
+		index_together = [['to', 'datetime_sent', '_type', 'datetime_responded']]
 
 	# All of the types of messages
 	MEDICATION 	                = 'm'
@@ -440,8 +582,10 @@ class Message(models.Model):
 	datetime_responded  = models.DateTimeField(blank=True, null=True)
 	datetime_sent       = models.DateTimeField(auto_now_add=True)
 # ************ ENCRYPTION START ************ 
-	content             = models.CharField(max_length=160)
+	content             = models.CharField(max_length=1600)
 # ************ ENCRYPTION END ************** 
+	# Segments content is sent as, as a concatenated text if more than one
+	segment_count       = models.PositiveSmallIntegerField(blank=True, null=True)
 
 	# Required for MEDICATION
 	nth_message_of_day_of_type = models.PositiveSmallIntegerField(blank=True, null=True)
@@ -462,6 +606,9 @@ class Message(models.Model):
 	def __init__(self, *args, **kwargs):
 		super(Message, self).__init__(*args, **kwargs)
 
+		if self.segment_count is None and self.content:
+			self.segment_count = min(count_segments(self.content), SMS_MAX_SEGMENTS)
+
 		if self._type in Message.RESPONSE_MESSAGES:
 			if self.previous_message is None:
 				raise ValidationError("A message sent as a response requires a pointer to a previous message")
@@ -501,6 +648,8 @@ class Feedback(models.Model):
 
 	datetime_sent      = models.DateTimeField(auto_now_add=True)
 	datetime_responded = models.DateTimeField(blank=True, null=True)
+	# True once the dose has been counted in its AdherenceRollup
+	rolled_up          = models.BooleanField(default=False)
 
 
 	notification       = models.ForeignKey(Notification)
@@ -508,3 +657,356 @@ class Feedback(models.Model):
 
 	class Meta:
 		get_latest_by = 'datetime_sent'
+
+
+class AdherenceRollupManager(models.Manager):
+	def _add_dose_counts(self, dose_counts):
+		"""
+		Adds dose_counts, a dict mapping (patient id, prescription id, date) to a
+		[dose_count, acked_dose_count] pair, to the matching rollups, creating them as needed
+		"""
+		for (patient_id, prescription_id, date), (dose_count, acked_dose_count) in dose_counts.iteritems():
+			rollups = self.filter(patient=patient_id, prescription=prescription_id, date=date)
+			increments = {'dose_count': F('dose_count') + dose_count,
+			              'acked_dose_count': F('acked_dose_count') + acked_dose_count,
+			              'last_updated': datetime.datetime.now()}
+			if rollups.update(**increments):
+				continue
+			try:
+				with transaction.atomic():
+					self.create(patient_id=patient_id, prescription_id=prescription_id, date=date,
+					            dose_count=dose_count, acked_dose_count=acked_dose_count)
+			except IntegrityError:
+				# Another process created the rollup first
+				rollups.update(**increments)
+
+	def record_acked_doses(self, feedback_ids, datetime_responded):
+		"""
+		Marks the feedback with ids <feedback_ids> completed and counts their medication
+		doses as acknowledged. A dose already counted as missed by record_timed_out_doses
+		is moved over to acknowledged.
+		"""
+		feedback_ids = list(feedback_ids)
+		if not feedback_ids:
+			return
+		with transaction.atomic():
+			feedbacks = list(Feedback.objects.select_for_update().filter(pk__in=feedback_ids).values_list(
+				'id', '_type', 'prescription', 'datetime_sent', 'completed', 'rolled_up'))
+			patient_ids = dict(Prescription.objects.filter(
+				pk__in=set(feedback[2] for feedback in feedbacks)).values_list('id', 'patient'))
+
+			dose_counts = {}
+			rolled_up_ids = []
+			for (feedback_id, _type, prescription_id, datetime_sent, completed, rolled_up) in feedbacks:
+				if _type != Feedback.MEDICATION or (completed and rolled_up):
+					continue
+				key = (patient_ids[prescription_id], prescription_id, datetime_sent.date())
+				counts = dose_counts.setdefault(key, [0, 0])
+				if not rolled_up:
+					counts[0] += 1
+					rolled_up_ids.append(feedback_id)
+				counts[1] += 1
+
+			Feedback.objects.filter(pk__in=feedback_ids).update(
+				completed=True, datetime_responded=datetime_responded)
+			if rolled_up_ids:
+				Feedback.objects.filter(pk__in=rolled_up_ids).update(rolled_up=True)
+			self._add_dose_counts(dose_counts)
+
+	def record_timed_out_doses(self, cutoff_datetime):
+		"""
+		Counts every medication dose not yet in the rollups that was either acknowledged
+		or sent at or before cutoff_datetime without being acknowledged (i.e. missed).
+		Acknowledged doses normally arrive through record_acked_doses; this also picks up
+		feedback completed some other way. Returns the number of doses counted.
+		"""
+		with transaction.atomic():
+			cursor = connection.cursor()
+			cursor.execute(
+				"UPDATE %s AS f SET rolled_up = %%s FROM %s AS p "
+				"WHERE p.id = f.prescription_id AND f._type = %%s AND f.rolled_up = %%s "
+				"AND (f.completed = %%s OR f.datetime_sent <= %%s) "
+				"RETURNING p.patient_id, f.prescription_id, f.datetime_sent, f.completed" % (
+					connection.ops.quote_name(Feedback._meta.db_table),
+					connection.ops.quote_name(Prescription._meta.db_table)),
+				[True, Feedback.MEDICATION, False, True, cutoff_datetime])
+			rows = cursor.fetchall()
+
+			dose_counts = {}
+			for (patient_id, prescription_id, datetime_sent, completed) in rows:
+				counts = dose_counts.setdefault((patient_id, prescription_id, datetime_sent.date()), [0, 0])
+				counts[0] += 1
+				if completed:
+					counts[1] += 1
+			self._add_dose_counts(dose_counts)
+		return len(rows)
+
+	def _compute_dose_counts_from_feedback(self):
+		"""
+		Returns the dose counts the rollups should hold according to the rolled up
+		feedback, keyed like _add_dose_counts
+		"""
+		feedbacks = Feedback.objects.filter(_type=Feedback.MEDICATION, rolled_up=True).values_list(
+			'prescription__patient', 'prescription', 'datetime_sent', 'completed').iterator()
+		dose_counts = {}
+		for (patient_id, prescription_id, datetime_sent, completed) in feedbacks:
+			counts = dose_counts.setdefault((patient_id, prescription_id, datetime_sent.date()), [0, 0])
+			counts[0] += 1
+			if completed:
+				counts[1] += 1
+		return dose_counts
+
+	def rebuild(self, cutoff_datetime, batch_size=1000):
+		"""
+		Recomputes every rollup from scratch from feedback, counting doses as
+		record_timed_out_doses(cutoff_datetime) would. Returns the number of rollups.
+		Meant to be run while no responses are being processed.
+		"""
+		with transaction.atomic():
+			Feedback.objects.filter(_type=Feedback.MEDICATION).update(rolled_up=False)
+			Feedback.objects.filter(_type=Feedback.MEDICATION).filter(
+				Q(completed=True) | Q(datetime_sent__lte=cutoff_datetime)).update(rolled_up=True)
+			self.all().delete()
+			rollups = [self.model(patient_id=patient_id, prescription_id=prescription_id, date=date,
+			                      dose_count=dose_count, acked_dose_count=acked_dose_count)
+			           for (patient_id, prescription_id, date), (dose_count, acked_dose_count)
+			           in self._compute_dose_counts_from_feedback().iteritems()]
+			self.bulk_create(rollups, batch_size=batch_size)
+		return len(rollups)
+
+	def for_patients_between(self, patients, start_date, end_date):
+		"""
+		Returns the rollups of <patients> for the days from start_date to end_date
+		"""
+		return self.filter(patient__in=patients, date__gte=start_date, date__lte=end_date)
+
+	def find_inconsistencies(self):
+		"""
+		Compares the rollups against the rolled up feedback. Returns a sorted list of
+		(patient id, prescription id, date, expected counts, actual counts) tuples for every
+		rollup whose [dose_count, acked_dose_count] disagree, with [0, 0] standing in for
+		a missing rollup.
+		"""
+		expected_dose_counts = self._compute_dose_counts_from_feedback()
+		actual_dose_counts = dict(
+			((patient_id, prescription_id, date), [dose_count, acked_dose_count])
+			for (patient_id, prescription_id, date, dose_count, acked_dose_count)
+			in self.values_list('patient', 'prescription', 'date', 'dose_count', 'acked_dose_count').iterator())
+		inconsistencies = []
+		for key in set(expected_dose_counts) | set(actual_dose_counts):
+			expected = expected_dose_counts.get(key, [0, 0])
+			actual = actual_dose_counts.get(key, [0, 0])
+			if expected != actual:
+				inconsistencies.append(key + (expected, actual))
+		return sorted(inconsistencies)
+
+
+class AdherenceRollup(models.Model):
+	"""
+	Number of medication doses of a prescription sent on a day whose outcome is known
+	(acknowledged, or missed for longer than the timeout), and how many of those were
+	acknowledged. Maintained incrementally by AdherenceRollupManager so adherence over a
+	window can be read from O(days) rows instead of scanning feedback.
+	"""
+	patient          = models.ForeignKey(PatientProfile, related_name='adherence_rollups')
+	prescription     = models.ForeignKey(Prescription, related_name='adherence_rollups')
+	date             = models.DateField()
+	dose_count       = models.PositiveIntegerField(default=0)
+	acked_dose_count = models.PositiveIntegerField(default=0)
+	last_updated     = models.DateTimeField(auto_now=True)
+
+	objects = AdherenceRollupManager()
+
+	class Meta:
+		unique_together = ('prescription', 'date')
+		index_together = [['patient', 'date']]
+
+
+class MessageCounterManager(models.Manager):
+	def _increment(self, date, _type, count):
+		"""
+		Adds <count> to the counter of messages of type <_type> sent on <date> in a single
+		atomic UPDATE and returns its new value, or None if there's no such counter yet
+		"""
+		cursor = connection.cursor()
+		cursor.execute(
+			"UPDATE %s SET count = count + %%s WHERE date = %%s AND _type = %%s RETURNING count" % (
+				connection.ops.quote_name(MessageCounter._meta.db_table)),
+			[count, date, _type])
+		row = cursor.fetchone()
+		return row[0] if row else None
+
+	def reserve(self, date, _type, count=1):
+		"""
+		Adds <count> to the counter of messages of type <_type> sent on <date> and returns its
+		previous value. Concurrent reservations never overlap, since the counter is
+		incremented and read back by one UPDATE.
+		"""
+		new_count = self._increment(date, _type, count)
+		if new_count is None:
+			# The day's first message of this type picks up after any sent before the counter
+			# existed. Only today's messages can be counted.
+			initial_count = 0
+			if date == datetime.date.today():
+				initial_count = Message.objects.next_nth_message_of_day_of_type(_type)
+			try:
+				with transaction.atomic():
+					self.create(date=date, _type=_type, count=initial_count + count)
+				new_count = initial_count + count
+			except IntegrityError:
+				# Another process created the counter first
+				new_count = self._increment(date, _type, count)
+		return new_count - count
+
+
+class MessageCounter(models.Model):
+	"""
+	Number of messages of a type sent on a day, from which each message's
+	nth_message_of_day_of_type is reserved without scanning the day's messages
+	"""
+	date   = models.DateField()
+	_type  = models.CharField(max_length=4, choices=Message.MESSAGE_TYPE_CHOICES)
+	count  = models.PositiveIntegerField(default=0)
+
+	objects = MessageCounterManager()
+
+	class Meta:
+		unique_together = ('date', '_type')
+
+
+class DispatchCursorManager(models.Manager):
+	def get_datetime_completed(self, name):
+		"""
+		Returns the datetime the dispatch loop <name> last completed up to, or None if it never ran
+		"""
+		datetimes = self.filter(name=name).values_list('datetime_completed', flat=True)
+		return datetimes[0] if datetimes else None
+
+	def advance(self, name, datetime_completed):
+		"""
+		Records that the dispatch loop <name> completed up to <datetime_completed>. Callers
+		hold the loop's advisory lock, so the cursor is never written concurrently.
+		"""
+		if not self.filter(name=name).update(datetime_completed=datetime_completed):
+			self.create(name=name, datetime_completed=datetime_completed)
+
+
+class DispatchCursor(models.Model):
+	"""
+	The datetime a periodic dispatch loop last completed, shared by every worker so a
+	tick picks up where the previous one left off wherever it ran
+	"""
+	name               = models.CharField(max_length=64, unique=True)
+	datetime_completed = models.DateTimeField()
+
+	objects = DispatchCursorManager()
+
+
+class InboundMessageManager(models.Manager):
+	@staticmethod
+	def _cache_key(sid):
+		return 'reminders.inbound_message.%s' % sid
+
+	@staticmethod
+	def _build_response(status_code, content_type, content):
+		if status_code is None:
+			return None
+		return HttpResponse(content=content, content_type=content_type, status=status_code)
+
+	def process_once(self, sid, process):
+		"""
+		Returns process(), the HTTP response to an inbound text, the first time the text with
+		provider message SID <sid> is seen. Retries of it get a copy of that response,
+		from the cache or else the ledger, without processing the text again.
+		A retry that arrives while the first delivery is still being processed waits for it.
+		Texts without a SID are always processed.
+		"""
+		if not sid:
+			return process()
+		cache_key = self._cache_key(sid)
+		cached_response = cache.get(cache_key)
+		if cached_response is not None:
+			return self._build_response(*cached_response)
+
+		with transaction.atomic():
+			try:
+				with transaction.atomic():
+					inbound_message = self.create(sid=sid)
+			except IntegrityError:
+				# Blocks until the first delivery's transaction is done
+				inbound_message = self.get(sid=sid)
+				return self._build_response(
+					inbound_message.status_code, inbound_message.content_type, inbound_message.content)
+			response = process()
+			inbound_message.record_response(response)
+		cache.set(cache_key, (inbound_message.status_code, inbound_message.content_type, inbound_message.content),
+		          INBOUND_MESSAGE_LEDGER_TTL)
+		return response
+
+	def receive(self, sid, from_number, body):
+		"""
+		Records an inbound text to be processed later. Returns the InboundMessage, or None
+		if the text with provider message SID <sid> was already received.
+		Texts without a SID are given a random one.
+		"""
+		if not sid:
+			sid = uuid.uuid4().hex
+		try:
+			with transaction.atomic():
+				return self.create(sid=sid, from_number=from_number or '', body=body)
+		except IntegrityError:
+			return None
+
+	def pending_for_number(self, from_number):
+		"""
+		Returns the unprocessed inbound texts from from_number in the order they were received
+		"""
+		return self.filter(from_number=from_number, datetime_processed=None).order_by('datetime_received', 'id')
+
+	def delete_expired(self, now):
+		"""
+		Deletes ledger entries older than INBOUND_MESSAGE_LEDGER_TTL seconds. Returns how many were deleted.
+		"""
+		expired = self.filter(datetime_received__lt=now - datetime.timedelta(seconds=INBOUND_MESSAGE_LEDGER_TTL))
+		expired_count = expired.count()
+		expired.delete()
+		return expired_count
+
+
+class InboundMessage(models.Model):
+	"""
+	Ledger of inbound texts keyed on the provider's message SID, with the HTTP response each
+	got, so that webhook retries are answered without processing the text again.
+	With INBOUND_SMS_ASYNC, also queues texts until a worker processes them.
+	"""
+	sid               = models.CharField(max_length=64, unique=True)
+	datetime_received = models.DateTimeField(auto_now_add=True, db_index=True)
+
+	datetime_processed = models.DateTimeField(blank=True, null=True)
+
+	# The response to the first delivery; status_code is None if there was none
+	status_code       = models.PositiveSmallIntegerField(null=True, blank=True)
+	content_type      = models.CharField(max_length=100, blank=True)
+# ************ ENCRYPTION START ************ 
+	content           = models.TextField(blank=True)
+
+	# The text itself, kept for texts processed asynchronously
+	from_number       = models.CharField(max_length=32, blank=True)
+	body              = models.TextField(blank=True)
+# ************ ENCRYPTION END ************** 
+
+	objects = InboundMessageManager()
+
+	class Meta:
+		index_together = [['from_number', 'datetime_processed']]
+
+	def record_response(self, response):
+		"""
+		Records the HTTP response the text got, which may be None, and marks it processed
+		"""
+		if response is not None:
+			self.status_code = response.status_code
+			self.content_type = response['Content-Type']
+			self.content = response.content.decode('utf-8')
+		self.datetime_processed = datetime.datetime.now()
+		self.save()
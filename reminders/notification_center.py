@@ -1,18 +1,101 @@
-import datetime, itertools
+import collections, datetime, itertools, operator
 
-from django.template.loader import render_to_string
+from django.db import transaction
+from django.db.models.query import QuerySet
 
 from configs.dev import settings
-from common.utilities import sendTextMessageToNumber, list_to_queryset
+from common.message_templates import render_message
+from common.sms_segments import pack_sms
+from common.utilities import sendTextMessageToNumber, reserve_primary_keys
 from common.models import UserProfile
 from patients.models import PatientProfile, SafetyNetRelationship
 from reminders.models import Notification, Message, Feedback
 
 
+class DispatchRecordBatch(object):
+	"""
+	Collects the Messages, Feedbacks and Message M2M rows produced while dispatching a tick,
+	and writes them all in one transaction with a constant number of queries on flush().
+	Notification send time updates aren't batched: each message's are written as it is
+	recorded, before it is sent, so a dispatch that dies resends nothing.
+	"""
+
+	def __init__(self):
+		self.clear()
+
+	def clear(self):
+		"""
+		Discard all collected records
+		"""
+		self.messages = []
+		self.feedbacks = []
+		self.message_notifications = []
+		self.message_feedbacks = []
+		self.message_counts_by_type = collections.defaultdict(int)
+		# Every notification in the batch is advanced past the same now
+		self.now = datetime.datetime.now()
+
+	def add_text_message(self, to, _type, content, notifications):
+		"""
+		Records a message of type <_type> sent to <to> for <notifications>, creating
+		feedback for each notification and advancing each to its next send time.
+		The advanced send times are written to the DB right away, in a single query.
+		"""
+		# Numbered within the batch for now; flush() shifts the numbers past today's earlier messages
+		message = Message(to=to, _type=_type, content=content,
+		                  nth_message_of_day_of_type=self.message_counts_by_type[_type])
+		self.message_counts_by_type[_type] += 1
+		self.messages.append(message)
+
+		for notification in notifications:
+			self.message_notifications.append((message, notification))
+			notification.update_to_next_send_time(save=False, now=self.now)
+			if Feedback.is_valid_type(_type):
+				feedback = Feedback(_type=_type, prescription=notification.prescription, notification=notification)
+				self.feedbacks.append(feedback)
+				self.message_feedbacks.append((message, feedback))
+		Notification.objects.bulk_update_send_times(notifications)
+		return message
+
+	def flush(self):
+		"""
+		Write all collected records to the DB
+		"""
+		if not self.messages:
+			return
+		# Reserve each type's nth_message_of_day_of_type values with one query per type
+		first_nth_message_of_day_of_type = dict(
+			(_type, Message.objects.reserve_nth_messages_of_day_of_type(_type, count))
+			for (_type, count) in self.message_counts_by_type.iteritems())
+		for message in self.messages:
+			message.nth_message_of_day_of_type += first_nth_message_of_day_of_type[message._type]
+		with transaction.atomic():
+			reserve_primary_keys(self.messages)
+			Message.objects.bulk_create(self.messages)
+			reserve_primary_keys(self.feedbacks)
+			Feedback.objects.bulk_create(self.feedbacks)
+
+			MessageNotification = Message.notifications.through
+			MessageNotification.objects.bulk_create(
+				[MessageNotification(message_id=message.pk, notification_id=notification.pk)
+				 for (message, notification) in self.message_notifications])
+			MessageFeedback = Message.feedbacks.through
+			MessageFeedback.objects.bulk_create(
+				[MessageFeedback(message_id=message.pk, feedback_id=feedback.pk)
+				 for (message, feedback) in self.message_feedbacks])
+		self.clear()
+
+
 class NotificationCenter(object):
 
-	def __init__(self, interval_sec=settings.REMINDER_MERGE_INTERVAL):
+	def __init__(self, interval_sec=settings.REMINDER_MERGE_INTERVAL, record_batch=None):
+		"""
+		If record_batch is a DispatchRecordBatch, the records of sent text messages are
+		collected in it instead of being written to the DB as each message is sent;
+		the caller is responsible for calling record_batch.flush()
+		"""
 		self.interval_sec = interval_sec
+		self.record_batch = record_batch
 
 	@staticmethod
 	def get_cutoff_datetime():
@@ -22,30 +105,31 @@ class NotificationCenter(object):
 	def merge_notifications(self, notifications, interval_sec=None):
 		"""
 		Merge Notification objects <notifications> into <interval> chunks;
-		Returns a tuple of tuples, where each sub-tuple consists of 
-		notifications falling within the same chunk.
+		Yields a tuple for each chunk, consisting of the notifications falling
+		within it, in send_datetime order.
+		notifications may be a sequence, which is sorted in memory without DB access
+		(in linear time if already sorted, as dispatched notifications are), or a QuerySet,
+		which is ordered and read in a single query.
 		"""
 		if not interval_sec:
 			interval_sec = self.interval_sec
 
 		interval_sec_dt = datetime.timedelta(seconds=interval_sec)
-		if notifications.exists():
-			notifications_iter = notifications.order_by("send_datetime")
-			first_notification = notifications[0]
-			chunks = []
-			current_chunk = []
-			current_chunk_endtime = first_notification.send_datetime + interval_sec_dt
-			for notification in notifications_iter:
-				if notification.send_datetime < current_chunk_endtime:
-					current_chunk.append(notification)
-				else:
-					chunks.append(tuple(current_chunk))
-					current_chunk = [notification]
-					current_chunk_endtime = notification.send_datetime + interval_sec_dt
-			chunks.append(tuple(current_chunk))
-
-			return tuple(chunks)
-		return
+		if isinstance(notifications, QuerySet):
+			notifications = notifications.order_by("send_datetime")
+		else:
+			notifications = sorted(notifications, key=operator.attrgetter('send_datetime'))
+
+		current_chunk = []
+		for notification in notifications:
+			if current_chunk and notification.send_datetime >= current_chunk_endtime:
+				yield tuple(current_chunk)
+				current_chunk = []
+			if not current_chunk:
+				current_chunk_endtime = notification.send_datetime + interval_sec_dt
+			current_chunk.append(notification)
+		if current_chunk:
+			yield tuple(current_chunk)
 
 	def resend_text_message(self, to, message):
 		"""
@@ -82,20 +166,23 @@ class NotificationCenter(object):
 
 		# compose message
 		if body is None:
-			body = render_to_string(template, context)
+			body = render_message(template, context)
 		primary_phone_number = to.primary_phone_number or to.primary_contact.primary_phone_number
 
 		# Perform record keeping in DB
 		_type = notifications[0]._type
-		message = Message.objects.create(to=to, _type=_type, content=body)
-		for one_notification in notifications:
-			message.notifications.add(one_notification)
-			one_notification.update_to_next_send_time()
-			if Feedback.is_valid_type(_type):
-				feedback = Feedback.objects.create(_type=_type,
-												   prescription=one_notification.prescription,
-												   notification=one_notification)
-				message.feedbacks.add(feedback)
+		if self.record_batch is not None:
+			self.record_batch.add_text_message(to=to, _type=_type, content=body, notifications=notifications)
+		else:
+			message = Message.objects.create(to=to, _type=_type, content=body)
+			for one_notification in notifications:
+				message.notifications.add(one_notification)
+				one_notification.update_to_next_send_time()
+				if Feedback.is_valid_type(_type):
+					feedback = Feedback.objects.create(_type=_type,
+													   prescription=one_notification.prescription,
+													   notification=one_notification)
+					message.feedbacks.add(feedback)
 
 		cutoff_datetime = NotificationCenter.get_cutoff_datetime()
 		if not [n for n in notifications if n.send_datetime < cutoff_datetime]:
@@ -105,10 +192,9 @@ class NotificationCenter(object):
 
 	def send_refill_notifications(self, to, notifications):
 		"""
-		Send refill notifications in QuerySet <notifications> to recipient <to>
+		Send refill notifications in list <notifications> to recipient <to>
 		"""
-		notifications = notifications.filter(to=to, _type=Notification.REFILL)
-		if not notifications.exists() or to.status != PatientProfile.ACTIVE:
+		if not notifications or to.status != PatientProfile.ACTIVE:
 			return
 
 		notification_groups = self.merge_notifications(notifications)
@@ -125,14 +211,12 @@ class NotificationCenter(object):
 
 	def send_medication_notifications(self, to, notifications):
 		"""
-		Send medication notifications in QuerySet <notifications> to recipient <to>
+		Send medication notifications in list <notifications> to recipient <to>
 		"""
-		notifications = notifications.filter(to=to, _type=Notification.MEDICATION) \
-			.exclude(prescription__filled=False)
-		if not notifications.exists() or to.status != PatientProfile.ACTIVE:
+		notifications = [n for n in notifications if n.prescription is None or n.prescription.filled]
+		if not notifications or to.status != PatientProfile.ACTIVE:
 			return
 
-		notifications = notifications.order_by('prescription__drug__name')
 		notification_groups = self.merge_notifications(notifications)
 
 		for notification_group in notification_groups:
@@ -146,10 +230,9 @@ class NotificationCenter(object):
 
 	def send_welcome_notifications(self, to, notifications):
 		"""
-		Send welcome notification in QuerySet <notifications> to recipient <to>
+		Send welcome notification in list <notifications> to recipient <to>
 		"""
-		notifications = notifications.filter(to=to, _type=Notification.WELCOME)
-		if not notifications.exists() or to.status != PatientProfile.NEW:
+		if not notifications or to.status != PatientProfile.NEW:
 			return
 		notification = notifications[0]
 
@@ -175,32 +258,32 @@ class NotificationCenter(object):
 
 	def send_safety_net_notifications(self, to, notifications):
 		"""
-		Send safety-net notifications in QuerySet <notifications> to recipient <to>
+		Send safety-net notifications in list <notifications> to recipient <to>
 		"""
-		notifications = notifications.filter(to=to, _type=Notification.SAFETY_NET)
-
-		if not notifications.exists() or to.status != PatientProfile.ACTIVE:
+		if not notifications or to.status != PatientProfile.ACTIVE:
 			return
 
-		notifications = notifications.order_by("send_datetime")
-		for notification in notifications:
-			# Construct content of message
-			self.send_text_message(to=to, notifications=notification, body=notification.content)
+		# Pack the reports on each patient into as few segments as possible
+		notifications = sorted(notifications, key=lambda n: n.send_datetime)
+		for body, indices in pack_sms([n.content for n in notifications], settings.SMS_MAX_SEGMENTS):
+			self.send_text_message(to=to, notifications=[notifications[i] for i in indices], body=body)
 
 	def send_safety_net_welcome_notifications(self, to, notifications):
 		"""
-		Send a welcome safety-net notifications in QuerySet <notifications> to recipient <to>
+		Send a welcome safety-net notifications in list <notifications> to recipient <to>
+		The relationships of every patient in <notifications> to <to> are read in one query
 		"""
-		notifications = notifications.filter(to=to, _type=Notification.SAFETY_NET_WELCOME)
-
-		if not notifications.exists():
+		if not notifications:
 			return
 
+		relationships = dict(SafetyNetRelationship.objects.filter(
+			target_patient=to,
+			source_patient__in=set(n.patient_of_safety_net_id for n in notifications)
+		).values_list('source_patient', 'target_to_source_relationship'))
 		for notification in notifications:
-			safety_nets = SafetyNetRelationship.objects.filter(target_patient=to, source_patient=notification.patient_of_safety_net)
-			if not safety_nets:
+			if notification.patient_of_safety_net_id not in relationships:
 				raise Exception("Sending safety net welcome notification to someone without a safety net")
-			relationship = safety_nets[0].target_to_source_relationship
+			relationship = relationships[notification.patient_of_safety_net_id]
 			context = {'patient_first_name': notification.patient_of_safety_net.first_name,
 			           'patient_gender': notification.patient_of_safety_net.gender,
 			           'patient_relationship': relationship,
@@ -219,28 +302,24 @@ class NotificationCenter(object):
 
 	def send_static_one_off_notifications(self, to, notifications):
 		"""
-		Send safety-net notifications in QuerySet <notifications> to recipient <to>
+		Send static one-off notifications in list <notifications> to recipient <to>
 		"""
-		notifications = notifications.filter(to=to, _type=Notification.STATIC_ONE_OFF)
-
-		if not notifications.exists() or to.status != PatientProfile.ACTIVE:
+		if not notifications or to.status != PatientProfile.ACTIVE:
 			return
 
-		notifications = notifications.order_by("send_datetime")
+		notifications = sorted(notifications, key=lambda n: n.send_datetime)
 		for notification in notifications:
 			# Construct content of message
 			self.send_text_message(to=to, notifications=notification, body=notification.content)
 
 	def send_repeat_message_notifications(self, to, notifications):
 		"""
-		Send repeat message notifications in QuerySet <notifications> to recipient <to>
+		Send repeat message notifications in list <notifications> to recipient <to>
 		"""
-		notifications = notifications.filter(to=to, _type=Notification.REPEAT_MESSAGE)
-
-		if not notifications.exists() or to.status != PatientProfile.ACTIVE:
+		if not notifications or to.status != PatientProfile.ACTIVE:
 			return
 
-		notifications = notifications.order_by("send_datetime")
+		notifications = sorted(notifications, key=lambda n: n.send_datetime)
 		for notification in notifications:
 			notification.active = False
 			notification.save()
@@ -248,22 +327,27 @@ class NotificationCenter(object):
 
 	def send_notifications(self, to, notifications):
 		"""
-		Send Notifications QuerySet <notifications> to recipient <to>
+		Send <notifications> to recipient <to>, where notifications is a QuerySet, a list or
+		a single Notification. Notifications are read once and partitioned by type in memory;
+		loaded with select_related(*Notification.DISPATCH_RELATED), as by
+		notifications_at_time_by_recipient, they are sent without a query per notification.
 		"""
 		if to.status == PatientProfile.QUIT:
 			return
 
-		# if notifications is a list or single notification object, 
-		# convert into QuerySet
-		if isinstance(notifications, [].__class__):
-			notifications = list_to_queryset(notifications)
-		elif isinstance(notifications, Notification):
-			notifications = list_to_queryset([notifications])
-
-		self.send_welcome_notifications(to, notifications)
-		self.send_refill_notifications(to, notifications)
-		self.send_medication_notifications(to, notifications)
-		self.send_safety_net_notifications(to, notifications)
-		self.send_safety_net_welcome_notifications(to, notifications)
-		self.send_static_one_off_notifications(to, notifications)
-		self.send_repeat_message_notifications(to, notifications)
+		if isinstance(notifications, Notification):
+			notifications = [notifications]
+		elif isinstance(notifications, QuerySet):
+			notifications = notifications.select_related(*Notification.DISPATCH_RELATED)
+		notifications_by_type = collections.defaultdict(list)
+		for notification in notifications:
+			if notification.to_id == to.pk:
+				notifications_by_type[notification._type].append(notification)
+
+		self.send_welcome_notifications(to, notifications_by_type[Notification.WELCOME])
+		self.send_refill_notifications(to, notifications_by_type[Notification.REFILL])
+		self.send_medication_notifications(to, notifications_by_type[Notification.MEDICATION])
+		self.send_safety_net_notifications(to, notifications_by_type[Notification.SAFETY_NET])
+		self.send_safety_net_welcome_notifications(to, notifications_by_type[Notification.SAFETY_NET_WELCOME])
+		self.send_static_one_off_notifications(to, notifications_by_type[Notification.STATIC_ONE_OFF])
+		self.send_repeat_message_notifications(to, notifications_by_type[Notification.REPEAT_MESSAGE])
@@ -0,0 +1,160 @@
+import calendar, datetime
+
+
+def _microseconds(delta):
+	return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+def add_months(dt, months, day=None):
+	"""
+	Returns date or datetime <dt> moved by <months> months, onto day of the month <day>
+	(dt's day by default). The day is clamped to the end of shorter months, so the 31st
+	moves to Feb 28 (or Feb 29 in leap years).
+	"""
+	year, month = divmod(dt.year * 12 + dt.month - 1 + months, 12)
+	month += 1
+	return dt.replace(year=year, month=month, day=min(day or dt.day, calendar.monthrange(year, month)[1]))
+
+def next_by_period(start, now, period):
+	"""
+	Returns the first of start + period, start + 2 * period, ... after <now>,
+	where <period> is a timedelta
+	"""
+	periods = _microseconds(now - start) // _microseconds(period) + 1
+	return start + max(periods, 1) * period
+
+def next_by_months(start, now, months, day=None):
+	"""
+	Returns the first of <start> moved by months, 2 * months, ... months falling on a date
+	after <now>'s. Every occurrence is clamped from day of the month <day> (start's day by
+	default). Pass the schedule's original day when <start> may itself have been clamped,
+	so the 31st stays on the last day of each month instead of drifting to the 28th.
+	"""
+	steps = max(((now.year - start.year) * 12 + now.month - start.month) // months, 1)
+	next_datetime = add_months(start, steps * months, day)
+	if next_datetime.date() <= now.date():
+		next_datetime = add_months(start, (steps + 1) * months, day)
+	return next_datetime
+
+def next_by_years(start, now, day=None):
+	"""
+	Returns <start> moved to the first year after both its own and <now>'s, onto day of the
+	month <day> (start's day by default), with Feb 29 clamped to Feb 28 outside leap years
+	"""
+	return add_months(start, 12 * max(now.year - start.year + 1, 1), day)
+
+
+class RecurrenceRule(object):
+	"""
+	An RFC 5545 (RRULE) style recurrence rule such as "FREQ=DAILY;INTERVAL=2" for every other
+	day, or "FREQ=WEEKLY;BYDAY=MO,WE,FR;BYHOUR=8,20" for Mon/Wed/Fri at 8am and 8pm.
+	Supports FREQ (DAILY or WEEKLY), INTERVAL, BYDAY, BYHOUR, BYMINUTE and UNTIL; a tapering
+	schedule is a rule per step, each ending with UNTIL. Occurrences are anchored at a dtstart,
+	which also supplies the day, hour and minute a rule leaves out.
+	"""
+	DAILY = 'DAILY'
+	WEEKLY = 'WEEKLY'
+	WEEKDAYS = ['MO', 'TU', 'WE', 'TH', 'FR', 'SA', 'SU']
+
+	MAX_PARSED_RULES = 1024
+	_parsed_rules = {}
+
+	def __init__(self, rule):
+		parts = {}
+		for part in rule.strip().upper().split(';'):
+			if not part:
+				continue
+			name, sep, value = part.partition('=')
+			if not sep or not value or name in parts:
+				raise ValueError("Invalid recurrence rule part %r in %r" % (part, rule))
+			parts[name] = value
+		unknown_parts = set(parts) - set(['FREQ', 'INTERVAL', 'BYDAY', 'BYHOUR', 'BYMINUTE', 'UNTIL'])
+		if unknown_parts:
+			raise ValueError("Unsupported recurrence rule parts %s in %r" % (", ".join(sorted(unknown_parts)), rule))
+
+		self.freq = parts.get('FREQ')
+		if self.freq not in (self.DAILY, self.WEEKLY):
+			raise ValueError("Recurrence rule %r needs FREQ=DAILY or FREQ=WEEKLY" % rule)
+		self.interval = self._parse_integers(parts.get('INTERVAL', '1'), 1, None, rule)[0]
+		self.weekdays = None
+		if 'BYDAY' in parts:
+			if self.freq != self.WEEKLY:
+				raise ValueError("BYDAY needs FREQ=WEEKLY in recurrence rule %r" % rule)
+			try:
+				self.weekdays = sorted(set(self.WEEKDAYS.index(day) for day in parts['BYDAY'].split(',')))
+			except ValueError:
+				raise ValueError("Invalid BYDAY in recurrence rule %r" % rule)
+		self.hours = self._parse_integers(parts['BYHOUR'], 0, 23, rule) if 'BYHOUR' in parts else None
+		self.minutes = self._parse_integers(parts['BYMINUTE'], 0, 59, rule) if 'BYMINUTE' in parts else None
+		self.until = None
+		if 'UNTIL' in parts:
+			for until_format in ('%Y%m%dT%H%M%S', '%Y%m%d'):
+				try:
+					self.until = datetime.datetime.strptime(parts['UNTIL'], until_format)
+					break
+				except ValueError:
+					pass
+			else:
+				raise ValueError("Invalid UNTIL in recurrence rule %r" % rule)
+			if self.until.time() == datetime.time.min and len(parts['UNTIL']) == 8:
+				# A date includes the whole day
+				self.until = self.until.replace(hour=23, minute=59, second=59)
+
+	@staticmethod
+	def _parse_integers(value, minimum, maximum, rule):
+		try:
+			integers = sorted(set(int(integer) for integer in value.split(',')))
+		except ValueError:
+			raise ValueError("Invalid number in recurrence rule %r" % rule)
+		if integers[0] < minimum or (maximum is not None and integers[-1] > maximum):
+			raise ValueError("Number out of range in recurrence rule %r" % rule)
+		return integers
+
+	@classmethod
+	def parse(cls, rule):
+		"""
+		Returns the RecurrenceRule of string <rule>, parsing each distinct rule once
+		"""
+		recurrence_rule = cls._parsed_rules.get(rule)
+		if recurrence_rule is None:
+			recurrence_rule = cls(rule)
+			if len(cls._parsed_rules) >= cls.MAX_PARSED_RULES:
+				cls._parsed_rules.clear()
+			cls._parsed_rules[rule] = recurrence_rule
+		return recurrence_rule
+
+	def occurrences(self, dtstart, after, count=1):
+		"""
+		Returns the first <count> occurrences at or after <dtstart> and after <after>.
+		Skips straight to the period containing <after>, however far past dtstart it is.
+		"""
+		after = max(after, dtstart - datetime.timedelta(microseconds=1))
+		# Rules without times recur at dtstart's exact time of day
+		second, microsecond = (0, 0) if self.hours or self.minutes else (dtstart.second, dtstart.microsecond)
+		times = [datetime.time(hour, minute, second, microsecond)
+		         for hour in (self.hours or [dtstart.hour])
+		         for minute in (self.minutes or [dtstart.minute])]
+		if self.freq == self.WEEKLY:
+			period_days = 7 * self.interval
+			anchor = dtstart.date() - datetime.timedelta(days=dtstart.weekday())
+			day_offsets = self.weekdays or [dtstart.weekday()]
+		else:
+			period_days = self.interval
+			anchor = dtstart.date()
+			day_offsets = [0]
+
+		occurrences = []
+		period = max((after.date() - anchor).days // period_days, 0)
+		while len(occurrences) < count:
+			period_start = anchor + datetime.timedelta(days=period * period_days)
+			if self.until is not None and datetime.datetime.combine(period_start, datetime.time.min) > self.until:
+				break
+			for day_offset in day_offsets:
+				day = period_start + datetime.timedelta(days=day_offset)
+				for time in times:
+					occurrence = datetime.datetime.combine(day, time)
+					if occurrence > after and (self.until is None or occurrence <= self.until):
+						occurrences.append(occurrence)
+						if len(occurrences) == count:
+							return occurrences
+			period += 1
+		return occurrences
@@ -1,78 +1,57 @@
-import glob, itertools, re, datetime, random
+import itertools, datetime, random
 
 from django.http import HttpResponseNotFound, HttpResponse
 from django.template import Context
-from django.template.loader import render_to_string
 
+from common.message_templates import get_message_templates, render_message
 from common.models import DrugFact
 from patients.models import SafetyNetRelationship
-from reminders.models import Message, Notification
+from reminders.models import Message, Notification, AdherenceRollup
+from reminders.response_classifier import ResponseClassifier
 
 
 class ResponseCenter(object):
+	def __init__(self):
+		self.classifier = ResponseClassifier()
+
+	def classify(self, response):
+		"""
+		Returns the ClassifiedResponse of inbound text body <response>
+		"""
+		return self.classifier.classify(response)
+
 	def _is_quit(self, message):
 		""" 
 		Returns true if the message is a quit message
 		"""
-		return message.lower() in ("q", "quit")
+		return self.classify(message).intent == ResponseClassifier.QUIT
 
 	def _is_pause(self, message):
-		return message.lower() in ("p", "pause")
+		return self.classify(message).intent == ResponseClassifier.PAUSE
 
 	def _is_resume(self, message):
 		""" 
 		Returns true if the message is a resume
 		"""
-		return message.lower() in ("r", "resume")
+		return self.classify(message).intent == ResponseClassifier.RESUME
 
 	def is_yes(self, response):
-		return response.lower() in ['y', 'yes']
+		return self.classify(response).intent == ResponseClassifier.YES
 
 	def is_no(self, response):
-		return response.lower() in ['n', 'no']
+		return self.classify(response).intent == ResponseClassifier.NO
 
 	def is_med_info(self, response):
-		return response.lower() in ['m', 'info']
+		return self.classify(response).intent == ResponseClassifier.MED_INFO
 
 	def is_time_change(self, response):
-		# Parse time from response
-		time_with_minutes_re = "^(?P<hour>[0-9]{1,2})(:)?(?P<minute>[0-9][0-9])(\\s)?(?i)(?P<ampm>am|pm)?$"
-		time_without_minutes_re = "^(?P<hour>[0-9]{1,2})(\\s)?(?i)(?P<ampm>am|pm)?$"
-		time_res = [time_with_minutes_re, time_without_minutes_re]
-		for regex in time_res:
-			formatted_time = re.match(regex, response.lower())
-			if formatted_time:
-				break
-
-		if formatted_time:
-			extracted_hour = formatted_time.group("hour")
-			try:
-				extracted_minute = formatted_time.group("minute")
-			except:
-				extracted_minute = None
-			if int(extracted_hour) < 24:
-				hours = int(extracted_hour)
-			else:
-				return False
-			if extracted_minute:
-				if int(extracted_minute) < 60:
-					minutes = int(extracted_minute)
-				else:
-					return False
-			else:
-				minutes = 0
-
-			# Hours greater than 12 shouldn't have ampm. For example 13pm. Or 13am
-			if formatted_time.group("ampm") != "" and hours > 12:
-				return False
-
-			if formatted_time.group("ampm") == 'pm' and hours < 12:
-				hours = hours+12
-
-			time = datetime.time(hour=hours, minute=minutes)
-			return time
-		else:
-			return False
+		"""
+		Returns the datetime.time a time change response asks for, or False
+		"""
+		classified_response = self.classify(response)
+		if classified_response.intent == ResponseClassifier.TIME:
+			return classified_response.time
+		return False
 
 	def process_invalid_response(self):
 		return HttpResponseNotFound()
@@ -80,21 +59,21 @@ class ResponseCenter(object):
 	def process_quit_response(self, sender):
 		if sender.did_request_quit_within_quit_response_window():
 			sender.quit()
-			content = render_to_string('messages/response_quit_is_confirmed.txt')
+			content = render_message('messages/response_quit_is_confirmed.txt')
 		else:
 			sender.record_quit_request()
-			content = render_to_string('messages/response_quit_break_the_glass.txt')
+			content = render_message('messages/response_quit_break_the_glass.txt')
 		return HttpResponse(content=content)
 
 	def process_pause_response(self, sender):
 		sender.pause()
-		content = render_to_string('messages/response_pause_is_confirmed.txt')
+		content = render_message('messages/response_pause_is_confirmed.txt')
 		return HttpResponse(content=content, content_type="text/plain")
 
 	def process_resume_response(self, sender):
 		if sender.did_quit():
 			sender.resume()
-			content = render_to_string('messages/response_resume_welcome_back.txt')
+			content = render_message('messages/response_resume_welcome_back.txt')
 			return HttpResponse(content=content, content_type="text/plain")
 
 	def _get_adherence_ratio_ack_response_content(self, sender, acked_messages):
@@ -105,10 +84,8 @@ class ResponseCenter(object):
 
 	def _get_app_upsell_content(self, sender, acked_message):
 		# Select path to the appropriate upsell content
-		upsell_content_choices = glob.glob("templates/messages/medication_responses/yes_responses/app_upsell/*.txt")
-		remove_preceding_content = "templates/"
+		upsell_content_choices = get_message_templates().names_in('messages/medication_responses/yes_responses/app_upsell/')
 		upsell_content	= random.choice(upsell_content_choices)
-		upsell_content = upsell_content[remove_preceding_content.__len__():]
 		upsell_content = 'messages/medication_responses/yes_responses/app_upsell/dummy.txt'
 
 		# Find the happy person in string <happy_person> will be happy you're taking care of your health.
@@ -128,7 +105,7 @@ class ResponseCenter(object):
 		dict = {'app_upsell_content' : upsell_content,
 		        'happy_person' : happy_person}
 		# TODO: Make this template so that if it gets too long it will choose the shorter name
-		content = render_to_string('messages/medication_responses/app_upsell.txt', dict)
+		content = render_message('messages/medication_responses/app_upsell.txt', dict)
 		return content
 
 	def _get_health_educational_content(self, sender, acked_message):
@@ -163,12 +140,8 @@ class ResponseCenter(object):
 		# Switch on type of response
 		if self.is_yes(response):
 			# Send out a medication ack message
-			# Update state
-			feedbacks = message.feedbacks.all()
-			for feedback in feedbacks:
-				feedback.completed = True
-				feedback.datetime_responded = now
-				feedback.save()
+			# Update state, counting the doses towards the patient's adherence
+			AdherenceRollup.objects.record_acked_doses(message.feedbacks.values_list('id', flat=True), now)
 
 			# Create new message
 			content = self._return_best_ack_response_content(sender, message)
@@ -187,7 +160,7 @@ class ResponseCenter(object):
 			# Create a questionnaire message
 			template = 'messages/medication_questionnaire_message.txt'
 			context = {'response_dict': iter(sorted(Message.MEDICATION_QUESTIONNAIRE_RESPONSE_DICTIONARY.items()))}
-			content = render_to_string(template, context)
+			content = render_message(template, context)
 
 			# Create new message
 			new_m = Message.objects.create(to=sender, _type=Message.MEDICATION_QUESTIONNAIRE, previous_message=message,
@@ -215,10 +188,49 @@ class ResponseCenter(object):
 			message.datetime_responded = None
 			message.save()
 			template = 'messages/unknown_response.txt'
-			content = render_to_string(template)
+			content = render_message(template)
 			new_m = Message.objects.create(to=sender, _type=Message.STATIC_ONE_OFF, content=content)
 			return HttpResponse(content=content, content_type='text/plain')
 
+	# The type of message sent in reply to each questionnaire option
+	#TODO(mgaba): Figure out what else should happen if someone needs to refill or has side effects
+	#TODO(mgaba): Add doctors name to personalize messages
+	MEDICATION_QUESTIONNAIRE_REPLY_TYPES = {
+		'A': Message.STATIC_ONE_OFF,        # Haven't gotten the chance
+		'B': Message.STATIC_ONE_OFF,        # Need to refill
+		'C': Message.STATIC_ONE_OFF,        # Side effects
+		'D': Message.STATIC_ONE_OFF,        # Meds don't work
+		'E': Message.STATIC_ONE_OFF,        # Prescription changed
+		'F': Message.STATIC_ONE_OFF,        # I feel sad :(
+		'G': Message.OPEN_ENDED_QUESTION,   # Other
+	}
+	REFILL_QUESTIONNAIRE_REPLY_TYPES = {
+		'A': Message.STATIC_ONE_OFF,        # Haven't gotten the chance
+		'B': Message.STATIC_ONE_OFF,        # Too expensive
+		'C': Message.STATIC_ONE_OFF,        # Concerned about side effects
+		'D': Message.OPEN_ENDED_QUESTION,   # Other
+	}
+
+	def _process_questionnaire_option(self, sender, message, note, template_directory, reply_type):
+		"""
+		Records questionnaire answer <note> on the questioned feedback and replies with
+		the answer's template from template_directory as a message of type reply_type
+		"""
+		for feedback in message.feedbacks.all():
+			feedback.note = note
+			feedback.save()
+		content = render_message(template_directory + note + '.txt')
+		new_m = Message.objects.create(to=sender, _type=reply_type, content=content, previous_message=message)
+		return HttpResponse(content=content, content_type='text/plain')
+
+	def _process_unknown_questionnaire_response(self, sender, message):
+		message.datetime_responded = None
+		message.save()
+		template = 'messages/unknown_response.txt'
+		content = render_message(template)
+		new_m = Message.objects.create(to=sender, _type=Message.STATIC_ONE_OFF, content=content)
+		return HttpResponse(content=content, content_type='text/plain')
+
 	def process_medication_questionnaire_response(self, sender, message, response):
 		""" Process a response to a medication questionnaire message
 		"""
@@ -226,67 +238,21 @@ class ResponseCenter(object):
 		message.datetime_responded = now
 		message.save()
 
-		def process_response(return_message_type):
-			for feedback in message.feedbacks.all():
-				feedback.note = Message.MEDICATION_QUESTIONNAIRE_RESPONSE_DICTIONARY[response.upper()]
-				feedback.save()
-			template = 'messages/medication_questionnaire_responses/' + \
-			           Message.MEDICATION_QUESTIONNAIRE_RESPONSE_DICTIONARY[response.upper()] + \
-			           '.txt'
-			content = render_to_string(template)
-			new_m = Message.objects.create(to=sender, _type=return_message_type, content=content, previous_message=message)
-			return HttpResponse(content=content, content_type='text/plain')
+		option = self.classify(response).option
+		if option not in self.MEDICATION_QUESTIONNAIRE_REPLY_TYPES:
+			return self._process_unknown_questionnaire_response(sender, message)
 
-		# Switch on type of response
 		# a - Haven't gotten the chance
-		if response.lower() == 'a':
+		if option == 'A':
 			# Schedule a medication reminder for later
 			one_hour = datetime.datetime.now() + datetime.timedelta(hours=1)
 			n = Notification.objects.create(to=sender, _type=Notification.REPEAT_MESSAGE, repeat=Notification.NO_REPEAT,
 			                                message=message.previous_message, send_datetime=one_hour)
 
-			# Send response
-			return process_response(Message.STATIC_ONE_OFF)
-
-		# b - Need to refill
-		elif response.lower() == 'b':
-			#TODO(mgaba): Figure out what else should happen if someone needs to refill
-			# Send response
-			return process_response(Message.STATIC_ONE_OFF)
-
-		# c - Side effects
-		elif response.lower() == 'c':
-			#TODO(mgaba): Figure out what else should happen if someone has side effects
-			#TODO(mgaba): Add doctors name to personalize messages
-			# Send response
-			return process_response(Message.STATIC_ONE_OFF)
-
-		# d - Meds don't work
-		elif response.lower() == 'd':
-			#TODO(mgaba): Add doctors name to personalize messages
-			return process_response(Message.STATIC_ONE_OFF)
-
-		# e - Prescription changed
-		elif response.lower() == 'e':
-			#TODO(mgaba): Add doctors name to personalize messages
-			return process_response(Message.STATIC_ONE_OFF)
-
-		# f - I feel sad :(
-		elif response.lower() == 'f':
-			return process_response(Message.STATIC_ONE_OFF)
-
-		# g - Other
-		elif response.lower() == 'g':
-			#TODO(mgaba): Add doctors name to personalize message
-			return process_response(Message.OPEN_ENDED_QUESTION)
-		# Unknown response
-		else:
-			message.datetime_responded = None
-			message.save()
-			template = 'messages/unknown_response.txt'
-			content = render_to_string(template)
-			new_m = Message.objects.create(to=sender, _type=Message.STATIC_ONE_OFF, content=content)
-			return HttpResponse(content=content, content_type='text/plain')
+		# Send response
+		note = Message.MEDICATION_QUESTIONNAIRE_RESPONSE_DICTIONARY[option]
+		return self._process_questionnaire_option(sender, message, note, 'messages/medication_questionnaire_responses/',
+		                                          self.MEDICATION_QUESTIONNAIRE_REPLY_TYPES[option])
 
 	def process_refill_response(self, sender, message, response):
 		""" Process a response to a refill message
@@ -358,7 +324,7 @@ class ResponseCenter(object):
 			           'ampm':ampm,
 			           'day':day}
 			template = 'messages/refill_ack_message.txt'
-			content = render_to_string(template, context)
+			content = render_message(template, context)
 			Message.objects.create(to=sender, _type=Message.STATIC_ONE_OFF, previous_message=message, content=content)
 			return HttpResponse(content=content, content_type='text/plain')
 
@@ -374,7 +340,7 @@ class ResponseCenter(object):
 			# Create a questionnaire message
 			template = 'messages/refill_questionnaire_message.txt'
 			context = {'response_dict': iter(sorted(Message.REFILL_QUESTIONNAIRE_RESPONSE_DICTIONARY.items()))}
-			content = render_to_string(template, context)
+			content = render_message(template, context)
 
 			# Create new message
 			new_m = Message.objects.create(to=sender, _type=Message.REFILL_QUESTIONNAIRE, previous_message=message,
@@ -399,7 +365,7 @@ class ResponseCenter(object):
 			message.datetime_responded = None
 			message.save()
 			template = 'messages/unknown_response.txt'
-			content = render_to_string(template)
+			content = render_message(template)
 			new_m = Message.objects.create(to=sender, _type=Message.STATIC_ONE_OFF, content=content)
 			return HttpResponse(content=content, content_type='text/plain')
 		raise Exception("Not yet implemented")
@@ -411,53 +377,14 @@ class ResponseCenter(object):
 		message.datetime_responded = now
 		message.save()
 
-		def process_response(return_message_type):
-			for feedback in message.feedbacks.all():
-				feedback.note = Message.REFILL_QUESTIONNAIRE_RESPONSE_DICTIONARY[response.upper()]
-				feedback.save()
-			template = 'messages/refill_questionnaire_responses/' + \
-			           Message.REFILL_QUESTIONNAIRE_RESPONSE_DICTIONARY[response.upper()] + \
-			           '.txt'
-			content = render_to_string(template)
-			new_m = Message.objects.create(to=sender, _type=return_message_type, content=content, previous_message=message)
-			return HttpResponse(content=content, content_type='text/plain')
+		option = self.classify(response).option
+		if option not in self.REFILL_QUESTIONNAIRE_REPLY_TYPES:
+			return self._process_unknown_questionnaire_response(sender, message)
 
-
-		# Switch on type of response
-		# a - Haven't gotten the chance
-		if response.lower() == 'a':
-			# Schedule a medication reminder for later
-			one_hour = datetime.datetime.now() + datetime.timedelta(hours=1)
-
-			# Send response
-			return process_response(Message.STATIC_ONE_OFF)
-
-		# b - Too expensive
-		elif response.lower() == 'b':
-			#TODO(mgaba): Figure out what else should happen if someone needs to refill
-			# Send response
-			return process_response(Message.STATIC_ONE_OFF)
-
-		# c - Concerned about side effects
-		elif response.lower() == 'c':
-			#TODO(mgaba): Figure out what else should happen if someone has side effects
-			#TODO(mgaba): Add doctors name to personalize messages
-			# Send response
-			return process_response(Message.STATIC_ONE_OFF)
-
-		# d - Other
-		elif response.lower() == 'd':
-			#TODO(mgaba): Add doctors name to personalize messages
-			return process_response(Message.OPEN_ENDED_QUESTION)
-
-		# Unknown response
-		else:
-			message.datetime_responded = None
-			message.save()
-			template = 'messages/unknown_response.txt'
-			content = render_to_string(template)
-			new_m = Message.objects.create(to=sender, _type=Message.STATIC_ONE_OFF, content=content)
-			return HttpResponse(content=content, content_type='text/plain')
+		# Send response
+		note = Message.REFILL_QUESTIONNAIRE_RESPONSE_DICTIONARY[option]
+		return self._process_questionnaire_option(sender, message, note, 'messages/refill_questionnaire_responses/',
+		                                          self.REFILL_QUESTIONNAIRE_REPLY_TYPES[option])
 
 	def process_med_info_response(self, sender, message, response):
 		""" Process a response to a med info message
@@ -500,7 +427,7 @@ class ResponseCenter(object):
 			feedback.save()
 
 		template = 'messages/response_open_ended_question.txt'
-		content = render_to_string(template)
+		content = render_message(template)
 		new_m = Message.objects.create(to=sender, _type=Message.STATIC_ONE_OFF, content=content)
 		return HttpResponse(content=content, content_type='text/plain')
 
@@ -512,7 +439,7 @@ class ResponseCenter(object):
 			raise Exception("Not yet implemented")
 		else:
 			template = "messages/no_messages_to_reply_to.txt"
-			content = render_to_string(template)
+			content = render_message(template)
 			new_m = Message.objects.create(to=sender, _type=Message.STATIC_ONE_OFF, content=content)
 			return HttpResponse(content=content, content_type='text/plain')
 
@@ -535,15 +462,16 @@ class ResponseCenter(object):
 		""" 
 		Returns an HttpResponse object. Changes state of system based on action and sender's message
 		"""
-		if sender is None or (sender.did_quit() and not self._is_resume(response)):
+		intent = self.classify(response).intent
+		if sender is None or (sender.did_quit() and intent != ResponseClassifier.RESUME):
 			return self.process_invalid_response()
 
 		# Generic logic for responding to any type of message goes here
-		# if self._is_quit(response):
+		# if intent == ResponseClassifier.QUIT:
 		# 	return self.process_quit_response(sender)
-		if self._is_quit(response):
+		if intent == ResponseClassifier.QUIT:
 			return self.process_pause_response(sender)
-		elif sender.did_quit() and self._is_resume(response):
+		elif sender.did_quit() and intent == ResponseClassifier.RESUME:
 			return self.process_resume_response(sender)
 
 		last_sent_message = Message.objects.get_last_sent_message_requiring_response(to=sender)
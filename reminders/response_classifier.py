@@ -0,0 +1,98 @@
+import collections, datetime, re
+
+
+# The intent of an inbound text. option is the upper case letter of a questionnaire
+# option, time the datetime.time of a time change; both are None for other intents.
+ClassifiedResponse = collections.namedtuple('ClassifiedResponse', ['intent', 'option', 'time'])
+
+
+class ResponseClassifier(object):
+	"""
+	Classifies the body of an inbound text into an intent in a single pass: the body is
+	normalized once and looked up in a keyword table, then checked for a questionnaire
+	option and finally a time. New keywords are new KEYWORD_INTENTS entries.
+	Classifications are memoized, since most texts are one of a handful of bodies.
+	"""
+	YES       = 'yes'
+	NO        = 'no'
+	MED_INFO  = 'med_info'
+	QUIT      = 'quit'
+	PAUSE     = 'pause'
+	RESUME    = 'resume'
+	OPTION    = 'option'
+	TIME      = 'time'
+	UNKNOWN   = 'unknown'
+
+	KEYWORD_INTENTS = {
+		'y':      YES,
+		'yes':    YES,
+		'n':      NO,
+		'no':     NO,
+		'm':      MED_INFO,
+		'info':   MED_INFO,
+		'q':      QUIT,
+		'quit':   QUIT,
+		'p':      PAUSE,
+		'pause':  PAUSE,
+		'r':      RESUME,
+		'resume': RESUME,
+	}
+
+	# A single letter that isn't a keyword picks a questionnaire option
+	OPTION_RE = re.compile(r"^[a-z]$")
+	TIME_RES = [
+		re.compile(r"^(?P<hour>[0-9]{1,2})(:)?(?P<minute>[0-9][0-9])(\s)?(?P<ampm>am|pm)?$"),
+		re.compile(r"^(?P<hour>[0-9]{1,2})(\s)?(?P<ampm>am|pm)?$"),
+	]
+
+	MAX_MEMOIZED_RESPONSES = 1024
+
+	def __init__(self):
+		self.classified_responses = {}
+
+	def normalize(self, response):
+		return response.strip().lower()
+
+	def classify(self, response):
+		"""
+		Returns the ClassifiedResponse of inbound text body <response>
+		"""
+		classified_response = self.classified_responses.get(response)
+		if classified_response is None:
+			classified_response = self._classify(self.normalize(response))
+			if len(self.classified_responses) >= self.MAX_MEMOIZED_RESPONSES:
+				self.classified_responses.clear()
+			self.classified_responses[response] = classified_response
+		return classified_response
+
+	def _classify(self, normalized_response):
+		intent = self.KEYWORD_INTENTS.get(normalized_response)
+		if intent:
+			return ClassifiedResponse(intent, None, None)
+		if self.OPTION_RE.match(normalized_response):
+			return ClassifiedResponse(self.OPTION, normalized_response.upper(), None)
+		time = self._parse_time(normalized_response)
+		if time is not None:
+			return ClassifiedResponse(self.TIME, None, time)
+		return ClassifiedResponse(self.UNKNOWN, None, None)
+
+	def _parse_time(self, normalized_response):
+		"""
+		Returns the datetime.time in a reply such as "9am", "10:27 pm" or "1027", or None.
+		Hours past 12 are rejected, with or without am/pm.
+		"""
+		for time_re in self.TIME_RES:
+			formatted_time = time_re.match(normalized_response)
+			if formatted_time:
+				break
+		else:
+			return None
+
+		hours = int(formatted_time.group('hour'))
+		minute = formatted_time.groupdict().get('minute')
+		minutes = int(minute) if minute else 0
+		if hours > 12 or minutes >= 60:
+			return None
+		if formatted_time.group('ampm') == 'pm' and hours < 12:
+			hours += 12
+		return datetime.time(hour=hours, minute=minutes)
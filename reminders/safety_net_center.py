@@ -1,83 +1,138 @@
-from django.template.loader import render_to_string
+from django.db.models import Count, Sum
+from django.template.defaultfilters import floatformat
+from django.utils.html import escape
 
+from common.message_templates import render_message
 from patients.models import PatientProfile, SafetyNetRelationship
-from reminders.models import Notification, Feedback
+from reminders.models import Notification, Feedback, AdherenceRollup
 
 import datetime
 
 class SafetyNetCenter(object):
 
+	# Stands in for the patient's first name when safety net messages are rendered,
+	# so one rendering can be shared by every patient. See Unicode private use areas
+	PATIENT_FIRST_NAME_PLACEHOLDER = u'\uE004'
+
 	def __init__(self, 
 		window=datetime.timedelta(days=7), 
-		threshold=0.8, timeout=datetime.timedelta(hours=4)):
+		threshold=0.8, timeout=datetime.timedelta(hours=4), batch_size=1000):
 		self.window = window
 		self.threshold = threshold
 		self.timeout =  timeout
+		self.batch_size = batch_size
 
-	def _compute_adherence_percentage_by_patients(self, window_start, window_finish, time, timeout):
+	def _compute_dose_counts_by_patients(self, window_start, window_finish, time, timeout):
 		"""
-		Returns a list of [patient, missed_dose] tuples for doses missed between 
-		window_start and window_finish at time time. A dose is considered missed 
-		if it's gone unacknowledged for longer than timeout.
+		Returns a dict mapping patient id to a [dose_count, acked_dose_count] pair for 
+		safety-net doses sent between window_start and window_finish, as of time time.
+		Doses sent less than timeout ago are not counted yet, whether acknowledged or not.
+		Whole days inside the window are summed from the adherence rollups, which
+		AdherenceRollup.objects.record_timed_out_doses must have brought up to date; the
+		partial days at either end are counted from feedback. One query each.
 		"""
+		window_finish = min(window_finish, time - timeout)
+		first_whole_day = window_start.date() + datetime.timedelta(days=1)
+		last_day = window_finish.date()
+
+		dose_counts_by_patients = {}
+		if first_whole_day < last_day:
+			rollups = AdherenceRollup.objects.filter(
+				date__gte=first_whole_day,
+				date__lt=last_day,
+				prescription__safety_net_on=True)
+			grouped_rollups = rollups.order_by().values_list('patient').annotate(
+				Sum('dose_count'), Sum('acked_dose_count'))
+			for (patient_id, dose_count, acked_dose_count) in grouped_rollups:
+				dose_counts_by_patients[patient_id] = [dose_count, acked_dose_count]
+
 		feedback = Feedback.objects.filter(
 			datetime_sent__gte=window_start,
 			datetime_sent__lte=window_finish,
-			notification___type=Notification.MEDICATION).exclude(datetime_sent__gte=time - timeout)
-		# Cache reminder_time for quick reminder_time__reminder_type and reminder_time__patient lookup
-		feedback = feedback.prefetch_related('notification').prefetch_related('notification__prescription')
+			_type=Feedback.MEDICATION,
+			prescription__safety_net_on=True)
+		if first_whole_day < last_day:
+			feedback = feedback.exclude(
+				datetime_sent__gte=datetime.datetime.combine(first_whole_day, datetime.time.min),
+				datetime_sent__lt=datetime.datetime.combine(last_day, datetime.time.min))
+		grouped_feedback = feedback.order_by().values_list(
+			'prescription__patient', 'completed').annotate(dose_count=Count('id'))
+		for (patient_id, completed, dose_count) in grouped_feedback:
+			dose_counts = dose_counts_by_patients.setdefault(patient_id, [0, 0])
+			dose_counts[0] += dose_count
+			if completed:
+				dose_counts[1] += dose_count
 
-		patients = PatientProfile.objects.all()
-		if patients == None:
-			return
-		adherence_percentage_for_patients_list = []
-		for patient in patients:
-			dose_count = 0
-			acked_dose_count = 0
-			patient_feedback = feedback.filter(notification__to=patient)
-			for patient_reminder in patient_feedback:
-				if patient_reminder.prescription.safety_net_on:
-					dose_count += 1
-					if patient_reminder.completed == True:
-						acked_dose_count += 1
-			if dose_count != 0:
-				adherence_percentage_for_patients_list.append(
-					[patient, float(acked_dose_count)/float(dose_count)])
-		return adherence_percentage_for_patients_list
+		return dict((patient_id, dose_counts)
+		            for (patient_id, dose_counts) in dose_counts_by_patients.iteritems() if dose_counts[0])
+
+	def _compute_adherence_percentage_by_patients(self, window_start, window_finish, time, timeout):
+		"""
+		Returns a dict mapping patient id to the fraction of safety-net doses acknowledged
+		between window_start and window_finish at time time, for every patient with at 
+		least one such dose. A dose is considered missed if it's gone unacknowledged for 
+		longer than timeout.
+		"""
+		dose_counts_by_patients = self._compute_dose_counts_by_patients(
+			window_start, window_finish, time, timeout)
+		return dict((patient_id, float(acked_dose_count)/float(dose_count))
+		            for patient_id, (dose_count, acked_dose_count) in dose_counts_by_patients.iteritems())
+
+	def _render_safety_net_message(self, template, rendered_messages, patient, relationship, 
+		adherence_percentage, threshold):
+		"""
+		Renders safety net message template for patient. The template is rendered once per
+		distinct (template, relationship, gender, rounded adherence percentage) and cached in
+		rendered_messages with a placeholder in place of the patient's first name.
+		"""
+		adherence_percentage = adherence_percentage*100 #Multiply by 100 for formatting in the template
+		key = (template, relationship, patient.gender, floatformat(adherence_percentage, "0"))
+		if key not in rendered_messages:
+			dictionary = {
+			'adherence_percentage':adherence_percentage, 
+			'threshold':threshold*100, #Multiply by 100 for comparing with adherence_percentage
+			'patient_first':self.PATIENT_FIRST_NAME_PLACEHOLDER,
+			'patient_gender':patient.gender,
+			'patient_relationship':relationship,
+			}
+			rendered_messages[key] = render_message(template, dictionary)
+		return rendered_messages[key].replace(self.PATIENT_FIRST_NAME_PLACEHOLDER, escape(patient.first_name))
 
 	def _schedule_safety_net_messages_from_adherence_percentage_list(self, 
-		adherence_percentage_by_patients_list, threshold):
+		adherence_percentage_by_patients, threshold):
 		"""
 		Schedules notifications to safety net members.
+		adherence_percentage_by_patients maps patient ids to adherence percentages
 		threshold is a threshold we use to calculate the cutoff of the adherence message to a patient
+		Patients are processed in batches of batch_size, each costing one query to fetch
+		safety net relationships and one to create notifications.
 		"""
-		if adherence_percentage_by_patients_list == None:
+		if not adherence_percentage_by_patients:
 			return
 
-		for adherence_percentage_by_patient in adherence_percentage_by_patients_list:
-			patient = adherence_percentage_by_patient[0]
-			adherence_percentage = adherence_percentage_by_patient[1]
-			# render prescriptions to template
-			dictionary = {
-			'adherence_percentage':adherence_percentage*100, #Multiply by 100 for formatting in the template
-			'threshold':threshold*100, #Multiply by 100 for comparing with adherence_percentage
-			'patient_first':patient.first_name,
-			'patient_gender':patient.gender
-			}
-			safety_net_contacts = patient.safety_net_contacts.all()
-			for safety_net_contact in safety_net_contacts:
-				dictionary['patient_relationship'] = \
-					SafetyNetRelationship.objects.get(source_patient=patient,
-						target_patient=safety_net_contact).target_to_source_relationship
+		rendered_messages = {}
+		patient_ids = sorted(adherence_percentage_by_patients.keys())
+		for batch_start in range(0, len(patient_ids), self.batch_size):
+			relationships = SafetyNetRelationship.objects.filter(
+				source_patient__in=patient_ids[batch_start:batch_start + self.batch_size]
+			).select_related('source_patient', 'target_patient')
+
+			notifications = []
+			for relationship in relationships:
+				patient = relationship.source_patient
+				adherence_percentage = adherence_percentage_by_patients[patient.pk]
 				if adherence_percentage > threshold:
-					message_body = render_to_string('messages/safety_net_message_adherent.txt', dictionary)
+					template = 'messages/safety_net_message_adherent.txt'
 				else:
-					message_body = render_to_string('messages/safety_net_message_nonadherent.txt', dictionary)
-				Notification.objects.create(to=safety_net_contact, _type=Notification.SAFETY_NET,
-				                            repeat=Notification.NO_REPEAT,
-				                            content=message_body,
-				                            adherence_rate=adherence_percentage,
-				                            patient_of_safety_net=patient)
+					template = 'messages/safety_net_message_nonadherent.txt'
+				message_body = self._render_safety_net_message(template, rendered_messages, patient,
+					relationship.target_to_source_relationship, adherence_percentage, threshold)
+				notifications.append(Notification(to=relationship.target_patient, _type=Notification.SAFETY_NET,
+				                                  repeat=Notification.NO_REPEAT,
+				                                  content=message_body,
+				                                  adherence_rate=adherence_percentage,
+				                                  patient_of_safety_net=patient))
+			Notification.objects.bulk_create(notifications)
 
 	def schedule_safety_net_messages(self, window_start, window_finish, threshold, timeout):
 		"""
@@ -91,9 +146,9 @@ class SafetyNetCenter(object):
 		if threshold < 0 or threshold > 1:
 			raise Exception("0 <= threshold <= 1 must be true")
 
-		adherence_percentage_by_patients_list = \
+		adherence_percentage_by_patients = \
 			self._compute_adherence_percentage_by_patients(
 				window_start, window_finish, datetime.datetime.now(), timeout)
 
 		self._schedule_safety_net_messages_from_adherence_percentage_list(
-			adherence_percentage_by_patients_list, threshold)
+			adherence_percentage_by_patients, threshold)
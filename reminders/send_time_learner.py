@@ -0,0 +1,105 @@
+import datetime
+
+from django.db import connection, transaction
+
+from configs.dev import settings
+from patients.models import PatientProfile
+from reminders.models import Prescription, Feedback
+
+
+class SendTimeLearner(object):
+	"""
+	Learns how much later than scheduled each patient's medication reminders are best sent.
+	Every medication dose ever sent is counted by patient and the local hour it was sent at,
+	along with whether it was acknowledged within ack_window. Each hour's acknowledgement
+	rate is smoothed toward the patient's overall rate by prior_weight doses. Reminders at
+	an hour are moved to the later hour, up to max_offset_hours later, with the highest rate,
+	if it beats the scheduled hour's by at least min_improvement.
+	The offsets are stored on PatientProfile.send_time_offsets, which dispatch reads through
+	Notification.get_best_send_time.
+	"""
+	HOURS = 24
+
+	def __init__(self,
+		ack_window=datetime.timedelta(seconds=settings.SEND_TIME_ACK_WINDOW),
+		max_offset_hours=settings.SEND_TIME_MAX_OFFSET_HOURS,
+		prior_weight=settings.SEND_TIME_PRIOR_WEIGHT,
+		min_improvement=settings.SEND_TIME_MIN_IMPROVEMENT,
+		batch_size=1000):
+		self.ack_window = ack_window
+		self.max_offset_hours = max_offset_hours
+		self.prior_weight = prior_weight
+		self.min_improvement = min_improvement
+		self.batch_size = batch_size
+
+	def _compute_hourly_dose_counts(self):
+		"""
+		Returns a dict mapping patient id to a pair of lists of the medication doses sent at each
+		local hour and of those acknowledged within ack_window, from the whole feedback history
+		in a single aggregate query
+		"""
+		cursor = connection.cursor()
+		cursor.execute(
+			"SELECT p.patient_id, "
+			"EXTRACT(HOUR FROM (f.datetime_sent AT TIME ZONE %%s) AT TIME ZONE pp.timezone)::integer AS hour, "
+			"COUNT(*), "
+			"SUM(CASE WHEN f.completed AND f.datetime_responded <= f.datetime_sent + %%s THEN 1 ELSE 0 END) "
+			"FROM %s AS f JOIN %s AS p ON p.id = f.prescription_id JOIN %s AS pp ON pp.%s = p.patient_id "
+			"WHERE f._type = %%s GROUP BY p.patient_id, hour" % (
+				connection.ops.quote_name(Feedback._meta.db_table),
+				connection.ops.quote_name(Prescription._meta.db_table),
+				connection.ops.quote_name(PatientProfile._meta.db_table),
+				connection.ops.quote_name(PatientProfile._meta.pk.column)),
+			[settings.TIME_ZONE, self.ack_window, Feedback.MEDICATION])
+
+		dose_counts = {}
+		for (patient_id, hour, dose_count, acked_dose_count) in cursor.fetchall():
+			counts = dose_counts.setdefault(patient_id, ([0] * self.HOURS, [0] * self.HOURS))
+			counts[0][hour] += dose_count
+			counts[1][hour] += acked_dose_count
+		return dose_counts
+
+	def compute_offsets(self, dose_counts, acked_dose_counts):
+		"""
+		Returns the minutes reminders sent at each local hour are best delayed by, given the
+		doses sent and acknowledged at each hour
+		"""
+		total_dose_count = sum(dose_counts)
+		if not total_dose_count:
+			return [0] * self.HOURS
+		prior = float(sum(acked_dose_counts)) / total_dose_count
+		rates = [(acked_dose_count + prior * self.prior_weight) / (dose_count + self.prior_weight)
+		         for (dose_count, acked_dose_count) in zip(dose_counts, acked_dose_counts)]
+		offsets = []
+		for hour in range(self.HOURS):
+			best_delay = max(range(self.max_offset_hours + 1),
+			                 key=lambda delay: (rates[(hour + delay) % self.HOURS], -delay))
+			if rates[(hour + best_delay) % self.HOURS] - rates[hour] < self.min_improvement:
+				best_delay = 0
+			offsets.append(best_delay * 60)
+		return offsets
+
+	def train(self):
+		"""
+		Relearns the send time offsets of every patient with medication doses, writing them
+		back in batches of batch_size. Returns the number of patients trained.
+		"""
+		offsets_by_patients = []
+		for patient_id, (dose_counts, acked_dose_counts) in self._compute_hourly_dose_counts().iteritems():
+			offsets = self.compute_offsets(dose_counts, acked_dose_counts)
+			# Patients whose reminders are best sent on time store nothing
+			send_time_offsets = ",".join(str(offset) for offset in offsets) if any(offsets) else ""
+			offsets_by_patients.append((patient_id, send_time_offsets))
+
+		table = connection.ops.quote_name(PatientProfile._meta.db_table)
+		pk_column = connection.ops.quote_name(PatientProfile._meta.pk.column)
+		cursor = connection.cursor()
+		with transaction.atomic():
+			for start in range(0, len(offsets_by_patients), self.batch_size):
+				batch = offsets_by_patients[start:start + self.batch_size]
+				cursor.execute(
+					"UPDATE %s AS pp SET send_time_offsets = v.send_time_offsets "
+					"FROM (VALUES %s) AS v(id, send_time_offsets) WHERE pp.%s = v.id" % (
+						table, ", ".join(["(%s, %s)"] * len(batch)), pk_column),
+					[value for row in batch for value in row])
+		return len(offsets_by_patients)
@@ -0,0 +1,7 @@
+-- Partial indexes on active notifications for the reminder tick (NotificationManager.notifications_at_time).
+-- Sent one-shot notifications are never read again, so they are left out of both.
+-- syncdb creates these with the table; on an existing database, run: manage.py upgrade_schema
+-- Due notifications, found by send_datetime
+CREATE INDEX reminders_notification_active_send_datetime ON reminders_notification (send_datetime) WHERE active;
+-- Each due recipient's latest due notification and look-ahead window
+CREATE INDEX reminders_notification_active_to_send_datetime ON reminders_notification (to_id, send_datetime) WHERE active;
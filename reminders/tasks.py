@@ -1,24 +1,57 @@
 # Tasks that will be executed by Celery.
 from __future__ import absolute_import
 
-import datetime
+import datetime, time, zlib
 import common.datasources as datasources
 
-from django.conf import Settings
+from configs.dev import settings
 from django.template.loader import render_to_string
+from django.core.cache import cache
+from django.db import transaction
+from django.http import HttpResponseServerError
 from django.db.models import Q
 
+from common.message_templates import get_message_templates
 from common.models import UserProfile
+from common.sms_transport import RateLimiter
+from common.utilities import SMSLogger, advisory_lock, resolve_server_is_dst, sendTextMessageToNumber
 from doctors.models import DoctorProfile
 from patients.models import PatientProfile, SafetyNetRelationship
-from reminders.models import Notification, Message
-from reminders.notification_center import NotificationCenter
+from reminders.models import Notification, Message, AdherenceRollup, InboundMessage, DispatchCursor
+from reminders.notification_center import NotificationCenter, DispatchRecordBatch
+from reminders.response_center import ResponseCenter
 from reminders.safety_net_center import SafetyNetCenter
+from reminders.send_time_learner import SendTimeLearner
 
 from celery import shared_task
+from celery.signals import task_postrun, worker_process_init
+from celery.utils.log import get_task_logger
+
+logger = get_task_logger(__name__)
+
+@worker_process_init.connect
+def load_message_templates(**kwargs):
+	# Compile the message templates before the first task, not during it
+	get_message_templates()
+
+@task_postrun.connect
+def flush_message_log(**kwargs):
+	# Worker children can exit without running atexit handlers, so don't leave lines buffered
+	SMSLogger.flush()
 
 FAKE_CSV = False # Use fake patient csv data for 
 
+# Advisory lock key for reminder dispatch. Subkey 0 is the beat tick, subkey n+1 is shard n
+SEND_REMINDERS_LOCK_ID = 7301
+# DispatchCursor names of the last minute reminders were sent up to, unsharded and by shard
+SEND_REMINDERS_CURSOR_NAME = 'reminders.send_reminders'
+SEND_REMINDERS_SHARD_CURSOR_NAME = 'reminders.send_reminders.shard.%d.%d'
+SEND_REMINDERS_METRICS_KEY = 'reminders.send_reminders.metrics'
+# Advisory lock key for processing inbound texts; the subkey is the CRC32 of the sender's number
+PROCESS_INBOUND_MESSAGES_LOCK_ID = 7302
+# Pending inbound texts older than this many seconds are assumed to have lost their task
+PENDING_INBOUND_MESSAGE_GRACE_PERIOD = 60
+
 # @shared_task()
 def fetch_new_patient_records(source="fake_csv"):
 	"""
@@ -30,41 +63,173 @@ def fetch_new_patient_records(source="fake_csv"):
 		print "Fetched new patient records"
 
 
-def sendRemindersAtDatetime(datetime, patient=None):
+def get_dispatch_rate(recipient_count, spread_sec, shard_count=1):
+	"""
+	Returns the recipients per second that spreads <recipient_count> recipients over <spread_sec>
+	seconds, capped at a shard's share of the provider's SMS_TRANSPORT_GLOBAL_RATE.
+	Returns None if sends shouldn't be paced. Recipients still left when spread_sec is up
+	are sent unpaced by sendRemindersAtDatetime, so a tick never runs long past its window.
+	"""
+	if spread_sec <= 0 or recipient_count <= 1:
+		return None
+	provider_rate = float(settings.SMS_TRANSPORT_GLOBAL_RATE) / shard_count
+	return min(recipient_count / float(spread_sec), provider_rate)
+
+def sendRemindersAtDatetime(datetime, patient=None, shard=0, shard_count=1, spread_sec=0,
+	hold_until_best_send_time=True):
 	"""
 	Called from scheduler.
 	Sends reminders to users who have a reminder between this time and this time - REMINDER_INTERVAL
 	If patient is not None, only send reminders to that patient
+	If shard_count > 1, only send reminders to patients in shard <shard>
+	If spread_sec > 0, paces the sends to patients over at most that many seconds (see get_dispatch_rate)
+	If hold_until_best_send_time, patients whose due reminders are all best sent later
+	(see Notification.get_best_send_time) are left for a later tick
+	Returns the number of patients reminders were sent to
+	"""
+	recipient_groups = Notification.objects.notifications_at_time_by_recipient(
+		datetime, patient=patient, shard=shard, shard_count=shard_count,
+		now_is_dst=resolve_server_is_dst(datetime))
+
+	# Send a reminder to each patient with the pills they need to take,
+	# writing the records in bulk after every REMINDER_DISPATCH_FLUSH_SIZE patients.
+	# Patients are paced as a whole, so their merged reminders still go out together.
+	dispatch_rate = get_dispatch_rate(len(recipient_groups), spread_sec, shard_count)
+	rate_limiter = RateLimiter(dispatch_rate) if dispatch_rate else None
+	spread_deadline = time.time() + spread_sec
+	nc = NotificationCenter(record_batch=DispatchRecordBatch())
+	sent_count = 0
+	try:
+		for p, p_reminders in recipient_groups:
+			if hold_until_best_send_time and min(
+				n.get_best_send_time() for n in p_reminders if n.send_datetime <= datetime) > datetime:
+				continue
+			if rate_limiter and time.time() < spread_deadline and not rate_limiter.try_acquire():
+				# Record what's been sent before waiting, so replies during the wait find their message
+				nc.record_batch.flush()
+				rate_limiter.acquire()
+			nc.send_notifications(to=p, notifications=p_reminders)
+			sent_count += 1
+			if sent_count % settings.REMINDER_DISPATCH_FLUSH_SIZE == 0:
+				nc.record_batch.flush()
+	finally:
+		nc.record_batch.flush()
+	return sent_count
+
+def get_catch_up_datetimes(last_tick_datetime, now):
+	"""
+	Returns the datetimes reminders should be sent at to catch up from the last completed
+	tick at last_tick_datetime to now, in steps of REMINDER_CATCH_UP_WINDOW seconds.
+	Never reaches back further than MESSAGE_CUTOFF_HOURS; the first window still picks up
+	every older reminder, since notifications_at_time includes everything due before it.
 	"""
-	reminders_for_now = Notification.objects.notifications_at_time(datetime)
+	window = datetime.timedelta(seconds=settings.REMINDER_CATCH_UP_WINDOW)
+	if last_tick_datetime is None or last_tick_datetime >= now - window:
+		return [now]
+	cutoff_datetime = now - datetime.timedelta(hours=settings.MESSAGE_CUTOFF_HOURS)
+	send_datetime = max(last_tick_datetime, cutoff_datetime) + window
+	send_datetimes = []
+	while send_datetime < now:
+		send_datetimes.append(send_datetime)
+		send_datetime += window
+	send_datetimes.append(now)
+	return send_datetimes
 
-	if patient is not None:
-		reminders_for_now = reminders_for_now.filter(to=patient)
-	# Get reminders that are distinct by patients
-	distinct_reminders = reminders_for_now.distinct('to')
+def send_reminders_catching_up(now, cursor_name, shard=0, shard_count=1, spread_sec=0):
+	"""
+	Sends reminders at each of the catch-up datetimes from the DispatchCursor <cursor_name>
+	up to now (see get_catch_up_datetimes), advancing the cursor as each completes.
+	Only now's sends are paced over spread_sec; catch-up batches are already late.
+	Callers hold the advisory lock guarding the cursor.
+	Returns the number of patients reminders were sent to and the number of windows
+	"""
+	send_datetimes = get_catch_up_datetimes(DispatchCursor.objects.get_datetime_completed(cursor_name), now)
+	recipient_count = 0
+	for send_datetime in send_datetimes:
+		recipient_count += sendRemindersAtDatetime(
+			send_datetime, shard=shard, shard_count=shard_count,
+			spread_sec=spread_sec if send_datetime == now else 0)
+		DispatchCursor.objects.advance(cursor_name, send_datetime)
+	return (recipient_count, len(send_datetimes))
 
-	# if not distinct_reminders:
-	# 	print "No reminders"
+def record_send_reminders_metrics(now, start_time, skipped=False, windows=0):
+	"""
+	Records tick lag (seconds between the scheduled minute and the start of the run)
+	and run duration of a sendRemindersForNow tick in the cache
+	"""
+	metrics = cache.get(SEND_REMINDERS_METRICS_KEY) or {'skipped_ticks': 0}
+	tick_datetime = now.replace(second=0, microsecond=0)
+	metrics.update({
+		'tick_datetime': tick_datetime,
+		'tick_lag_sec': (now - tick_datetime).total_seconds(),
+		'run_duration_sec': time.time() - start_time,
+		'windows': windows,
+	})
+	if skipped:
+		metrics['skipped_ticks'] += 1
+	cache.set(SEND_REMINDERS_METRICS_KEY, metrics, None)
+	logger.info("Reminder tick %s: lag %.2fs, duration %.2fs, %d windows%s",
+	            tick_datetime, metrics['tick_lag_sec'], metrics['run_duration_sec'], windows,
+	            " (skipped, previous tick still running)" if skipped else "")
+	return metrics
 
-	# Send a reminder to each patient with the pills they need to take
-	nc = NotificationCenter()
-	for reminder in distinct_reminders:
-		p = reminder.to
-		p_reminders = reminders_for_now.filter(to=p)
-		# for p_reminder in p_reminders:
-		# 	print "Type: ", p_reminder._type
-		# 	if p_reminder.prescription != None: print "Name: ", p_reminder.prescription.drug.name
-		# 	print "To: ", p_reminder.to
-		nc.send_notifications(to=p, notifications=p_reminders)
+@shared_task()
+def sendRemindersForShard(datetime, shard, shard_count, spread_sec=0):
+	"""
+	Sends reminders at datetime to the patients in shard <shard> of <shard_count>,
+	paced over spread_sec seconds, and reports the shard's throughput
+	Each shard keeps its own DispatchCursor, advanced only once its sends complete, and
+	catches up from it first, so a skipped, failed or lost shard run is made up next time
+	Skips the shard if a previous run for the same shard is still in progress
+	"""
+	with advisory_lock(SEND_REMINDERS_LOCK_ID, shard + 1) as acquired:
+		if not acquired:
+			logger.warning("Skipping shard %d/%d: previous run still in progress", shard, shard_count)
+			return None
+		start_time = time.time()
+		(recipient_count, windows) = send_reminders_catching_up(
+			datetime, SEND_REMINDERS_SHARD_CURSOR_NAME % (shard, shard_count),
+			shard=shard, shard_count=shard_count, spread_sec=spread_sec)
+		elapsed_sec = time.time() - start_time
+	recipients_per_sec = recipient_count / elapsed_sec if elapsed_sec > 0 else 0.0
+	logger.info("Shard %d/%d sent reminders to %d patients in %.2fs (%.1f patients/s)",
+	            shard, shard_count, recipient_count, elapsed_sec, recipients_per_sec)
+	return {'shard': shard,
+	        'shard_count': shard_count,
+	        'recipient_count': recipient_count,
+	        'windows': windows,
+	        'elapsed_sec': elapsed_sec,
+	        'recipients_per_sec': recipients_per_sec}
 
 @shared_task()
 def sendRemindersForNow():
 	"""
 	Called from scheduler. 
 	Sends reminders to all users who have a reminder between this time and this time - REMINDER_INTERVAL
+	If REMINDER_DISPATCH_SHARDS > 1, fans out one sendRemindersForShard subtask per shard,
+	each of which catches up on its own
+	Ticks that overlap a tick still in progress are skipped; the next tick catches up on
+	the missed time in REMINDER_CATCH_UP_WINDOW batches. The last minute sent up to is
+	kept in a DispatchCursor, so the catch-up holds whichever worker runs the tick
+	The tick's own sends are paced over REMINDER_SEND_SPREAD_WINDOW; catch-up batches,
+	which are already late, are not
 	"""
+	start_time = time.time()
 	now = datetime.datetime.now()
-	sendRemindersAtDatetime(now)
+	with advisory_lock(SEND_REMINDERS_LOCK_ID) as acquired:
+		if not acquired:
+			return record_send_reminders_metrics(now, start_time, skipped=True)
+
+		shard_count = settings.REMINDER_DISPATCH_SHARDS
+		if shard_count > 1:
+			# The shards' windows are reported by the shards themselves
+			windows = 0
+			for shard in range(shard_count):
+				sendRemindersForShard.delay(now, shard, shard_count, settings.REMINDER_SEND_SPREAD_WINDOW)
+		else:
+			(recipient_count, windows) = send_reminders_catching_up(
+				now, SEND_REMINDERS_CURSOR_NAME, spread_sec=settings.REMINDER_SEND_SPREAD_WINDOW)
+	return record_send_reminders_metrics(now, start_time, windows=windows)
 
 @shared_task()
 def schedule_safety_net_messages():
@@ -74,8 +239,89 @@ def schedule_safety_net_messages():
 	"""
 	snc = SafetyNetCenter()
 	now = datetime.datetime.now()
+	# Adherence is read from the rollups, so count the doses that have timed out since the last sweep
+	AdherenceRollup.objects.record_timed_out_doses(now - snc.timeout)
 	snc.schedule_safety_net_messages(
 		window_start=now - snc.window, 
 		window_finish=now, 
 		threshold=snc.threshold, 
-		timeout=snc.timeout)
\ No newline at end of file
+		timeout=snc.timeout)
+
+@shared_task()
+def train_send_time_offsets():
+	"""
+	Called nightly from scheduler.
+	Relearns every patient's medication reminder send time offsets from their dose history
+	"""
+	patient_count = SendTimeLearner().train()
+	logger.info("Trained send time offsets of %d patients", patient_count)
+	return patient_count
+
+@shared_task()
+def rollup_timed_out_doses():
+	"""
+	Called from scheduler.
+	Counts doses that have gone unacknowledged for longer than the safety net timeout
+	as missed in the adherence rollups
+	"""
+	snc = SafetyNetCenter()
+	dose_count = AdherenceRollup.objects.record_timed_out_doses(datetime.datetime.now() - snc.timeout)
+	logger.info("Rolled up %d doses", dose_count)
+	return dose_count
+
+@shared_task()
+def delete_expired_inbound_messages():
+	"""
+	Called hourly from scheduler.
+	Deletes inbound message ledger entries that are past their TTL
+	"""
+	expired_count = InboundMessage.objects.delete_expired(datetime.datetime.now())
+	logger.info("Deleted %d expired inbound messages", expired_count)
+	return expired_count
+
+def process_inbound_message(inbound_message, response_center):
+	"""
+	Processes an inbound text recorded by InboundMessage.objects.receive and texts the
+	reply back to the sender. A text that fails to process is recorded with a 500 response,
+	so it doesn't hold up later texts from the same sender.
+	"""
+	patient = PatientProfile.objects.get_by_phone_number(inbound_message.from_number)
+	try:
+		with transaction.atomic():
+			response = response_center.process_response(patient, inbound_message.body)
+	except Exception:
+		logger.exception("Failed to process inbound text %s", inbound_message.sid)
+		response = HttpResponseServerError()
+	inbound_message.record_response(response)
+	if response is not None and response.status_code == 200 and response.content:
+		sendTextMessageToNumber(response.content.decode('utf-8'), inbound_message.from_number)
+
+@shared_task()
+def process_inbound_messages(from_number):
+	"""
+	Processes every pending inbound text from from_number in the order they were received.
+	Only one worker at a time processes texts from a number, so each text is applied to
+	the conversation state left by the one before it. Returns the number of texts processed.
+	"""
+	response_center = ResponseCenter()
+	processed_count = 0
+	with advisory_lock(PROCESS_INBOUND_MESSAGES_LOCK_ID, zlib.crc32(from_number), wait=True):
+		for inbound_message in InboundMessage.objects.pending_for_number(from_number):
+			process_inbound_message(inbound_message, response_center)
+			processed_count += 1
+	return processed_count
+
+@shared_task()
+def process_pending_inbound_messages():
+	"""
+	Called every minute from scheduler.
+	Queues processing for senders whose inbound texts have been pending for longer than
+	PENDING_INBOUND_MESSAGE_GRACE_PERIOD, e.g. because their task was lost
+	"""
+	cutoff_datetime = datetime.datetime.now() - datetime.timedelta(seconds=PENDING_INBOUND_MESSAGE_GRACE_PERIOD)
+	from_numbers = InboundMessage.objects.filter(
+		datetime_processed=None, datetime_received__lt=cutoff_datetime
+	).order_by().values_list('from_number', flat=True).distinct()
+	for from_number in from_numbers:
+		process_inbound_messages.delay(from_number)
+	return len(from_numbers)
@@ -0,0 +1,152 @@
+import datetime
+
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TestCase, Client
+
+from common.models import Drug
+from doctors.models import DoctorProfile
+from patients.models import PatientProfile
+from reminders.models import Prescription, Notification, Message, Feedback, AdherenceRollup
+from reminders.response_center import ResponseCenter
+
+from guardian.shortcuts import assign_perm
+
+
+class AdherenceRollupTest(TestCase):
+	def setUp(self):
+		self.now = datetime.datetime.now()
+		self.cutoff = self.now - datetime.timedelta(hours=4)
+		self.doctor = DoctorProfile.objects.create(first_name="Bob", last_name="Wachter",
+		                                           primary_phone_number="2029163381", birthday=datetime.date(1960, 1, 1))
+		self.drug = Drug.objects.create(name='advil')
+		self.minqi = PatientProfile.objects.create(first_name="Minqi", last_name="Jiang",
+		                                           primary_phone_number="8569067308",
+		                                           gender=PatientProfile.MALE)
+		self.prescription = Prescription.objects.create(prescriber=self.doctor, patient=self.minqi,
+		                                                drug=self.drug, filled=True, safety_net_on=True)
+		self.notification = Notification.objects.create(to=self.minqi, _type=Notification.MEDICATION,
+		                                                prescription=self.prescription, repeat=Notification.DAILY,
+		                                                send_datetime=self.now)
+
+	def create_feedback(self, hours_ago, completed=False):
+		feedback = Feedback.objects.create(_type=Feedback.MEDICATION, notification=self.notification,
+		                                   prescription=self.prescription, completed=completed)
+		Feedback.objects.filter(pk=feedback.pk).update(
+			datetime_sent=self.now - datetime.timedelta(hours=hours_ago))
+		return Feedback.objects.get(pk=feedback.pk)
+
+	def get_counts(self, feedback):
+		rollup = AdherenceRollup.objects.get(prescription=self.prescription, date=feedback.datetime_sent.date())
+		return [rollup.dose_count, rollup.acked_dose_count]
+
+	def test_record_acked_doses(self):
+		feedback = self.create_feedback(hours_ago=1)
+		AdherenceRollup.objects.record_acked_doses([feedback.pk], self.now)
+		self.assertEqual(self.get_counts(feedback), [1, 1])
+		feedback = Feedback.objects.get(pk=feedback.pk)
+		self.assertTrue(feedback.completed)
+		self.assertTrue(feedback.rolled_up)
+		self.assertEqual(feedback.datetime_responded, self.now)
+
+		# Acknowledging the same dose twice doesn't count it twice
+		AdherenceRollup.objects.record_acked_doses([feedback.pk], self.now)
+		self.assertEqual(self.get_counts(feedback), [1, 1])
+		# Nor does the timeout sweep
+		self.assertEqual(AdherenceRollup.objects.record_timed_out_doses(self.now), 0)
+		self.assertEqual(self.get_counts(feedback), [1, 1])
+
+	def test_record_timed_out_doses(self):
+		missed = self.create_feedback(hours_ago=5)
+		pending = self.create_feedback(hours_ago=1)
+		self.assertEqual(AdherenceRollup.objects.record_timed_out_doses(self.cutoff), 1)
+		self.assertEqual(self.get_counts(missed), [1, 0])
+		self.assertFalse(Feedback.objects.get(pk=pending.pk).rolled_up)
+
+		# A late acknowledgement turns a missed dose into an acknowledged one
+		AdherenceRollup.objects.record_acked_doses([missed.pk], self.now)
+		self.assertEqual(self.get_counts(missed), [1, 1])
+
+	def test_process_medication_response_yes_updates_rollup(self):
+		feedback = self.create_feedback(hours_ago=1)
+		message = Message.objects.create(to=self.minqi, _type=Message.MEDICATION, nth_message_of_day_of_type=0)
+		message.feedbacks.add(feedback)
+		ResponseCenter().process_medication_response(self.minqi, message, "y")
+		self.assertEqual(self.get_counts(feedback), [1, 1])
+
+	def test_rebuild_and_find_inconsistencies(self):
+		acked = self.create_feedback(hours_ago=30, completed=True)
+		self.create_feedback(hours_ago=30)
+		self.create_feedback(hours_ago=1)
+		self.assertEqual(AdherenceRollup.objects.rebuild(self.cutoff), 1)
+		self.assertEqual(self.get_counts(acked), [2, 1])
+		self.assertEqual(AdherenceRollup.objects.find_inconsistencies(), [])
+
+		AdherenceRollup.objects.update(acked_dose_count=2)
+		self.assertEqual(AdherenceRollup.objects.find_inconsistencies(),
+		                 [(self.minqi.pk, self.prescription.pk, acked.datetime_sent.date(), [2, 1], [2, 2])])
+		self.assertRaises(CommandError, call_command, 'check_adherence_rollups')
+		call_command('backfill_adherence_rollups', timeout_hours=4)
+		call_command('check_adherence_rollups')
+		self.assertEqual(self.get_counts(acked), [2, 1])
+
+
+class AdherenceHistoryCsvTest(TestCase):
+	def setUp(self):
+		self.client_user = PatientProfile.objects.create(
+			first_name='Test', last_name='User', primary_phone_number='+10000000000')
+		self.client_user.set_password('testpassword')
+		self.client_user.save()
+		self.client = Client()
+		self.client.login(phone_number='+10000000000', password='testpassword')
+
+		doctor = DoctorProfile.objects.create(first_name="Bob", last_name="Wachter",
+		                                      primary_phone_number="2029163381", birthday=datetime.date(1960, 1, 1))
+		drug = Drug.objects.create(name='advil')
+		self.minqi = PatientProfile.objects.create(first_name="Minqi", last_name="Jiang",
+		                                           primary_phone_number="8569067308")
+		self.matt = PatientProfile.objects.create(first_name="Matt", last_name="Gaba",
+		                                          primary_phone_number="2147094720")
+		for (patient, day, dose_count, acked_dose_count) in [(self.minqi, 1, 2, 2), (self.minqi, 3, 2, 0),
+		                                                    (self.matt, 1, 2, 1)]:
+			prescription = Prescription.objects.create(prescriber=doctor, patient=patient, drug=drug)
+			AdherenceRollup.objects.create(patient=patient, prescription=prescription,
+			                               date=datetime.date(2014, 1, day),
+			                               dose_count=dose_count, acked_dose_count=acked_dose_count)
+
+	def get_csv(self, **params):
+		params.update({'start': '2014-01-01', 'end': '2014-01-04'})
+		return self.client.get('/fishfood/patients/adherence_history_csv/', params)
+
+	def test_patient_adherence_history(self):
+		self.assertEqual(self.get_csv(p_id=str(self.minqi.id)).status_code, 400)
+
+		assign_perm('manage_patientprofile', self.client_user, self.minqi)
+		response = self.get_csv(p_id=str(self.minqi.id))
+		self.assertEqual(response.status_code, 200)
+		self.assertEqual(''.join(response.streaming_content),
+		                 "date,adherence_rate,daily_adherence_rate,dose_count,acked_dose_count\n"
+		                 "1-Jan-14,1.0,1.0,2,2\n"
+		                 "2-Jan-14,1.0,,0,0\n"
+		                 "3-Jan-14,0.5,0.0,2,0\n"
+		                 "4-Jan-14,0.5,,0,0\n")
+
+	def test_panel_adherence_history(self):
+		assign_perm('manage_patientprofile', self.client_user, self.minqi)
+		assign_perm('manage_patientprofile', self.client_user, self.matt)
+		response = self.get_csv()
+		self.assertEqual(response.status_code, 200)
+		self.assertEqual(list(response.streaming_content)[1], "1-Jan-14,0.75,0.75,4,3\n")
+
+	def test_etag(self):
+		assign_perm('manage_patientprofile', self.client_user, self.minqi)
+		response = self.get_csv(p_id=str(self.minqi.id))
+		etag = response['ETag']
+		self.assertEqual(self.client.get('/fishfood/patients/adherence_history_csv/',
+		                                 {'p_id': str(self.minqi.id), 'start': '2014-01-01', 'end': '2014-01-04'},
+		                                 HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+		AdherenceRollup.objects.filter(patient=self.minqi).update(acked_dose_count=1)
+		response = self.get_csv(p_id=str(self.minqi.id))
+		self.assertEqual(response.status_code, 200)
+		self.assertNotEqual(response['ETag'], etag)
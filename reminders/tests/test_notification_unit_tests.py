@@ -1,9 +1,12 @@
-import datetime, codecs, os, sys
+import datetime, codecs, itertools, os, sys, contextlib, mock
 
+from django.core.exceptions import ValidationError
+from django.db import connection
 from django.db.models import Q
 from django.http import HttpResponse, HttpResponseNotFound
-from django.test import TestCase
+from django.test import SimpleTestCase, TestCase
 from django.test import Client
+from django.test.utils import CaptureQueriesContext
 from django.template.loader import render_to_string
 
 from configs.dev import settings
@@ -11,11 +14,12 @@ from common.models import UserProfile, Drug
 from common.utilities import SMSLogger, InterpersonalRelationship
 from doctors.models import DoctorProfile
 from patients.models import PatientProfile
-from reminders.models import Notification, Prescription, Message, Feedback
+from reminders.models import Notification, Prescription, Message, MessageCounter, Feedback, DispatchCursor
 from reminders import models as reminder_model
 from reminders import tasks as reminder_tasks
+from reminders import recurrence
 from reminders import views as reminder_views
-from reminders.notification_center import NotificationCenter
+from reminders.notification_center import NotificationCenter, DispatchRecordBatch
 from reminders.response_center import ResponseCenter
 
 from freezegun import freeze_time
@@ -64,7 +68,7 @@ class NotificationCenterTest(TestCase):
 		                                                           repeat=Notification.NO_REPEAT)
 
 	def test_merge_notifications(self):
-		merged_notifications = self.nc.merge_notifications(self.med_notifications)
+		merged_notifications = tuple(self.nc.merge_notifications(self.med_notifications))
 		ground_truth_merged_notifications = []
 		reminder_group = []
 		for reminder in self.med_notifications:
@@ -73,6 +77,14 @@ class NotificationCenterTest(TestCase):
 		ground_truth_merged_notifications = tuple(ground_truth_merged_notifications)
 		self.assertEqual(merged_notifications, ground_truth_merged_notifications)
 
+	def test_merge_notifications_in_memory(self):
+		notifications = list(self.med_notifications)
+		notifications[-1].send_datetime = self.now_datetime + datetime.timedelta(seconds=settings.REMINDER_MERGE_INTERVAL)
+		with self.assertNumQueries(0):
+			merged_notifications = list(self.nc.merge_notifications(reversed(notifications)))
+		self.assertEqual(merged_notifications, [tuple(notifications[:-1]), (notifications[-1],)])
+		self.assertEqual(list(self.nc.merge_notifications([])), [])
+
 	def test_send_message(self):
 		self.patient1.status = UserProfile.ACTIVE
 		sent_time = datetime.datetime.now()
@@ -210,6 +222,18 @@ class NotificationCenterTest(TestCase):
 		self.safetynet_notification = Notification.objects.get(pk=self.safetynet_notification.pk)
 		self.assertTrue(self.safetynet_notification.active == False)
 
+	def test_send_safetynet_notifications_packs_segments(self):
+		self.patient1.status = UserProfile.ACTIVE
+		Notification.objects.create(to=self.patient1, _type=Notification.SAFETY_NET, content="Your father was adherent",
+		                            patient_of_safety_net=self.patient2, adherence_rate=90,
+		                            repeat=Notification.NO_REPEAT, send_datetime=self.now_datetime)
+		notifications = Notification.objects.filter(to=self.patient1, _type=Notification.SAFETY_NET)
+		self.nc.send_notifications(to=self.patient1, notifications=notifications)
+		message = Message.objects.get(to=self.patient1)
+		self.assertEqual(message.content, "Your mother was adherent\n\nYour father was adherent")
+		self.assertEqual(message.segment_count, 1)
+		self.assertEqual(message.notifications.count(), 2)
+
 	def test_send_safetynet_welcome_notifications(self):
 		# # see if safetynet welcome notification is sent
 		self.patient1.status = UserProfile.ACTIVE
@@ -272,6 +296,138 @@ class NotificationCenterTest(TestCase):
 		self.nc.send_notifications(self.patient1, notification)
 		self.assertEqual(len(Message.objects.all()), 1)
 
+class DispatchRecordBatchTest(TestCase):
+	def setUp(self):
+		self.record_batch = DispatchRecordBatch()
+		self.nc = NotificationCenter(record_batch=self.record_batch)
+		self.doctor = DoctorProfile.objects.create(first_name="Bob", last_name="Watcher",
+			primary_phone_number="2029163381", birthday=datetime.date(1960, 1, 1))
+		self.drug = Drug.objects.create(name='advil')
+		self.now_datetime = datetime.datetime.now()
+		self.patients = []
+		for i in range(3):
+			patient = PatientProfile.objects.create(first_name="Patient", last_name=str(i),
+			                                        primary_phone_number="856906730" + str(i),
+			                                        status=PatientProfile.ACTIVE)
+			prescription = Prescription.objects.create(prescriber=self.doctor, patient=patient,
+			                                           drug=self.drug, filled=True)
+			Notification.objects.create(to=patient, _type=Notification.MEDICATION, prescription=prescription,
+			                            repeat=Notification.DAILY, send_datetime=self.now_datetime)
+			self.patients.append(patient)
+		# Start today's counter, so every flush below takes the same queries
+		MessageCounter.objects.reserve(datetime.date.today(), Message.MEDICATION, 0)
+
+	def test_records_are_written_on_flush(self):
+		for patient in self.patients:
+			self.nc.send_notifications(patient, list(Notification.objects.filter(to=patient)))
+		self.assertEqual(Message.objects.count(), 0)
+		self.assertEqual(Feedback.objects.count(), 0)
+		self.assertEqual([n.times_sent for n in Notification.objects.all()], [1] * len(self.patients))
+
+		self.record_batch.flush()
+		self.assertEqual(Message.objects.count(), len(self.patients))
+		self.assertEqual(Feedback.objects.count(), len(self.patients))
+		self.assertEqual(sorted(m.nth_message_of_day_of_type for m in Message.objects.all()), range(len(self.patients)))
+		for message in Message.objects.all():
+			notification = message.notifications.get()
+			self.assertEqual(notification.to, message.to)
+			self.assertEqual(message.feedbacks.get().notification, notification)
+			self.assertEqual(notification.times_sent, 1)
+			self.assertEqual((notification.send_datetime.date() - self.now_datetime.date()).days, 1)
+
+	def test_flush_query_count_is_constant(self):
+		def flush_query_count(patients):
+			for patient in patients:
+				self.nc.send_notifications(patient, list(Notification.objects.filter(to=patient)))
+			with CaptureQueriesContext(connection) as queries:
+				self.record_batch.flush()
+			return len(queries)
+		self.assertEqual(flush_query_count(self.patients[:1]), flush_query_count(self.patients[1:]))
+		with self.assertNumQueries(0):
+			self.record_batch.flush()
+
+	def test_safety_net_welcome_query_count_is_constant(self):
+		safety_net = self.patients[0]
+		for patient in self.patients[1:]:
+			patient.add_safety_net_contact(target_patient=safety_net, relationship=InterpersonalRelationship.FRIEND)
+			Notification.objects.create(to=safety_net, _type=Notification.SAFETY_NET_WELCOME,
+			                            patient_of_safety_net=patient, repeat=Notification.NO_REPEAT)
+		notifications = list(Notification.objects.filter(
+			to=safety_net, _type=Notification.SAFETY_NET_WELCOME).select_related(*Notification.DISPATCH_RELATED))
+		# One query for the relationships, however many patients the welcomes are about,
+		# and one send time update per text
+		with self.assertNumQueries(1 + 3 * len(notifications)):
+			self.nc.send_safety_net_welcome_notifications(safety_net, notifications)
+		self.record_batch.flush()
+		self.assertEqual(Message.objects.filter(to=safety_net).count(), 3 * len(notifications))
+
+	def test_dispatch_flushes_every_few_recipients(self):
+		# Records are written before later patients are texted, so replies can find their message
+		message_counts = []
+		send_notifications = NotificationCenter.send_notifications
+		def count_and_send(nc, to, notifications):
+			message_counts.append(Message.objects.count())
+			return send_notifications(nc, to=to, notifications=notifications)
+		with mock.patch.object(settings, 'REMINDER_DISPATCH_FLUSH_SIZE', 2):
+			with mock.patch.object(NotificationCenter, 'send_notifications', autospec=True,
+			                       side_effect=count_and_send):
+				reminder_tasks.sendRemindersAtDatetime(self.now_datetime)
+		self.assertEqual(message_counts, [0, 0, 2])
+		self.assertEqual(Message.objects.count(), len(self.patients))
+
+	def test_send_times_are_advanced_before_texting(self):
+		# A dispatch that dies while texting a patient resends nothing to earlier patients
+		def fail_on_second_text(body, phone_number):
+			texted_numbers.append(phone_number)
+			if len(texted_numbers) == 2:
+				raise Exception("Transport failed")
+		texted_numbers = []
+		with mock.patch('reminders.notification_center.sendTextMessageToNumber', side_effect=fail_on_second_text):
+			with self.assertRaises(Exception):
+				reminder_tasks.sendRemindersAtDatetime(self.now_datetime)
+		self.assertEqual(len(texted_numbers), 2)
+		self.assertEqual(sorted(n.times_sent for n in Notification.objects.all()), [0, 1, 1])
+		self.assertEqual(Message.objects.count(), 2)
+
+	def test_dispatch_query_count_per_recipient_is_constant(self):
+		def dispatch_query_count():
+			with CaptureQueriesContext(connection) as queries:
+				reminder_tasks.sendRemindersAtDatetime(self.now_datetime)
+			return len(queries)
+		query_count = dispatch_query_count()
+		self.assertEqual(Message.objects.count(), len(self.patients))
+
+		for i in range(3, 8):
+			patient = PatientProfile.objects.create(first_name="Patient", last_name=str(i),
+			                                        primary_phone_number="856906730" + str(i),
+			                                        status=PatientProfile.ACTIVE)
+			prescription = Prescription.objects.create(prescriber=self.doctor, patient=patient,
+			                                           drug=self.drug, filled=True)
+			Notification.objects.create(to=patient, _type=Notification.MEDICATION, prescription=prescription,
+			                            repeat=Notification.DAILY, send_datetime=self.now_datetime)
+		# One UPDATE per recipient advances their send times; everything else is written per batch
+		self.assertEqual(dispatch_query_count(), query_count + 5)
+		self.assertEqual(Message.objects.count(), 8)
+
+class MessageCounterTest(TestCase):
+	def setUp(self):
+		self.patient = PatientProfile.objects.create(first_name="Minqi", last_name="Jiang",
+		                                             primary_phone_number="8569067308")
+
+	def test_reserve(self):
+		today = datetime.date.today()
+		self.assertEqual(MessageCounter.objects.reserve(today, Message.MEDICATION, 3), 0)
+		self.assertEqual(MessageCounter.objects.reserve(today, Message.MEDICATION), 3)
+		self.assertEqual(MessageCounter.objects.reserve(today, Message.REFILL), 0)
+		self.assertEqual(MessageCounter.objects.reserve(today - datetime.timedelta(days=1), Message.MEDICATION), 0)
+		with self.assertNumQueries(1):
+			self.assertEqual(MessageCounter.objects.reserve(today, Message.MEDICATION), 4)
+
+	def test_counter_starts_after_messages_sent_today(self):
+		Message.objects.create(to=self.patient, _type=Message.WELCOME, nth_message_of_day_of_type=6)
+		self.assertEqual(Message.objects.create(to=self.patient, _type=Message.WELCOME).nth_message_of_day_of_type, 7)
+		self.assertEqual(Message.objects.create(to=self.patient, _type=Message.WELCOME).nth_message_of_day_of_type, 8)
+
 class WelcomeMessageTest(TestCase):
 	def setUp(self):
 		self.nc = NotificationCenter()
@@ -297,6 +453,190 @@ class WelcomeMessageTest(TestCase):
 		self.assertEqual(welcome_notification.active,  False)
 		self.assertEqual(self.patient1.status, PatientProfile.ACTIVE)
 
+class NotificationsAtTimeTest(TestCase):
+	def setUp(self):
+		self.now_datetime = datetime.datetime.now()
+		self.patient1 = PatientProfile.objects.create(first_name="Minqi", last_name="Jiang",
+		                                              primary_phone_number="8569067308",
+		                                              birthday=datetime.date(year=1990, month=8, day=7))
+		self.patient2 = PatientProfile.objects.create(first_name="Matt", last_name="Gaba",
+		                                              primary_phone_number="2147094720",
+		                                              birthday=datetime.date(year=1989, month=10, day=13))
+		def create_notification(to, send_datetime):
+			return Notification.objects.create(to=to, _type=Notification.STATIC_ONE_OFF, content="Test content",
+			                                   repeat=Notification.NO_REPEAT, send_datetime=send_datetime)
+		merge_interval = datetime.timedelta(seconds=reminder_model.REMINDER_MERGE_INTERVAL)
+		self.due = create_notification(self.patient1, self.now_datetime - datetime.timedelta(minutes=5))
+		self.look_ahead = create_notification(self.patient1, self.now_datetime + datetime.timedelta(minutes=30))
+		self.too_late = create_notification(self.patient1, self.now_datetime + merge_interval)
+		self.not_due = create_notification(self.patient2, self.now_datetime + datetime.timedelta(minutes=10))
+
+	def test_notifications_at_time_looks_ahead_per_recipient(self):
+		notifications = Notification.objects.notifications_at_time(self.now_datetime)
+		self.assertEqual(list(notifications), [self.due, self.look_ahead])
+
+	def test_notifications_at_time_ignores_inactive(self):
+		self.due.active = False
+		self.due.save()
+		notifications = Notification.objects.notifications_at_time(self.now_datetime)
+		self.assertEqual(list(notifications), [])
+
+	def test_notifications_at_time_by_recipient_single_query(self):
+		Notification.objects.create(to=self.patient2, _type=Notification.STATIC_ONE_OFF, content="Test content",
+		                            repeat=Notification.NO_REPEAT, send_datetime=self.now_datetime)
+		with self.assertNumQueries(1):
+			groups = Notification.objects.notifications_at_time_by_recipient(self.now_datetime)
+		self.assertEqual(len(groups), 2)
+		recipients = dict((recipient.pk, notifications) for recipient, notifications in groups)
+		self.assertEqual(recipients[self.patient1.pk], [self.due, self.look_ahead])
+		self.assertEqual(len(recipients[self.patient2.pk]), 2)
+
+class ShardedDispatchTest(TestCase):
+	def setUp(self):
+		self.now_datetime = datetime.datetime.now()
+		self.patients = []
+		for i in range(6):
+			patient = PatientProfile.objects.create(first_name="Patient", last_name=str(i),
+			                                        primary_phone_number="856906730" + str(i),
+			                                        status=PatientProfile.ACTIVE)
+			Notification.objects.create(to=patient, _type=Notification.STATIC_ONE_OFF, content="Test content",
+			                            repeat=Notification.NO_REPEAT, send_datetime=self.now_datetime)
+			self.patients.append(patient)
+
+	def test_shards_partition_recipients(self):
+		shard_count = 3
+		recipient_pks = []
+		for shard in range(shard_count):
+			groups = Notification.objects.notifications_at_time_by_recipient(
+				self.now_datetime, shard=shard, shard_count=shard_count)
+			for recipient, notifications in groups:
+				self.assertEqual(recipient.pk % shard_count, shard)
+				recipient_pks.append(recipient.pk)
+		self.assertEqual(sorted(recipient_pks), sorted(p.pk for p in self.patients))
+
+	def test_send_reminders_for_shard(self):
+		shard_count = 2
+		sent_count = 0
+		for shard in range(shard_count):
+			result = reminder_tasks.sendRemindersForShard(self.now_datetime, shard, shard_count)
+			self.assertEqual(result['shard'], shard)
+			sent_count += result['recipient_count']
+		self.assertEqual(sent_count, len(self.patients))
+		self.assertEqual(Message.objects.count(), len(self.patients))
+		self.assertFalse(Notification.objects.filter(active=True).exists())
+
+	def test_dispatch_rate(self):
+		with mock.patch.object(settings, 'SMS_TRANSPORT_GLOBAL_RATE', 30):
+			self.assertEqual(reminder_tasks.get_dispatch_rate(len(self.patients), 0), None)
+			self.assertEqual(reminder_tasks.get_dispatch_rate(1, 45), None)
+			self.assertEqual(reminder_tasks.get_dispatch_rate(90, 45), 2.0)
+			# Never faster than the provider allows, shared between shards
+			self.assertEqual(reminder_tasks.get_dispatch_rate(9000, 45), 30.0)
+			self.assertEqual(reminder_tasks.get_dispatch_rate(9000, 45, shard_count=3), 10.0)
+
+	def test_spread_sends_are_paced_per_recipient(self):
+		# Every send waits for the rate limiter, after recording the sends before it
+		message_counts = []
+		with mock.patch.object(reminder_tasks.RateLimiter, 'try_acquire', return_value=False):
+			with mock.patch.object(reminder_tasks.RateLimiter, 'acquire',
+			                       side_effect=lambda: message_counts.append(Message.objects.count())):
+				recipient_count = reminder_tasks.sendRemindersAtDatetime(self.now_datetime, spread_sec=45)
+		self.assertEqual(recipient_count, len(self.patients))
+		self.assertEqual(message_counts, range(len(self.patients)))
+		self.assertEqual(Message.objects.count(), len(self.patients))
+
+	def test_spread_sends_stop_pacing_after_spread_window(self):
+		clock = mock.Mock()
+		# 10 seconds pass between each look at the clock
+		clock.time.side_effect = itertools.count(0, 10)
+		with mock.patch.object(reminder_tasks, 'time', clock):
+			with mock.patch.object(reminder_tasks.RateLimiter, 'try_acquire', return_value=False):
+				with mock.patch.object(reminder_tasks.RateLimiter, 'acquire') as acquire:
+					reminder_tasks.sendRemindersAtDatetime(self.now_datetime, spread_sec=25)
+		self.assertEqual(acquire.call_count, 2)
+		self.assertEqual(Message.objects.count(), len(self.patients))
+
+class SendRemindersTickTest(TestCase):
+	def setUp(self):
+		self.now_datetime = datetime.datetime.now()
+		self.patient = PatientProfile.objects.create(first_name="Minqi", last_name="Jiang",
+		                                             primary_phone_number="8569067308",
+		                                             status=PatientProfile.ACTIVE)
+		Notification.objects.create(to=self.patient, _type=Notification.STATIC_ONE_OFF, content="Test content",
+		                            repeat=Notification.NO_REPEAT, send_datetime=self.now_datetime)
+
+	def test_get_catch_up_datetimes(self):
+		now = self.now_datetime
+		window = datetime.timedelta(seconds=settings.REMINDER_CATCH_UP_WINDOW)
+		self.assertEqual(reminder_tasks.get_catch_up_datetimes(None, now), [now])
+		self.assertEqual(reminder_tasks.get_catch_up_datetimes(now - window, now), [now])
+
+		last_tick = now - 3 * window - datetime.timedelta(seconds=1)
+		send_datetimes = reminder_tasks.get_catch_up_datetimes(last_tick, now)
+		self.assertEqual(send_datetimes, [last_tick + window, last_tick + 2 * window, last_tick + 3 * window, now])
+
+		# catch up never reaches back past the message cutoff
+		send_datetimes = reminder_tasks.get_catch_up_datetimes(now - datetime.timedelta(days=30), now)
+		cutoff_windows = settings.MESSAGE_CUTOFF_HOURS * 3600 / settings.REMINDER_CATCH_UP_WINDOW
+		self.assertEqual(len(send_datetimes), cutoff_windows)
+		self.assertEqual(send_datetimes[-1], now)
+
+	def test_overlapping_tick_is_skipped(self):
+		@contextlib.contextmanager
+		def held_lock(key, subkey=0):
+			yield False
+		with mock.patch('reminders.tasks.advisory_lock', held_lock):
+			metrics = reminder_tasks.sendRemindersForNow()
+		self.assertEqual(Message.objects.count(), 0)
+		self.assertGreater(metrics['skipped_ticks'], 0)
+
+	def test_tick_sends_reminders_and_records_metrics(self):
+		metrics = reminder_tasks.sendRemindersForNow()
+		self.assertEqual(Message.objects.filter(to=self.patient).count(), 1)
+		self.assertGreaterEqual(metrics['windows'], 1)
+		self.assertGreaterEqual(metrics['tick_lag_sec'], 0)
+		self.assertGreaterEqual(metrics['run_duration_sec'], 0)
+
+	def test_tick_catches_up_from_the_shared_cursor(self):
+		window = datetime.timedelta(seconds=settings.REMINDER_CATCH_UP_WINDOW)
+		DispatchCursor.objects.advance(reminder_tasks.SEND_REMINDERS_CURSOR_NAME,
+		                               self.now_datetime - 2 * window - datetime.timedelta(seconds=1))
+		with freeze_time(self.now_datetime):
+			metrics = reminder_tasks.sendRemindersForNow()
+		self.assertEqual(metrics['windows'], 3)
+		self.assertEqual(DispatchCursor.objects.get_datetime_completed(reminder_tasks.SEND_REMINDERS_CURSOR_NAME),
+		                 self.now_datetime)
+
+	def test_shards_catch_up_from_their_own_cursors(self):
+		window = datetime.timedelta(seconds=settings.REMINDER_CATCH_UP_WINDOW)
+		last_tick = self.now_datetime - 2 * window - datetime.timedelta(seconds=1)
+		for shard in range(2):
+			DispatchCursor.objects.advance(reminder_tasks.SEND_REMINDERS_SHARD_CURSOR_NAME % (shard, 2), last_tick)
+		with mock.patch.object(settings, 'REMINDER_DISPATCH_SHARDS', 2):
+			with mock.patch.object(reminder_tasks.sendRemindersForShard, 'delay') as delay:
+				with freeze_time(self.now_datetime):
+					reminder_tasks.sendRemindersForNow()
+		self.assertEqual(delay.call_args_list,
+		                 [mock.call(self.now_datetime, shard, 2, settings.REMINDER_SEND_SPREAD_WINDOW)
+		                  for shard in range(2)])
+
+		# A shard whose run is skipped doesn't move its cursor
+		@contextlib.contextmanager
+		def held_lock(key, subkey=0):
+			yield False
+		with mock.patch('reminders.tasks.advisory_lock', held_lock):
+			self.assertIsNone(reminder_tasks.sendRemindersForShard(self.now_datetime, 0, 2))
+		self.assertEqual(DispatchCursor.objects.get_datetime_completed(
+			reminder_tasks.SEND_REMINDERS_SHARD_CURSOR_NAME % (0, 2)), last_tick)
+
+		results = [reminder_tasks.sendRemindersForShard(*call[0]) for call in delay.call_args_list]
+		self.assertEqual([result['windows'] for result in results], [3, 3])
+		self.assertEqual(sum(result['recipient_count'] for result in results), 1)
+		self.assertEqual(Message.objects.filter(to=self.patient).count(), 1)
+		for shard in range(2):
+			self.assertEqual(DispatchCursor.objects.get_datetime_completed(
+				reminder_tasks.SEND_REMINDERS_SHARD_CURSOR_NAME % (shard, 2)), self.now_datetime)
+
 class UpdateSendDateTimeTest(TestCase):
 	def setUp(self):
 		self.test_datetime = datetime.datetime.now()
@@ -350,6 +690,151 @@ class UpdateSendDateTimeTest(TestCase):
 		self.assertTrue((self.n_yearly.send_datetime.year - future_datetime.year) == 1)
 		freezer.stop()
 
+	def test_repeated_monthly_and_yearly_updates_keep_their_day(self):
+		monthly = Notification.objects.create(to=self.patient1, _type=Notification.STATIC_ONE_OFF,
+		                                      repeat=Notification.MONTHLY, content="Test content",
+		                                      send_datetime=datetime.datetime(2016, 1, 31, 9, 0))
+		for (i, day) in enumerate([datetime.date(2016, 2, 29), datetime.date(2016, 3, 31),
+		                           datetime.date(2016, 4, 30), datetime.date(2016, 5, 31)]):
+			# Alternate between single and bulk updates, which write the notification back differently
+			if i % 2:
+				Notification.objects.advance_send_times([monthly], now=monthly.send_datetime)
+			else:
+				monthly.update_to_next_send_time(now=monthly.send_datetime)
+			monthly = Notification.objects.select_related('to').get(pk=monthly.pk)
+			self.assertEqual(monthly.send_datetime, datetime.datetime.combine(day, datetime.time(9, 0)))
+
+		yearly = Notification.objects.create(to=self.patient1, _type=Notification.STATIC_ONE_OFF,
+		                                     repeat=Notification.YEARLY, content="Test content",
+		                                     send_datetime=datetime.datetime(2012, 2, 29, 9, 0))
+		for day in [datetime.date(2013, 2, 28), datetime.date(2014, 2, 28), datetime.date(2015, 2, 28),
+		            datetime.date(2016, 2, 29)]:
+			yearly.update_to_next_send_time(now=yearly.send_datetime)
+			yearly = Notification.objects.get(pk=yearly.pk)
+			self.assertEqual(yearly.send_datetime, datetime.datetime.combine(day, datetime.time(9, 0)))
+
+	def test_advance_send_times(self):
+		notifications = [self.n_daily, self.n_weekly, self.n_monthly, self.n_yearly]
+		for notification in notifications:
+			notification.save()
+		# A year dormant is caught up in one step and one query
+		now = self.test_datetime + datetime.timedelta(days=365, hours=1)
+		with self.assertNumQueries(1):
+			Notification.objects.advance_send_times(notifications, now=now)
+		n_daily = Notification.objects.get(pk=self.n_daily.pk)
+		self.assertEqual(n_daily.send_datetime, self.test_datetime + datetime.timedelta(days=366))
+		self.assertEqual(n_daily.times_sent, 1)
+		n_weekly = Notification.objects.get(pk=self.n_weekly.pk)
+		self.assertEqual(n_weekly.send_datetime, self.test_datetime + datetime.timedelta(days=371))
+
+	def test_update_custom_send_datetime(self):
+		tuesday = datetime.datetime(2014, 3, 4, 7, 0)
+		notification = Notification.objects.create(to=self.patient1, _type=Notification.STATIC_ONE_OFF,
+		                                           repeat=Notification.CUSTOM, send_datetime=tuesday,
+		                                           recurrence_rule="FREQ=WEEKLY;BYDAY=MO,WE,FR;BYHOUR=8,20",
+		                                           content="Test content")
+		# The first send is snapped to the rule's first occurrence
+		self.assertEqual(notification.send_datetime, datetime.datetime(2014, 3, 5, 8, 0))
+		notification.update_to_next_send_time(now=datetime.datetime(2014, 3, 5, 8, 1))
+		notification = Notification.objects.get(pk=notification.pk)
+		self.assertEqual(notification.send_datetime, datetime.datetime(2014, 3, 5, 20, 0))
+		self.assertEqual(notification.get_upcoming_send_datetimes(3, now=datetime.datetime(2015, 3, 4)),
+		                 [datetime.datetime(2015, 3, 4, 8, 0), datetime.datetime(2015, 3, 4, 20, 0),
+		                  datetime.datetime(2015, 3, 6, 8, 0)])
+
+		notification.recurrence_rule = "FREQ=DAILY;UNTIL=20140306"
+		notification.update_to_next_send_time(now=datetime.datetime(2014, 3, 7))
+		self.assertFalse(notification.active)
+		self.assertRaises(ValidationError, Notification, to=self.patient1, _type=Notification.STATIC_ONE_OFF,
+		                  repeat=Notification.CUSTOM, send_datetime=tuesday, recurrence_rule="FREQ=HOURLY",
+		                  content="Test content")
+
+	def test_update_send_datetime_in_patient_timezone(self):
+		# Phoenix doesn't observe DST, so 8am there is 8am on the server until 11/2/2014 and 7am after
+		self.patient1.timezone = 'America/Phoenix'
+		notification = Notification.objects.create(to=self.patient1, _type=Notification.STATIC_ONE_OFF,
+		                                           repeat=Notification.DAILY, content="Test content",
+		                                           send_datetime=datetime.datetime(2014, 11, 1, 8, 0))
+		notification.update_to_next_send_time(now=datetime.datetime(2014, 11, 1, 8, 0))
+		self.assertEqual(notification.send_datetime, datetime.datetime(2014, 11, 2, 7, 0))
+		notification.update_to_next_send_time(now=datetime.datetime(2014, 11, 2, 7, 0))
+		self.assertEqual(notification.send_datetime, datetime.datetime(2014, 11, 3, 7, 0))
+
+		Notification.objects.change_timezone(self.patient1, 'America/New_York')
+		notification = Notification.objects.get(pk=notification.pk)
+		self.assertEqual(notification.send_datetime, datetime.datetime(2014, 11, 3, 5, 0))
+		self.assertEqual(PatientProfile.objects.get(pk=self.patient1.pk).timezone, 'America/New_York')
+
+	def test_send_datetime_repeated_by_server_dst_change(self):
+		# 4:30am in New York on 11/2/2014 is the second 1:30am on the server, after it falls back
+		self.patient1.timezone = 'America/New_York'
+		self.patient1.save()
+		notification = Notification.objects.create(to=self.patient1, _type=Notification.STATIC_ONE_OFF,
+		                                           repeat=Notification.DAILY, content="Test content",
+		                                           send_datetime=datetime.datetime(2014, 11, 1, 1, 30))
+		notification.update_to_next_send_time(now=datetime.datetime(2014, 11, 1, 2, 0))
+		notification = Notification.objects.select_related('to').get(pk=notification.pk)
+		self.assertEqual(notification.send_datetime, datetime.datetime(2014, 11, 2, 1, 30))
+		self.assertEqual(notification.send_datetime_is_dst, False)
+		self.assertEqual(notification.get_local_send_datetime(), datetime.datetime(2014, 11, 2, 4, 30))
+
+		# It isn't due during the first 1:30am
+		now = datetime.datetime(2014, 11, 2, 1, 45)
+		self.assertFalse(Notification.objects.notifications_at_time(now, now_is_dst=True).exists())
+		self.assertEqual(list(Notification.objects.notifications_at_time(now, now_is_dst=False)), [notification])
+
+		notification.update_to_next_send_time(now=now)
+		self.assertEqual(notification.send_datetime, datetime.datetime(2014, 11, 3, 1, 30))
+		self.assertEqual(notification.send_datetime_is_dst, None)
+
+class RecurrenceTest(SimpleTestCase):
+	def test_next_by_period(self):
+		start = datetime.datetime(2014, 1, 1, 9, 0)
+		day = datetime.timedelta(days=1)
+		self.assertEqual(recurrence.next_by_period(start, start, day), datetime.datetime(2014, 1, 2, 9, 0))
+		self.assertEqual(recurrence.next_by_period(start, start - 3 * day, day), datetime.datetime(2014, 1, 2, 9, 0))
+		self.assertEqual(recurrence.next_by_period(start, datetime.datetime(2015, 3, 1, 8, 59), day),
+		                 datetime.datetime(2015, 3, 1, 9, 0))
+		self.assertEqual(recurrence.next_by_period(start, datetime.datetime(2015, 3, 1, 9, 0), 7 * day),
+		                 datetime.datetime(2015, 3, 4, 9, 0))
+
+	def test_next_by_months_clamps_month_ends(self):
+		start = datetime.datetime(2016, 1, 31, 9, 0)
+		self.assertEqual(recurrence.next_by_months(start, start, 1), datetime.datetime(2016, 2, 29, 9, 0))
+		self.assertEqual(recurrence.next_by_months(start, datetime.datetime(2016, 3, 5), 1),
+		                 datetime.datetime(2016, 3, 31, 9, 0))
+		self.assertEqual(recurrence.next_by_months(start, datetime.datetime(2017, 2, 28), 1),
+		                 datetime.datetime(2017, 3, 31, 9, 0))
+		self.assertEqual(recurrence.next_by_months(datetime.datetime(2013, 11, 15), datetime.datetime(2013, 11, 15), 1),
+		                 datetime.datetime(2013, 12, 15))
+		# A clamped start goes back to the schedule's day
+		clamped = datetime.datetime(2016, 2, 29, 9, 0)
+		self.assertEqual(recurrence.next_by_months(clamped, clamped, 1, 31), datetime.datetime(2016, 3, 31, 9, 0))
+
+	def test_next_by_years_clamps_leap_days(self):
+		start = datetime.datetime(2012, 2, 29, 9, 0)
+		self.assertEqual(recurrence.next_by_years(start, start), datetime.datetime(2013, 2, 28, 9, 0))
+		self.assertEqual(recurrence.next_by_years(start, datetime.datetime(2015, 6, 1)), datetime.datetime(2016, 2, 29, 9, 0))
+
+	def test_recurrence_rule_occurrences(self):
+		tuesday = datetime.datetime(2014, 3, 4, 8, 0)
+		every_other_day = recurrence.RecurrenceRule.parse("FREQ=DAILY;INTERVAL=2")
+		self.assertEqual(every_other_day.occurrences(tuesday, datetime.datetime(2015, 1, 1), 2),
+		                 [datetime.datetime(2015, 1, 2, 8, 0), datetime.datetime(2015, 1, 4, 8, 0)])
+		every_other_week = recurrence.RecurrenceRule.parse("FREQ=WEEKLY;INTERVAL=2;BYDAY=MO,FR")
+		self.assertEqual(every_other_week.occurrences(tuesday, tuesday, 3),
+		                 [datetime.datetime(2014, 3, 7, 8, 0), datetime.datetime(2014, 3, 17, 8, 0),
+		                  datetime.datetime(2014, 3, 21, 8, 0)])
+		until = recurrence.RecurrenceRule.parse("FREQ=DAILY;BYHOUR=9;BYMINUTE=15;UNTIL=20140305")
+		self.assertEqual(until.occurrences(tuesday, tuesday, 5),
+		                 [datetime.datetime(2014, 3, 4, 9, 15), datetime.datetime(2014, 3, 5, 9, 15)])
+		self.assertIs(recurrence.RecurrenceRule.parse("FREQ=DAILY;INTERVAL=2"), every_other_day)
+
+	def test_invalid_recurrence_rules(self):
+		for rule in ["", "FREQ=MONTHLY", "FREQ=DAILY;BYDAY=MO", "FREQ=WEEKLY;BYDAY=XX", "FREQ=DAILY;BYHOUR=24",
+		             "FREQ=DAILY;INTERVAL=0", "FREQ=DAILY;COUNT=3", "FREQ=DAILY;UNTIL=tomorrow"]:
+			self.assertRaises(ValueError, recurrence.RecurrenceRule, rule)
+
 class TestTemplates(TestCase):
 
 	def test_safety_net_adherent_template_male_response(self):
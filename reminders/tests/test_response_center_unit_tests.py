@@ -1,14 +1,18 @@
 import datetime, mock
 
+from django.core.cache import cache
 from django.http import HttpResponseNotFound
-from django.test import TestCase
+from django.test import SimpleTestCase, TestCase
 
+from configs.dev import settings
 from common.models import Drug, DrugFact
 from common.utilities import list_to_queryset
 from patients.models import PatientProfile
 from doctors.models import DoctorProfile
-from reminders.models import Message, Prescription, Notification, Feedback
+from reminders.models import Message, Prescription, Notification, Feedback, InboundMessage
 from reminders.response_center import ResponseCenter
+from reminders.response_classifier import ResponseClassifier, ClassifiedResponse
+from reminders import tasks
 
 from freezegun import freeze_time
 
@@ -595,3 +599,95 @@ class ResponseCenterTest(TestCase):
 		self.assertFalse(self.rc.is_time_change(message))
 		message = '10:2am'
 		self.assertFalse(self.rc.is_time_change(message))
+
+
+class ResponseClassifierTest(SimpleTestCase):
+	def setUp(self):
+		self.classifier = ResponseClassifier()
+
+	def test_classify(self):
+		self.assertEqual(self.classifier.classify(' Yes '), ClassifiedResponse(ResponseClassifier.YES, None, None))
+		self.assertEqual(self.classifier.classify('Q'), ClassifiedResponse(ResponseClassifier.QUIT, None, None))
+		self.assertEqual(self.classifier.classify('info'), ClassifiedResponse(ResponseClassifier.MED_INFO, None, None))
+		self.assertEqual(self.classifier.classify('c'), ClassifiedResponse(ResponseClassifier.OPTION, 'C', None))
+		self.assertEqual(self.classifier.classify('10:27 PM'),
+		                 ClassifiedResponse(ResponseClassifier.TIME, None, datetime.time(hour=22, minute=27)))
+		self.assertEqual(self.classifier.classify('see you at 9'), ClassifiedResponse(ResponseClassifier.UNKNOWN, None, None))
+
+	def test_classify_is_memoized(self):
+		self.assertIs(self.classifier.classify('y'), self.classifier.classify('y'))
+		self.classifier.MAX_MEMOIZED_RESPONSES = 2
+		for response in ['a', 'b', 'c']:
+			self.classifier.classify(response)
+		self.assertLessEqual(len(self.classifier.classified_responses), 2)
+
+
+class InboundMessageLedgerTest(TestCase):
+	def setUp(self):
+		cache.clear()
+		self.minqi = PatientProfile.objects.create(first_name="Minqi", last_name="Jiang",
+		                                           primary_phone_number="8569067308")
+		doctor = DoctorProfile.objects.create(first_name="Bob", last_name="Wachter",
+		                                      primary_phone_number="2029163381", birthday=datetime.date(1960, 1, 1))
+		prescription = Prescription.objects.create(prescriber=doctor, patient=self.minqi,
+		                                           drug=Drug.objects.create(name='advil'), filled=True)
+		notification = Notification.objects.create(to=self.minqi, _type=Notification.MEDICATION,
+		                                           prescription=prescription, repeat=Notification.DAILY,
+		                                           send_datetime=datetime.datetime.now())
+		self.message = Message.objects.create(to=self.minqi, _type=Message.MEDICATION)
+		self.message.notifications.add(notification)
+		self.message.feedbacks.add(Feedback.objects.create(_type=Feedback.MEDICATION, notification=notification,
+		                                                   prescription=prescription))
+
+	def tearDown(self):
+		cache.clear()
+
+	def send_text(self, body, sid):
+		return self.client.get('/textmessage_response/',
+		                       {'From': self.minqi.primary_phone_number, 'Body': body, 'MessageSid': sid})
+
+	def test_retries_get_the_first_response(self):
+		response = self.send_text('n', 'SM0001')
+		self.assertEqual(response.status_code, 200)
+		message_count = Message.objects.count()
+
+		# Served from the cache without touching the DB
+		with self.assertNumQueries(0):
+			retry = self.send_text('n', 'SM0001')
+		self.assertEqual((retry.status_code, retry.content), (response.status_code, response.content))
+
+		# Served from the ledger once the cache has lost it
+		cache.clear()
+		retry = self.send_text('n', 'SM0001')
+		self.assertEqual((retry.status_code, retry.content), (response.status_code, response.content))
+		self.assertEqual(Message.objects.count(), message_count)
+
+		# A new text is processed
+		self.send_text('a', 'SM0002')
+		self.assertEqual(Message.objects.count(), message_count + 1)
+
+	@mock.patch('reminders.tasks.sendTextMessageToNumber')
+	@mock.patch('reminders.views.process_inbound_messages')
+	def test_async_processing_in_order(self, process_inbound_messages, sendTextMessageToNumber):
+		with mock.patch.object(settings, 'INBOUND_SMS_ASYNC', True):
+			self.assertEqual(self.send_text('n', 'SM0001').content, '')
+			self.send_text('a', 'SM0002')
+			self.send_text('a', 'SM0002')
+		process_inbound_messages.delay.assert_called_with(self.minqi.primary_phone_number)
+		self.assertEqual(process_inbound_messages.delay.call_count, 2)
+		self.assertEqual(Notification.objects.filter(_type=Notification.REPEAT_MESSAGE).count(), 0)
+
+		self.assertEqual(tasks.process_inbound_messages(self.minqi.primary_phone_number), 2)
+		# 'a' is only understood as an answer to the questionnaire sent in reply to 'n'
+		self.assertEqual(Notification.objects.filter(_type=Notification.REPEAT_MESSAGE).count(), 1)
+		self.assertEqual(sendTextMessageToNumber.call_count, 2)
+		self.assertEqual(InboundMessage.objects.pending_for_number(self.minqi.primary_phone_number).count(), 0)
+		self.assertEqual(tasks.process_inbound_messages(self.minqi.primary_phone_number), 0)
+
+	def test_delete_expired(self):
+		self.send_text('n', 'SM0001')
+		self.send_text('a', 'SM0002')
+		InboundMessage.objects.filter(sid='SM0001').update(
+			datetime_received=datetime.datetime.now() - datetime.timedelta(days=2))
+		self.assertEqual(InboundMessage.objects.delete_expired(datetime.datetime.now()), 1)
+		self.assertEqual(list(InboundMessage.objects.values_list('sid', flat=True)), ['SM0002'])
@@ -0,0 +1,115 @@
+import datetime
+
+from django.test import TestCase
+
+from common.models import Drug
+from doctors.models import DoctorProfile
+from patients.models import PatientProfile
+from reminders.models import Prescription, Notification, Feedback, AdherenceRollup
+from reminders.safety_net_center import SafetyNetCenter
+
+
+class SafetyNetCenterTest(TestCase):
+	def setUp(self):
+		self.snc = SafetyNetCenter()
+		self.now = datetime.datetime.now()
+		self.doctor = DoctorProfile.objects.create(first_name="Bob", last_name="Wachter",
+		                                           primary_phone_number="2029163381", birthday=datetime.date(1960, 1, 1))
+		self.drug = Drug.objects.create(name='advil')
+		self.minqi = PatientProfile.objects.create(first_name="Minqi", last_name="Jiang",
+		                                           primary_phone_number="8569067308",
+		                                           gender=PatientProfile.MALE)
+		self.matt = PatientProfile.objects.create(first_name="Matt", last_name="Gaba",
+		                                          primary_phone_number="2147094720",
+		                                          gender=PatientProfile.MALE)
+		self.minqi_prescription = Prescription.objects.create(prescriber=self.doctor, patient=self.minqi,
+		                                                      drug=self.drug, filled=True, safety_net_on=True)
+		self.matt_prescription = Prescription.objects.create(prescriber=self.doctor, patient=self.matt,
+		                                                     drug=self.drug, filled=True, safety_net_on=False)
+
+	def create_feedback(self, prescription, completed, hours_ago):
+		notification = Notification.objects.create(to=prescription.patient, _type=Notification.MEDICATION,
+		                                           prescription=prescription, repeat=Notification.DAILY,
+		                                           send_datetime=self.now)
+		feedback = Feedback.objects.create(_type=Feedback.MEDICATION, notification=notification,
+		                                   prescription=prescription, completed=completed)
+		Feedback.objects.filter(pk=feedback.pk).update(
+			datetime_sent=self.now - datetime.timedelta(hours=hours_ago))
+
+	def compute_adherence(self):
+		AdherenceRollup.objects.record_timed_out_doses(self.now - self.snc.timeout)
+		return self.snc._compute_adherence_percentage_by_patients(
+			self.now - self.snc.window, self.now, self.now, self.snc.timeout)
+
+	def test_compute_adherence_percentage_by_patients(self):
+		self.create_feedback(self.minqi_prescription, completed=True, hours_ago=24)
+		self.create_feedback(self.minqi_prescription, completed=True, hours_ago=48)
+		self.create_feedback(self.minqi_prescription, completed=False, hours_ago=72)
+		# Doses sent less than timeout ago aren't counted yet, acknowledged or not
+		self.create_feedback(self.minqi_prescription, completed=False, hours_ago=1)
+		self.create_feedback(self.minqi_prescription, completed=True, hours_ago=1)
+		# Doses sent before the window aren't counted, even on the window's first day
+		self.create_feedback(self.minqi_prescription, completed=False, hours_ago=24 * 7 + 1)
+		self.create_feedback(self.minqi_prescription, completed=False, hours_ago=24 * 8)
+		# Doses of prescriptions without a safety net aren't counted
+		self.create_feedback(self.matt_prescription, completed=False, hours_ago=24)
+
+		adherence = self.compute_adherence()
+		self.assertEqual(adherence.keys(), [self.minqi.pk])
+		self.assertAlmostEqual(adherence[self.minqi.pk], 2.0 / 3.0)
+
+	def test_compute_adherence_percentage_by_patients_reads_rollups(self):
+		for i in range(3):
+			self.create_feedback(self.minqi_prescription, completed=bool(i % 2), hours_ago=24 * (i + 1))
+		self.assertAlmostEqual(self.compute_adherence()[self.minqi.pk], 1.0 / 3.0)
+		# One query to sum the rollups of whole days and one to count the partial days
+		with self.assertNumQueries(2):
+			adherence = self.snc._compute_adherence_percentage_by_patients(
+				self.now - self.snc.window, self.now, self.now, self.snc.timeout)
+		self.assertAlmostEqual(adherence[self.minqi.pk], 1.0 / 3.0)
+
+	def test_compute_adherence_percentage_by_patients_spans_days(self):
+		window_start = datetime.datetime(2014, 3, 1, 12, 0)
+		time = datetime.datetime(2014, 3, 8, 16, 0)
+		self.now = time
+		for (hours_ago, completed) in [(24 * 7 + 5, True), (24 * 7 + 1, False), (24 * 7 - 1, True),
+		                               (24 * 3, False), (5, True), (3, True), (1, False)]:
+			self.create_feedback(self.minqi_prescription, completed=completed, hours_ago=hours_ago)
+		AdherenceRollup.objects.record_timed_out_doses(time - self.snc.timeout)
+		# Only the doses sent from Mar 1 at noon until timeout before time (Mar 8 at noon) count
+		adherence = self.snc._compute_dose_counts_by_patients(window_start, time, time, self.snc.timeout)
+		self.assertEqual(adherence, {self.minqi.pk: [4, 2]})
+
+	def test_schedule_safety_net_messages_from_adherence_percentage_list(self):
+		mom = PatientProfile.objects.create(first_name="Jianna", last_name="Jiang", primary_phone_number="1234567890")
+		friend = PatientProfile.objects.create(first_name="Bob", last_name="Smith", primary_phone_number="1234567891")
+		self.minqi.add_safety_net_contact(target_patient=mom, relationship='mother')
+		self.matt.add_safety_net_contact(target_patient=mom, relationship='mother')
+		self.matt.add_safety_net_contact(target_patient=friend, relationship='friend')
+
+		with self.assertNumQueries(2):
+			self.snc._schedule_safety_net_messages_from_adherence_percentage_list(
+				{self.minqi.pk: 0.5, self.matt.pk: 0.5}, self.snc.threshold)
+
+		notifications = Notification.objects.filter(_type=Notification.SAFETY_NET)
+		self.assertEqual(notifications.count(), 3)
+		minqi_to_mom = notifications.get(to=mom, patient_of_safety_net=self.minqi)
+		self.assertEqual(minqi_to_mom.content,
+		                 "Your son, Minqi, has had trouble with his medicine this week. He's reported taking 50% of "
+		                 "his meds. Maybe you should give him a call?")
+		matt_to_mom = notifications.get(to=mom, patient_of_safety_net=self.matt)
+		self.assertEqual(matt_to_mom.content, minqi_to_mom.content.replace("Minqi", "Matt"))
+		matt_to_friend = notifications.get(to=friend, patient_of_safety_net=self.matt)
+		self.assertTrue(matt_to_friend.content.startswith("Your friend, Matt,"))
+
+	def test_schedule_safety_net_messages_query_count_is_per_batch(self):
+		self.snc.batch_size = 1
+		self.minqi.add_safety_net_contact(target_patient=self.matt, relationship='friend')
+		self.matt.add_safety_net_contact(target_patient=self.minqi, relationship='friend')
+		with self.assertNumQueries(4):
+			self.snc._schedule_safety_net_messages_from_adherence_percentage_list(
+				{self.minqi.pk: 1.0, self.matt.pk: 1.0}, self.snc.threshold)
+		self.assertEqual(Notification.objects.filter(_type=Notification.SAFETY_NET).count(), 2)
+		content = Notification.objects.get(_type=Notification.SAFETY_NET, patient_of_safety_net=self.minqi).content
+		self.assertEqual(content, "Great news - your friend, Minqi, has been taking care this week. He's reported "
+		                          "taking 100% of his meds.")
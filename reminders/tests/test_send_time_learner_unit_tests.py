@@ -0,0 +1,74 @@
+import datetime
+
+from django.test import TestCase
+
+from common.models import Drug
+from doctors.models import DoctorProfile
+from patients.models import PatientProfile
+from reminders.models import Prescription, Notification, Message, Feedback
+from reminders.send_time_learner import SendTimeLearner
+from reminders import tasks as reminder_tasks
+
+from freezegun import freeze_time
+
+
+class SendTimeLearnerTest(TestCase):
+	def setUp(self):
+		self.learner = SendTimeLearner(ack_window=datetime.timedelta(hours=1), max_offset_hours=2,
+		                               prior_weight=5, min_improvement=0.1)
+		self.doctor = DoctorProfile.objects.create(first_name="Bob", last_name="Wachter",
+		                                           primary_phone_number="2029163381", birthday=datetime.date(1960, 1, 1))
+		self.drug = Drug.objects.create(name='advil')
+		self.minqi = PatientProfile.objects.create(first_name="Minqi", last_name="Jiang",
+		                                           primary_phone_number="8569067308",
+		                                           status=PatientProfile.ACTIVE)
+		self.prescription = Prescription.objects.create(prescriber=self.doctor, patient=self.minqi,
+		                                                drug=self.drug, filled=True)
+		self.notification = Notification.objects.create(to=self.minqi, _type=Notification.MEDICATION,
+		                                                prescription=self.prescription, repeat=Notification.DAILY,
+		                                                send_datetime=datetime.datetime(2014, 3, 1, 8, 0))
+
+	def create_feedback(self, datetime_sent, response_delay=None):
+		feedback = Feedback.objects.create(_type=Feedback.MEDICATION, notification=self.notification,
+		                                   prescription=self.prescription, completed=response_delay is not None)
+		Feedback.objects.filter(pk=feedback.pk).update(
+			datetime_sent=datetime_sent,
+			datetime_responded=datetime_sent + response_delay if response_delay is not None else None)
+
+	def test_compute_offsets(self):
+		dose_counts = [0] * 24
+		acked_dose_counts = [0] * 24
+		dose_counts[8], acked_dose_counts[8] = 20, 2
+		dose_counts[9], acked_dose_counts[9] = 20, 18
+		offsets = self.learner.compute_offsets(dose_counts, acked_dose_counts)
+		self.assertEqual(offsets[8], 60)
+		# Reminders at 9 are already sent at the best hour; hours without doses lean on the prior
+		self.assertEqual(offsets[9], 0)
+		self.assertEqual(offsets[7], 120)
+		self.assertEqual(self.learner.compute_offsets([0] * 24, [0] * 24), [0] * 24)
+
+	def test_train(self):
+		for day in range(1, 21):
+			# Reminders at 8am go unacknowledged or are acknowledged hours later; those at 9am promptly
+			self.create_feedback(datetime.datetime(2014, 3, day, 8, 0),
+			                     datetime.timedelta(hours=3) if day % 2 else None)
+			self.create_feedback(datetime.datetime(2014, 3, day, 9, 0), datetime.timedelta(minutes=10))
+		self.assertEqual(self.learner.train(), 1)
+		minqi = PatientProfile.objects.get(pk=self.minqi.pk)
+		self.assertEqual(minqi.get_send_time_offset(8), 60)
+		self.assertEqual(minqi.get_send_time_offset(9), 0)
+
+	def test_dispatch_holds_until_best_send_time(self):
+		self.minqi.send_time_offsets = ",".join(["60" if hour == 8 else "0" for hour in range(24)])
+		self.minqi.save()
+		self.assertEqual(self.notification.get_best_send_time(), datetime.datetime(2014, 3, 1, 9, 0))
+
+		with freeze_time(datetime.datetime(2014, 3, 1, 8, 0)):
+			self.assertEqual(reminder_tasks.sendRemindersAtDatetime(datetime.datetime(2014, 3, 1, 8, 0)), 0)
+		self.assertEqual(Message.objects.count(), 0)
+		with freeze_time(datetime.datetime(2014, 3, 1, 9, 0)):
+			self.assertEqual(reminder_tasks.sendRemindersAtDatetime(datetime.datetime(2014, 3, 1, 9, 0)), 1)
+		self.assertEqual(Message.objects.count(), 1)
+		# The next reminder is still scheduled at 8am
+		notification = Notification.objects.get(pk=self.notification.pk)
+		self.assertEqual(notification.send_datetime, datetime.datetime(2014, 3, 2, 8, 0))
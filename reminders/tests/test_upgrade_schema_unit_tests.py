@@ -0,0 +1,29 @@
+from StringIO import StringIO
+
+import mock
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase
+
+
+class UpgradeSchemaTest(TestCase):
+	def dry_run(self):
+		out = StringIO()
+		call_command('upgrade_schema', dry_run=True, stdout=out)
+		return out.getvalue()
+
+	def test_current_schema_needs_no_changes(self):
+		self.assertEqual(self.dry_run(), "")
+
+	@mock.patch('reminders.management.commands.upgrade_schema.call_command')
+	def test_upgrades_schema_from_before_new_columns(self, call_command_mock):
+		cursor = connection.cursor()
+		cursor.execute("ALTER TABLE reminders_feedback DROP COLUMN rolled_up")
+		cursor.execute("ALTER TABLE reminders_notification DROP COLUMN send_datetime_is_dst")
+		cursor.execute("ALTER TABLE reminders_message ALTER COLUMN content TYPE varchar(160)")
+		cursor.execute("DROP INDEX reminders_notification_active_send_datetime")
+		self.assertEqual(len(self.dry_run().splitlines()), 5)
+
+		call_command('upgrade_schema', stdout=StringIO())
+		self.assertTrue(call_command_mock.called)
+		self.assertEqual(self.dry_run(), "")
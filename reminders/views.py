@@ -1,48 +1,177 @@
-import csv, random, datetime, json
-from django.db.models import Q
+import csv, datetime, hashlib, json, StringIO
+from django.db.models import Q, Count, Max, Sum
 
-from django.http import HttpResponse
+from django.http import HttpResponse, HttpResponseBadRequest, StreamingHttpResponse
 from django.contrib.auth.decorators import login_required
 from django.template.loader import render_to_string
+from django.utils.cache import patch_cache_control
+from django.utils.dateparse import parse_date
+from django.views.decorators.http import condition
 
+from guardian.shortcuts import get_objects_for_user
+
+from configs.dev import settings
+from common.utilities import is_integer, query_budget
 from patients.models import PatientProfile
-from reminders.models import Feedback, Message
+from reminders.models import Feedback, Message, AdherenceRollup, InboundMessage
 from reminders.response_center import ResponseCenter
+from reminders.tasks import process_inbound_messages
+
+# ResponseCenter keeps no per-request state, so one instance serves every inbound text
+response_center = ResponseCenter()
 
 def handle_text(request):
+	if settings.INBOUND_SMS_ASYNC:
+		return handle_text_async(request)
+	def process():
+		patient = PatientProfile.objects.get_by_phone_number(request.GET.get('From'))
+		return response_center.process_response(patient, request.GET['Body'])
+	with query_budget(settings.INBOUND_SMS_QUERY_BUDGET, "Inbound text"):
+		# Twilio retries webhooks with the same MessageSid; retries get the first response
+		return InboundMessage.objects.process_once(request.GET.get('MessageSid'), process)
+
+def handle_text_async(request):
+	"""
+	Records the inbound text and acknowledges it with an empty response, so Twilio sends
+	no reply; a worker processes it and texts the reply (see reminders.tasks.process_inbound_messages)
+	"""
+	from_number = request.GET.get('From', '')
+	inbound_message = InboundMessage.objects.receive(request.GET.get('MessageSid'), from_number, request.GET['Body'])
+	if inbound_message is not None:
+		process_inbound_messages.delay(from_number)
+	return HttpResponse(content_type='text/plain')
+
+ADHERENCE_HISTORY_DAYS = 100 # days of history returned when no start date is given
+ADHERENCE_HISTORY_HEADERS = [
+	'date',
+	'adherence_rate',
+	'daily_adherence_rate',
+	'dose_count',
+	'acked_dose_count',
+]
+
+def _get_adherence_history_rollups(request):
+	"""
+	Returns a (rollups, start_date, end_date, error) tuple for an adherence_history_csv request.
+	rollups are those of patient p_id, or of every patient the user manages if p_id is
+	omitted, between the optional start and end dates (YYYY-MM-DD). If the request is
+	invalid, error is an error message and the rest are None.
+	Computed once per request, since the ETag, Last-Modified and the response all need it.
+	"""
+	if hasattr(request, '_adherence_history_rollups'):
+		return request._adherence_history_rollups
+
+	request._adherence_history_rollups = (None, None, None, "Something went wrong.")
 	try:
-		patient = PatientProfile.objects.get(primary_phone_number=request.GET['From'])
-	except:
-		patient = None
-	rc = ResponseCenter()
-	return rc.process_response(patient, request.GET['Body'])
+		end_date = parse_date(request.GET['end']) if 'end' in request.GET else datetime.date.today()
+		start_date = parse_date(request.GET['start']) if 'start' in request.GET else \
+			end_date and end_date - datetime.timedelta(days=ADHERENCE_HISTORY_DAYS - 1)
+	except ValueError:
+		return request._adherence_history_rollups
+	if not start_date or not end_date:
+		return request._adherence_history_rollups
+
+	patient_id = request.GET.get('p_id', None)
+	if patient_id is None:
+		patients = get_objects_for_user(request.user, 'patients.manage_patientprofile')
+	elif not is_integer(patient_id):
+		return request._adherence_history_rollups
+	else:
+		try:
+			patient = PatientProfile.objects.get(id=int(patient_id))
+		except PatientProfile.DoesNotExist:
+			return request._adherence_history_rollups
+		if not request.user.has_perm('patients.manage_patientprofile', patient):
+			request._adherence_history_rollups = (None, None, None, "You don't have access to this user's profile")
+			return request._adherence_history_rollups
+		patients = [patient]
+
+	rollups = AdherenceRollup.objects.for_patients_between(patients, start_date, end_date)
+	request._adherence_history_rollups = (rollups, start_date, end_date, None)
+	return request._adherence_history_rollups
+
+def _get_adherence_history_summary(request):
+	"""
+	Returns the latest update time, count and dose totals of the request's rollups,
+	which change whenever the CSV would
+	"""
+	if not hasattr(request, '_adherence_history_summary'):
+		rollups = _get_adherence_history_rollups(request)[0]
+		if rollups is None:
+			request._adherence_history_summary = None
+		else:
+			request._adherence_history_summary = rollups.aggregate(
+				Max('last_updated'), Count('id'), Sum('dose_count'), Sum('acked_dose_count'))
+	return request._adherence_history_summary
+
+def _adherence_history_etag(request):
+	summary = _get_adherence_history_summary(request)
+	if summary is None:
+		return None
+	rollups, start_date, end_date, error = _get_adherence_history_rollups(request)
+	return hashlib.md5(repr((start_date, end_date, sorted(summary.items())))).hexdigest()
+
+def _adherence_history_last_modified(request):
+	summary = _get_adherence_history_summary(request)
+	if summary is None:
+		return None
+	return summary['last_updated__max']
+
+def _generate_adherence_history_csv(rollups, start_date, end_date):
+	"""
+	Yields an adherence history CSV one line at a time. There is a line for every day
+	from the first day with doses to end_date, with that day's dose counts and the running
+	adherence rate since start_date. Reads one row per day with doses.
+	"""
+	line = StringIO.StringIO()
+	csv_writer = csv.DictWriter(line, ADHERENCE_HISTORY_HEADERS, extrasaction='ignore', lineterminator='\n')
+	def pop_line():
+		value = line.getvalue()
+		line.seek(0)
+		line.truncate()
+		return value
+
+	csv_writer.writeheader()
+	yield pop_line()
+
+	daily_dose_counts = rollups.order_by('date').values_list('date').annotate(
+		Sum('dose_count'), Sum('acked_dose_count')).iterator()
+	next_daily_dose_counts = next(daily_dose_counts, None)
+	total_dose_count = total_acked_dose_count = 0
+	current_date = start_date
+	while current_date <= end_date:
+		dose_count = acked_dose_count = 0
+		if next_daily_dose_counts and next_daily_dose_counts[0] == current_date:
+			dose_count, acked_dose_count = next_daily_dose_counts[1:]
+			next_daily_dose_counts = next(daily_dose_counts, None)
+		total_dose_count += dose_count
+		total_acked_dose_count += acked_dose_count
+		if total_dose_count:
+			csv_writer.writerow({
+				'date':current_date.strftime('%e-%b-%y').strip(),
+				'adherence_rate':float(total_acked_dose_count)/total_dose_count,
+				'daily_adherence_rate':float(acked_dose_count)/dose_count if dose_count else '',
+				'dose_count':dose_count,
+				'acked_dose_count':acked_dose_count,
+			})
+			yield pop_line()
+		current_date += datetime.timedelta(days=1)
 
 @login_required
+@condition(etag_func=_adherence_history_etag, last_modified_func=_adherence_history_last_modified)
 def adherence_history_csv(request):
+	"""
+	Streams the daily adherence of a patient, or of the user's whole panel, as CSV.
+	See _get_adherence_history_rollups for the GET parameters.
+	"""
 	if request.method == 'GET':
-		AVG_RATE = .60
-		headers = [
-			'date',
-			'adherence_rate',
-		]
-		response = HttpResponse(content_type='text/csv')
-		csv_writer = csv.DictWriter(response, headers, extrasaction='ignore')
-		csv_writer.writeheader()
-
-		current_datetime = datetime.datetime(2012, 12, 31)
-		dt = datetime.timedelta(days=1)
-		adherence_count = 0
-		for i in range(100):
-			current_datetime += dt
-			gain = 1 if random.random() < AVG_RATE else 0 
-			adherence_count += gain
-			data = {
-				'date':current_datetime.strftime('%e-%b-%y').strip(),
-				'adherence_rate':float(adherence_count)/(i+1),
-			}
-			csv_writer.writerow(data)
-		response.content = response.content.strip('\r\n')
-
+		rollups, start_date, end_date, error = _get_adherence_history_rollups(request)
+		if error:
+			return HttpResponseBadRequest(error)
+		response = StreamingHttpResponse(_generate_adherence_history_csv(rollups, start_date, end_date),
+		                                 content_type='text/csv')
+		# Let the browser cache the CSV, but revalidate it with the ETag on every use
+		patch_cache_control(response, private=True, no_cache=True)
 		return response
 
 @login_required
@@ -129,7 +129,9 @@
 					data : dynamicData,
 					success : function(data) {
 						parsedData = d3.csv.parse(data);
-						sparkline('.adherence-sparkline', parsedData);
+						if (parsedData.length) {
+							sparkline('.adherence-sparkline', parsedData);
+						}
 					}
 				});
 			};
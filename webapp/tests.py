@@ -184,6 +184,21 @@ class CreatePatientTest(TestCase):
 		q = Notification.objects.filter(to=p, _type=Notification.WELCOME)
 		self.assertEqual(len(q), 1)
 
+	def test_create_patient_existing_account_in_new_timezone(self):
+		notification = Notification.objects.create(
+			to=self.patient3, _type=Notification.STATIC_ONE_OFF, repeat=Notification.DAILY,
+			content="Test content", send_datetime=datetime.datetime(2014, 3, 1, 8, 0))
+		response = c.post('/fishfood/patients/new/', 
+			{'full_name':'Test User3', 'primary_phone_number':'12111111112',
+			 'timezone':'America/New_York'})
+		self.assertEqual(response.status_code, 200)
+
+		p = PatientProfile.objects.get(pk=self.patient3.pk)
+		self.assertEqual(p.timezone, 'America/New_York')
+		# The reminder stays at 8am on the patient's new wall clock
+		notification = Notification.objects.get(pk=notification.pk)
+		self.assertEqual(notification.send_datetime, datetime.datetime(2014, 3, 1, 5, 0))
+
 	def test_create_patient_existing_managed_account(self):
 		response = c.post('/fishfood/patients/new/', 
 			{'full_name':'Test User2', 'primary_phone_number':'12111111111'})
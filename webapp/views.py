@@ -1,5 +1,6 @@
 import datetime, json
 
+import pytz
 from django import forms
 from django.template import RequestContext
 from django.shortcuts import render_to_response, redirect
@@ -12,11 +13,11 @@ from django.core.exceptions import ValidationError
 from django.core.urlresolvers import resolve
 from django.core.mail import send_mail
 from django.db.models import Q
-from django.template.loader import render_to_string
 from localflavor.us.forms import USPhoneNumberField
 from itertools import groupby
 
-from common.utilities import is_integer, next_weekday, convert_to_e164, sendTextMessageToNumber
+from common.message_templates import render_message
+from common.utilities import is_integer, next_weekday, convert_to_e164, sendTextMessageToNumber, to_server_datetime
 from common.registration_services import create_inactive_patientprofile, \
 	regprofile_activate_user_phonenumber
 from common.models import RegistrationProfile, Drug
@@ -83,6 +84,7 @@ class VerifyMobileForm(forms.Form):
 class CreatePatientForm(forms.Form):
     full_name = forms.CharField(max_length=80)
     primary_phone_number = USPhoneNumberField()
+    timezone = forms.ChoiceField(choices=[(tz, tz) for tz in pytz.common_timezones], required=False)
 
     def clean_full_name(self):
     	full_name = self.cleaned_data['full_name'].strip()
@@ -198,7 +200,7 @@ class DeleteReminderForm(forms.Form):
 		reminders_for_deletion = []
 		reminder_time = self.cleaned_data.get('reminder_time')
 		for r in reminders:
-			if r.send_datetime.time() == reminder_time:
+			if patient.to_local_datetime(r.send_datetime, r.send_datetime_is_dst).time() == reminder_time:
 				reminders_for_deletion.append(r)
 		if len(reminders_for_deletion) == 0:
 			raise ValidationError('Reminder does not exist')
@@ -352,8 +354,7 @@ def resend_mobile_verification_code(request):
 		regprofile.set_phonenumber_activation_key()
 		regprofile.save()
 
-		c['otp'] = regprofile.phonenumber_activation_key
-		body = render_to_string('messages/verify_mobile.html', c)
+		body = render_message('messages/verify_mobile.txt', {'otp': regprofile.phonenumber_activation_key})
 		sendTextMessageToNumber(
 			to=regprofile.userprofile.primary_phone_number,
 			body=body)
@@ -465,6 +466,10 @@ def create_patient(request, *args, **kwargs):
 				target_patient=request_user_patient, relationship='other',
 				receives_all_reminders=True)
 
+			# An existing patient may already have reminders on their old wall clock
+			timezone = form.cleaned_data['timezone']
+			if timezone and timezone != patient.timezone:
+				Notification.objects.change_timezone(patient, timezone)
 			patient.status = PatientProfile.NEW
 			patient.num_caregivers += 1
 			Notification.objects.create_consumer_welcome_notification(
@@ -503,11 +508,13 @@ def retrieve_patient(request, *args, **kwargs):
 				# get reminders
 				reminders = Notification.objects.filter(
 					to=patient, _type=Notification.MEDICATION)
-				reminders = sorted(reminders, key=lambda x: (x.prescription.drug.name, x.send_datetime.time()))
+				# Reminder times are shown in the patient's time zone
+				local_time = lambda x: patient.to_local_datetime(x.send_datetime, x.send_datetime_is_dst).time()
+				reminders = sorted(reminders, key=lambda x: (x.prescription.drug.name, local_time(x)))
 				reminder_groups = []
 				for drug, outer_group in groupby(reminders, lambda x: x.prescription.drug.name):
 					drug_group = {'drug_name':drug, 'schedules':[]}
-					for send_datetime, time_group in groupby(outer_group, lambda y: y.send_datetime.time()):
+					for send_datetime, time_group in groupby(outer_group, local_time):
 						days_of_week = []
 						for reminder in time_group:
 							days_of_week.append(reminder.day_of_week)
@@ -544,6 +551,9 @@ def update_patient(request, *args, **kwargs):
 			patient.last_name = last_name
 			patient.full_name = full_name
 			patient.primary_phone_number = primary_phone_number
+			timezone = form.cleaned_data['timezone']
+			if timezone and timezone != patient.timezone:
+				Notification.objects.change_timezone(patient, timezone)
 			patient.save()
 			result = {
 				'first_name':first_name,
@@ -568,7 +578,7 @@ def send_reminder(request, *args, **kwargs):
 			if next_notification is None:
 				return HttpResponseBadRequest("This user has no upcoming notifications")
 			next_notification_time = next_notification[0].send_datetime
-			sendRemindersAtDatetime(next_notification_time, patient)
+			sendRemindersAtDatetime(next_notification_time, patient, hold_until_best_send_time=False)
 			return HttpResponse('')
 
 	return HttpResponseBadRequest('Something went wrong')
@@ -664,7 +674,9 @@ def create_reminder(request, *args, **kwargs):
 			(prescription, prescription_created) = Prescription.objects.get_or_create(
 				prescriber=request.user, patient=patient, drug=drug)
 
+			# reminder_time is in the patient's time zone
 			reminder_time = form.cleaned_data['reminder_time']
+			patient_now = patient.to_local_datetime(datetime.datetime.now())
 			existing_reminders = Notification.objects.filter(
 				to=patient, prescription__drug__name__iexact=drug_name)
 
@@ -675,18 +687,19 @@ def create_reminder(request, *args, **kwargs):
 			if is_daily_reminder:
 				# remove all other reminders at this time, and replace with single daily reminder
 				for r in existing_reminders:
-					if r.send_datetime.time() == reminder_time:
+					if patient.to_local_datetime(r.send_datetime, r.send_datetime_is_dst).time() == reminder_time:
 						r.delete()
-				send_datetime = datetime.datetime.combine(
-					datetime.datetime.today().date(), reminder_time)
+				(send_datetime, send_datetime_is_dst) = to_server_datetime(datetime.datetime.combine(
+					patient_now.date(), reminder_time), patient.get_timezone())
 				med_reminder = Notification.objects.get_or_create(
 					to=patient, 
 					_type=Notification.MEDICATION,
 					send_datetime = send_datetime,
 					repeat=Notification.DAILY,
-					prescription=prescription)[0]
+					prescription=prescription,
+					defaults={'send_datetime_is_dst': send_datetime_is_dst})[0]
 				new_reminders.append(med_reminder)
-				if datetime.datetime.now().time() > reminder_time:
+				if patient_now.time() > reminder_time:
 					med_reminder.update_to_next_send_time()
 				med_reminder.day_of_week = 8
 				med_reminder.save()
@@ -700,23 +713,26 @@ def create_reminder(request, *args, **kwargs):
 							Q(day_of_week=idx+1) | Q(repeat=Notification.DAILY)
 						)
 						for r in existing_reminders_for_day:
-							if r.send_datetime.time() == reminder_time:
+							if patient.to_local_datetime(r.send_datetime, r.send_datetime_is_dst).time() == reminder_time:
 								skip_day = True
 								break
 						if not skip_day:
-							today = datetime.datetime.today()
+							today = patient_now
 							if today.weekday() == idx:
 								send_datetime = datetime.datetime.combine(today.date(), reminder_time)
 							else:
 								send_datetime = datetime.datetime.combine(
 									next_weekday(today.date(), idx), reminder_time
 								)
+							(send_datetime, send_datetime_is_dst) = to_server_datetime(
+								send_datetime, patient.get_timezone())
 							med_reminder = Notification.objects.get_or_create(
 								to=patient, 
 								_type=Notification.MEDICATION,
 								send_datetime = send_datetime,
 								repeat=Notification.WEEKLY,
-								prescription=prescription)[0]
+								prescription=prescription,
+								defaults={'send_datetime_is_dst': send_datetime_is_dst})[0]
 							new_reminders.append(med_reminder)
 							med_reminder.day_of_week = idx + 1
 							med_reminder.save()